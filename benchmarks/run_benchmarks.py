@@ -0,0 +1,186 @@
+"""
+Throughput benchmarks for jupyter_translate.
+
+Runs jupyter_translate() and translate_directory() over copies of the real
+notebooks in Everyones_nanoGPT_TODO/ against the deterministic FakeBackend,
+so the numbers only depend on this code and the simulated service:
+
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --output after.json --compare before.json
+
+Every scenario runs in its own subprocess so peak RSS is measured per
+scenario.  Reported per scenario: wall time, cells/sec, API calls per
+notebook, tokens sent and peak RSS.
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+NOTEBOOK_DIR = os.path.join(ROOT, "Everyones_nanoGPT_TODO")
+SINGLE_NOTEBOOK = "Everyones_nanoGPT_colab_Chapter06_TODO.ipynb"
+LANGUAGES = ["ja", "ko", "zh", "es"]
+
+# name -> (kind, options)
+SCENARIOS = {
+    "notebook_sequential": ("notebook", dict(workers=1, pack_tokens=0)),
+    "notebook_workers8_packed": ("notebook", dict(workers=8, pack_tokens=1000)),
+    "directory_sequential": ("directory", dict(workers=1, pack_tokens=0, dedupe=False)),
+    "directory_workers8_packed": ("directory", dict(workers=8, pack_tokens=1000)),
+    "directory_jobs4_workers4": ("directory", dict(jobs=4, workers=4, pack_tokens=1000)),
+    "languages4_one_by_one": ("languages", dict(workers=8, pack_tokens=1000)),
+    "languages4_one_pass": ("languages", dict(workers=8, pack_tokens=1000, fan_out=True)),
+}
+
+
+def _peak_rss_mb():
+    usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in KiB on Linux and in bytes on macOS.
+    return usage / (1024 * 1024) if sys.platform == "darwin" else usage / 1024
+
+
+def run_scenario(name, latency, per_token_latency, error_rate, seed):
+    """
+    Run one scenario in this process and return its measurements.
+    """
+    import jupyter_translate
+
+    kind, options = SCENARIOS[name]
+    workdir = tempfile.mkdtemp(prefix="jt-bench-")
+    try:
+        if kind in ("notebook", "languages"):
+            shutil.copy(os.path.join(NOTEBOOK_DIR, SINGLE_NOTEBOOK), workdir)
+        else:
+            for fn in os.listdir(NOTEBOOK_DIR):
+                if fn.endswith(".ipynb"):
+                    shutil.copy(os.path.join(NOTEBOOK_DIR, fn), workdir)
+
+        backend = jupyter_translate.FakeBackend(latency=latency,
+                                                per_token_latency=per_token_latency,
+                                                error_rate=error_rate, seed=seed)
+        client = jupyter_translate.TranslatorClient(
+            backend=backend, limiter=jupyter_translate.RateLimiter(retry_delay=0))
+        started = time.time()
+        try:
+            path = os.path.join(workdir, SINGLE_NOTEBOOK)
+            if kind == "notebook":
+                summaries = [jupyter_translate.jupyter_translate(
+                    path, "en", "ja", 0, client=client, incremental=False, **options)]
+            elif kind == "languages" and options.pop("fan_out", False):
+                summaries = jupyter_translate.translate_languages(
+                    path, "en", LANGUAGES, 0, client=client, incremental=False, **options)
+            elif kind == "languages":
+                summaries = [jupyter_translate.jupyter_translate(
+                    path, "en", lang, 0, client=client, incremental=False, **options)
+                    for lang in LANGUAGES]
+            else:
+                summaries = jupyter_translate.translate_directory(
+                    workdir, "en", "ja", 0, client=client, incremental=False, **options)
+        finally:
+            client.close()
+        wall = time.time() - started
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    cells = sum(s["cells"] for s in summaries)
+    requests, tokens = client.usage.snapshot()
+    # Worker processes keep their own counters; the summaries add them up.
+    requests = max(requests, sum(s["requests"] for s in summaries))
+    tokens = max(tokens, sum(s["tokens"] for s in summaries))
+    return {
+        "scenario": name,
+        "notebooks": len(summaries),
+        "cells": cells,
+        "wall_seconds": round(wall, 3),
+        "cells_per_second": round(cells / wall, 2) if wall else None,
+        "api_calls": requests,
+        "api_calls_per_notebook": round(requests / len(summaries), 1),
+        "tokens_sent": tokens,
+        "failures": sum(s["failures"] for s in summaries),
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+    }
+
+
+COLUMNS = [("scenario", "Scenario", 28), ("wall_seconds", "Wall s", 8),
+           ("cells_per_second", "Cells/s", 8), ("api_calls_per_notebook", "Calls/nb", 9),
+           ("tokens_sent", "Tokens", 9), ("peak_rss_mb", "RSS MB", 7)]
+
+
+def print_report(results, baseline=None):
+    print("  ".join(f"{title:>{width}}" if n else f"{title:<{width}}"
+                    for n, (_, title, width) in enumerate(COLUMNS)))
+    base = {r["scenario"]: r for r in baseline or []}
+    for row in results:
+        print("  ".join(f"{row[key]!s:>{width}}" if n else f"{row[key]:<{width}}"
+                        for n, (key, _, width) in enumerate(COLUMNS)))
+        old = base.get(row["scenario"])
+        if old:
+            print("  ".join(
+                f"{_change(old[key], row[key]):>{width}}" if n else f"{'  vs baseline':<{width}}"
+                for n, (key, _, width) in enumerate(COLUMNS)))
+
+
+def _change(old, new):
+    if not old:
+        return "-"
+    return f"{(new - old) / old * 100:+.0f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="Run only these scenarios (repeatable)")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Fake seconds per request")
+    parser.add_argument("--per-token-latency", type=float, default=0.0002,
+                        help="Fake seconds per answer token")
+    parser.add_argument("--error-rate", type=float, default=0.02,
+                        help="Share of fake requests answered with a rate limit")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--compare", help="Baseline JSON from an earlier --output")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    names = args.scenario or list(SCENARIOS)
+
+    if args.child:
+        result = run_scenario(names[0], args.latency, args.per_token_latency,
+                              args.error_rate, args.seed)
+        print(json.dumps(result))
+        return
+
+    results = []
+    for name in names:
+        print(f"Running {name}...", file=sys.stderr)
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", "--scenario", name,
+             "--latency", str(args.latency), "--per-token-latency", str(args.per_token_latency),
+             "--error-rate", str(args.error_rate), "--seed", str(args.seed)],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True,
+            check=True)
+        results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+    print_report(results, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"settings": {"latency": args.latency,
+                                    "per_token_latency": args.per_token_latency,
+                                    "error_rate": args.error_rate, "seed": args.seed},
+                       "results": results}, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,297 +3,3484 @@ import os
 import re
 import sys
 import argparse
-from tqdm import tqdm  # For progress bar
 from time import sleep
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 
 # ---- 追加インポート（ファイル冒頭付近に） -----------------
-import openai
-import backoff
-import dotenv
+# openai, backoff, dotenv, requests, tqdm and http.server are imported on
+# first use so that `--help`, dry runs and cache-only reruns start quickly.
 import logging
 import time
+import hashlib
+import io
+import functools
+import heapq
+import math
+import tokenize
+import sqlite3
+import random
+from typing import NamedTuple
+import threading
+import contextlib
+import contextvars
+import mmap
+import multiprocessing
 from pathlib import Path
-from dotenv import load_dotenv
-load_dotenv()  # .env があれば自動で環境変数に反映
 # -----------------------------------------------------------
 
-# --- Configure logging  -----------------
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s %(levelname)s %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S"
+
+def configure_logging():
+    """
+    Logging setup of the command line tool.
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S"
+    )
+
+    # 2) このモジュール (__name__) のみ DEBUG
+    logging.getLogger(__name__).setLevel(logging.DEBUG)
+
+    # 3) 外部ライブラリのログは WARNING 以上に引き上げ
+    logging.getLogger("openai").setLevel(logging.WARNING)
+    logging.getLogger("urllib3").setLevel(logging.WARNING)
+    logging.getLogger("http.client").setLevel(logging.WARNING)
+    logging.getLogger("backoff").setLevel(logging.WARNING)
+
+
+_DOTENV_LOADED = False
+
+
+def load_env():
+    """
+    Read .env into the environment once (python-dotenv is imported only here).
+    """
+    global _DOTENV_LOADED
+    if not _DOTENV_LOADED:
+        _DOTENV_LOADED = True
+        from dotenv import load_dotenv
+        load_dotenv()  # .env があれば自動で環境変数に反映
+
+
+# Load prompts
+_PROMPTS_PATH = Path(__file__).parent / "prompts.json"
+_PROMPTS = None
+
+
+def get_prompts():
+    """
+    The contents of prompts.json, read on first use.
+    """
+    global _PROMPTS
+    if _PROMPTS is None:
+        try:
+            with open(_PROMPTS_PATH, encoding="utf-8") as f:
+                _PROMPTS = json.load(f)
+        except Exception as e:
+            logging.error(f"Failed to load prompts from {_PROMPTS_PATH}: {e}")
+            raise
+    return _PROMPTS
+
+
+def _import_openai():
+    global openai
+    import openai
+    return openai
+
+
+def __getattr__(name):
+    # Lazy module attributes (PEP 562): jupyter_translate.PROMPTS and
+    # jupyter_translate.openai keep working without an eager import.
+    if name == "PROMPTS":
+        return get_prompts()
+    if name == "openai":
+        return _import_openai()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+DEFAULT_CACHE_PATH = os.path.join("~", ".cache", "jupyter_translate", "translations.sqlite")
+
+
+class TranslationCache:
+    """
+    Persistent, content-addressed store of finished translations.
+
+    Entries live in a local SQLite file keyed by a hash of everything that
+    influences the model output (text, target language, model, system prompt
+    and temperature).  When the stored values exceed ``max_bytes`` the least
+    recently used entries are evicted.
+    """
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024):
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS translations ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS translations_last_used"
+            " ON translations (last_used)"
+        )
+        self._conn.commit()
+        row = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM translations").fetchone()
+        self._total_bytes = row[0]
+
+    @staticmethod
+    def make_key(text, dest_language, model, system_msg, temperature):
+        payload = json.dumps([text, dest_language, model, system_msg, temperature],
+                             ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM translations WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute(
+                "UPDATE translations SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            self._conn.commit()
+            return row[0]
+
+    def put(self, key, value):
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            old = self._conn.execute(
+                "SELECT size FROM translations WHERE key = ?", (key,)
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO translations (key, value, size, last_used)"
+                " VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time())
+            )
+            self._total_bytes += size - (old[0] if old else 0)
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes:
+            row = self._conn.execute(
+                "SELECT key, size FROM translations ORDER BY last_used LIMIT 1"
+            ).fetchone()
+            if row is None:
+                self._total_bytes = 0
+                return
+            self._conn.execute("DELETE FROM translations WHERE key = ?", (row[0],))
+            self._total_bytes -= row[1]
+            self.evictions += 1
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "bytes": self._total_bytes}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+DEFAULT_MEMORY_PATH = os.path.join("~", ".cache", "jupyter_translate", "memory.sqlite")
+
+
+_MEMORY_ANCHOR_RE = re.compile(r'`[^`\n]*`|\d+(?:[.,]\d+)*|\b\w*(?:_\w*|[a-z][A-Z]\w*)\b')
+
+
+def _memory_anchors(text: str) -> list:
+    """Numbers, identifiers and inline code of text, which a reused translation must share."""
+    return sorted(_MEMORY_ANCHOR_RE.findall(text))
+
+
+_DATA_URI_RE = re.compile(r'data:[\w.+-]+/[\w.+-]+(?:;[\w.+-]+(?:=[\w.+-]*)?)*,[^)\s"\']+')
+_DATA_TOKEN_RE = re.compile(r'data:blake2b-[0-9a-f]{16}')
+
+
+def _strip_data_uris(text: str) -> str:
+    """text with every data: URI (inline images) swapped for a short digest token."""
+    return _DATA_URI_RE.sub(
+        lambda m: "data:blake2b-" + hashlib.blake2b(m.group().encode("utf-8"),
+                                                    digest_size=8).hexdigest(), text)
+
+
+def _restore_data_uris(translation: str, text: str):
+    """
+    translation with the digest tokens of _strip_data_uris() swapped back for
+    the data: URIs of text, or None if one of them does not occur in text.
+    """
+    uris = {_strip_data_uris(uri): uri for uri in _DATA_URI_RE.findall(text)}
+    if any(token not in uris for token in _DATA_TOKEN_RE.findall(translation)):
+        return None
+    return _DATA_TOKEN_RE.sub(lambda m: uris[m.group()], translation)
+
+
+class MemoryMatch(NamedTuple):
+    similarity: float
+    source: str
+    translation: str
+
+
+class TranslationMemory:
+    """
+    Fuzzy index of earlier Markdown translations for near-duplicate cells.
+
+    Sources are compared as sets of character 5-grams.  A MinHash signature
+    split into LSH bands is stored per segment in SQLite, so lookup only
+    scores the few segments that share a band, which stays fast with tens of
+    thousands of entries.  lookup() returns the most similar segment whose
+    Jaccard similarity is at least reference_threshold.
+
+    By default a translation is only taken as is for the same text (after
+    normalize_text()); similar cells get it as a reference.  With a
+    reuse_threshold, near-duplicates are reused too, but never when their
+    numbers, identifiers or inline code differ.
+
+    Inline data: URIs are kept out of the index: segments are stored and
+    compared with each one swapped for a digest token (see _strip_data_uris()),
+    so a base64 image neither slows down hashing nor bloats the database.
+    Matches carry the stripped texts; recall them with restore().
+    """
+
+    SHINGLE = 5
+    BANDS = 16
+    ROWS = 4
+    MAX_CANDIDATES = 20
+    _PRIME = (1 << 61) - 1
+
+    def __init__(self, path, reuse_threshold=None, reference_threshold=0.6):
+        self.path = str(path)
+        self.reuse_threshold = reuse_threshold
+        self.reference_threshold = reference_threshold
+        self.reused = 0
+        self.referenced = 0
+        rng = random.Random(0)
+        self._perms = [(rng.randrange(1, self._PRIME), rng.randrange(self._PRIME))
+                       for _ in range(self.BANDS * self.ROWS)]
+        self._lock = threading.Lock()
+        self._signature = functools.lru_cache(maxsize=256)(self._compute_signature)
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS segments ("
+            " id INTEGER PRIMARY KEY,"
+            " lang TEXT NOT NULL,"
+            " source TEXT NOT NULL,"
+            " translation TEXT NOT NULL,"
+            " UNIQUE (lang, source))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS bands ("
+            " lang TEXT NOT NULL,"
+            " key INTEGER NOT NULL,"
+            " segment INTEGER NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS bands_key ON bands (lang, key)")
+        self._conn.commit()
+
+    def _shingles(self, text):
+        text = normalize_text(text).lower()
+        if len(text) <= self.SHINGLE:
+            return {text}
+        return {text[i:i + self.SHINGLE] for i in range(len(text) - self.SHINGLE + 1)}
+
+    def _compute_signature(self, stripped):
+        shingles = self._shingles(stripped)
+        return shingles, self._band_keys(shingles)
+
+    def _band_keys(self, shingles):
+        hashes = [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(),
+                                 "big") for s in shingles]
+        prime = self._PRIME
+        signature = [min((a * h + b) % prime for h in hashes) for a, b in self._perms]
+        keys = []
+        for band in range(self.BANDS):
+            rows = signature[band * self.ROWS:(band + 1) * self.ROWS]
+            digest = hashlib.blake2b(repr((band, rows)).encode("ascii"), digest_size=8)
+            keys.append(int.from_bytes(digest.digest(), "big", signed=True))
+        return keys
+
+    def lookup(self, dest_language, text):
+        """
+        The closest stored segment as a MemoryMatch, or None below reference_threshold.
+        """
+        shingles, keys = self._signature(_strip_data_uris(text))
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT s.source, s.translation FROM segments s JOIN ("
+                "  SELECT segment, COUNT(*) AS n FROM bands"
+                f"  WHERE lang = ? AND key IN ({','.join('?' * len(keys))})"
+                "  GROUP BY segment ORDER BY n DESC LIMIT ?"
+                ") c ON s.id = c.segment",
+                (dest_language, *keys, self.MAX_CANDIDATES)
+            ).fetchall()
+        best = None
+        for source, translation in rows:
+            other = self._shingles(source)
+            similarity = len(shingles & other) / len(shingles | other)
+            if best is None or similarity > best.similarity:
+                best = MemoryMatch(similarity, source, translation)
+        if best is None or best.similarity < self.reference_threshold:
+            return None
+        return best
+
+    def reusable(self, match, text) -> bool:
+        """
+        True if match's translation can stand for text without a request.
+        """
+        text = _strip_data_uris(text)
+        if normalize_text(match.source) == normalize_text(text):
+            return True
+        return (self.reuse_threshold is not None
+                and match.similarity >= self.reuse_threshold
+                and _memory_anchors(match.source) == _memory_anchors(text))
+
+    @staticmethod
+    def restore(match, text):
+        """
+        match's translation with text's data: URIs put back, or None if it
+        refers to an image text does not have.
+        """
+        return _restore_data_uris(match.translation, text)
+
+    def add(self, dest_language, source, translation):
+        source = _strip_data_uris(source)
+        translation = _strip_data_uris(translation)
+        _, keys = self._signature(source)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id FROM segments WHERE lang = ? AND source = ?", (dest_language, source)
+            ).fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE segments SET translation = ? WHERE id = ?",
+                                   (translation, row[0]))
+            else:
+                cur = self._conn.execute(
+                    "INSERT INTO segments (lang, source, translation) VALUES (?, ?, ?)",
+                    (dest_language, source, translation)
+                )
+                self._conn.executemany(
+                    "INSERT INTO bands (lang, key, segment) VALUES (?, ?, ?)",
+                    [(dest_language, key, cur.lastrowid) for key in keys]
+                )
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM segments").fetchone()[0]
+        return {"segments": size, "reused": self.reused, "referenced": self.referenced}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class UsageCounter:
+    """
+    Thread-safe tally of API requests and tokens made by this process,
+    in total and per target language.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.tokens = 0
+        self._by_language = {}
+
+    def add(self, tokens, language=None):
+        with self._lock:
+            self.requests += 1
+            self.tokens += tokens
+            if language is not None:
+                counts = self._by_language.setdefault(language, [0, 0])
+                counts[0] += 1
+                counts[1] += tokens
+
+    def snapshot(self, language=None):
+        with self._lock:
+            if language is not None:
+                return tuple(self._by_language.get(language, (0, 0)))
+            return self.requests, self.tokens
+
+
+# Model used for every request unless a function is given another one.
+DEFAULT_MODEL = "gpt-4.1-mini"
+
+# USD per million (prompt, completion) tokens, for the cost estimate in run reports.
+MODEL_PRICES = {
+    "gpt-4.1": (2.00, 8.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1-nano": (0.10, 0.40),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+}
+
+# (notebook, cell indices) of the work the current thread is doing.
+_CALL_CONTEXT = contextvars.ContextVar("jupyter_translate_call_context", default=(None, ()))
+
+
+class CallRecord(NamedTuple):
+    """
+    One TranslatorClient.complete() call as seen by CallMetrics.
+    """
+    notebook: str
+    cells: tuple
+    prompt: str
+    model: str
+    cache: str              # "hit", "miss" or "off"
+    queue_wait: float       # seconds spent waiting for the rate limiter
+    latency: float          # seconds of the successful backend request
+    retries: int
+    prompt_tokens: int
+    completion_tokens: int
+    error: str = ""
+    language: str = ""
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    # Nearest-rank method.
+    return ordered[min(len(ordered), max(1, math.ceil(q * len(ordered)))) - 1]
+
+
+def summarize_calls(records, seconds=None):
+    """
+    Aggregate CallRecords (or their dicts): counts, p50/p95 latency, tokens,
+    tokens/sec and cost per model, plus the same broken down by prompt.
+    """
+    records = [r if isinstance(r, CallRecord) else CallRecord(**r) for r in records]
+    sent = [r for r in records if r.cache != "hit" and not r.error]
+    latencies = [r.latency for r in sent]
+    prompt_tokens = sum(r.prompt_tokens for r in sent)
+    completion_tokens = sum(r.completion_tokens for r in sent)
+    busy = seconds if seconds else sum(latencies)
+
+    cost = {}
+    for r in sent:
+        price = MODEL_PRICES.get(r.model)
+        if price is None:
+            cost.setdefault(r.model, None)
+            continue
+        cost[r.model] = (cost.get(r.model) or 0.0) + (r.prompt_tokens * price[0]
+                                                      + r.completion_tokens * price[1]) / 1e6
+
+    summary = {
+        "calls": len(records),
+        "requests": len(sent),
+        "cache_hits": sum(r.cache == "hit" for r in records),
+        "errors": sum(bool(r.error) for r in records),
+        "retries": sum(r.retries for r in records),
+        "queue_wait_seconds": round(sum(r.queue_wait for r in records), 3),
+        "latency_p50": round(_percentile(latencies, 0.5), 3),
+        "latency_p95": round(_percentile(latencies, 0.95), 3),
+        "latency_seconds": round(sum(latencies), 3),
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "tokens_per_second": round((prompt_tokens + completion_tokens) / busy, 1) if busy else 0.0,
+        "cost_usd": {model: round(c, 6) if c is not None else None for model, c in cost.items()},
+    }
+    return summary
+
+
+class CallMetrics:
+    """
+    Thread-safe log of every TranslatorClient.complete() call.
+
+    Each record carries the notebook and cells being translated (set with
+    CallMetrics.context()), the prompts.json entries used, rate limiter
+    wait, request latency, retries, token counts and the cache outcome.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.records = []
+
+    @staticmethod
+    def context(notebook, cells=()):
+        """
+        Attribute calls made by this thread to notebook / cells until reset.
+
+        Returns a token for reset_context().
+        """
+        return _CALL_CONTEXT.set((notebook, tuple(cells)))
+
+    @staticmethod
+    def reset_context(token):
+        _CALL_CONTEXT.reset(token)
+
+    def add(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def mark(self):
+        """
+        Position to pass as start to for_notebook() later.
+        """
+        with self._lock:
+            return len(self.records)
+
+    def for_notebook(self, notebook, start=0, language=None):
+        with self._lock:
+            return [r for r in self.records[start:] if r.notebook == notebook
+                    and (language is None or r.language == language)]
+
+
+def _summary_labels(summaries):
+    """
+    Name each summary by its notebook, plus its language when there are several.
+    """
+    several = len({item.get("language") for item in summaries}) > 1
+    return [f"{item['file']} [{item['language']}]" if several and "language" in item
+            else item["file"] for item in summaries]
+
+
+def build_run_report(summaries, extra_calls=(), seconds=None):
+    """
+    JSON-ready report of a run: totals, per-notebook and per-prompt
+    aggregates, and the cells that took the most time and tokens.
+    """
+    calls = [CallRecord(**c) for s in summaries for c in s.get("calls", [])]
+    calls += list(extra_calls)
+    by_prompt = {}
+    for r in calls:
+        by_prompt.setdefault(r.prompt, []).append(r)
+    by_cell = {}
+    for r in calls:
+        if r.notebook is not None and r.cache != "hit":
+            entry = by_cell.setdefault((r.notebook, r.cells), [0.0, 0])
+            entry[0] += r.latency
+            entry[1] += r.prompt_tokens + r.completion_tokens
+    heaviest = sorted(by_cell.items(), key=lambda item: item[1][0], reverse=True)[:10]
+    return {
+        "total": summarize_calls(calls, seconds),
+        "seconds": round(seconds, 3) if seconds else None,
+        "notebooks": {label: summarize_calls(s.get("calls", []), s.get("seconds"))
+                      for label, s in zip(_summary_labels(summaries), summaries)
+                      if "error" not in s},
+        "prompts": {name: summarize_calls(rs) for name, rs in sorted(by_prompt.items())},
+        "slowest_cells": [{"notebook": nb, "cells": list(cells), "latency_seconds": round(lat, 3),
+                           "tokens": tokens}
+                          for (nb, cells), (lat, tokens) in heaviest],
+    }
+
+
+def format_prometheus(report):
+    """
+    Render build_run_report() output in the Prometheus text exposition format.
+    """
+    def esc(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP jupyter_translate_{name} {help_text}")
+        lines.append(f"# TYPE jupyter_translate_{name} {kind}")
+        for labels, value in samples:
+            label_text = ",".join(f'{k}="{esc(v)}"' for k, v in labels.items())
+            lines.append(f"jupyter_translate_{name}{{{label_text}}} {value}")
+
+    notebooks = report["notebooks"]
+    metric("requests_total", "counter", "API requests sent.",
+           [({"notebook": nb}, s["requests"]) for nb, s in notebooks.items()])
+    metric("cache_hits_total", "counter", "Calls answered from the cache.",
+           [({"notebook": nb}, s["cache_hits"]) for nb, s in notebooks.items()])
+    metric("retries_total", "counter", "Retried API requests.",
+           [({"notebook": nb}, s["retries"]) for nb, s in notebooks.items()])
+    metric("tokens_total", "counter", "Tokens used, by prompt from prompts.json.",
+           [({"prompt": p, "kind": kind}, s[f"{kind}_tokens"])
+            for p, s in report["prompts"].items() for kind in ("prompt", "completion")])
+    metric("queue_wait_seconds_total", "counter", "Time spent waiting for the rate limiter.",
+           [({"notebook": nb}, s["queue_wait_seconds"]) for nb, s in notebooks.items()])
+    total = report["total"]
+    metric("request_latency_seconds", "summary", "Latency of successful API requests.",
+           [({"quantile": "0.5"}, total["latency_p50"]),
+            ({"quantile": "0.95"}, total["latency_p95"])])
+    lines.append(f"jupyter_translate_request_latency_seconds_sum {total['latency_seconds']}")
+    lines.append(f"jupyter_translate_request_latency_seconds_count {total['requests']}")
+    metric("cost_usd", "gauge", "Estimated API cost by model.",
+           [({"model": m}, c) for m, c in total["cost_usd"].items() if c is not None])
+    return "\n".join(lines) + "\n"
+
+
+class RateLimiter:
+    """
+    Token-bucket limiter for requests per minute (rpm) and tokens per minute (tpm).
+
+    Both buckets refill continuously and hold at most BURST_SECONDS worth of
+    budget, so requests from many workers are spread evenly instead of
+    arriving in bursts.  The state lives in shared memory: one instance handed
+    to the worker processes of a directory run limits all of them together.
+    A rate limit answer from the API pauses every worker until its
+    Retry-After hint (or retry_delay seconds) has passed.  A limit of 0
+    disables that bucket.
+    """
+
+    BURST_SECONDS = 5.0
+
+    def __init__(self, rpm=0, tpm=0, retry_delay=10):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.retry_delay = retry_delay
+        self._req_capacity = max(1.0, rpm * self.BURST_SECONDS / 60.0)
+        self._tok_capacity = max(1.0, tpm * self.BURST_SECONDS / 60.0)
+        # request level, token level, last refill, paused until
+        self._state = multiprocessing.Array(
+            'd', [self._req_capacity, self._tok_capacity, time.time(), 0.0])
+
+    def _refill(self, now):
+        state = self._state
+        elapsed = max(0.0, now - state[2])
+        state[0] = min(self._req_capacity, state[0] + elapsed * self.rpm / 60.0)
+        state[1] = min(self._tok_capacity, state[1] + elapsed * self.tpm / 60.0)
+        state[2] = now
+
+    def acquire(self, tokens=0):
+        """
+        Block until one request of about `tokens` tokens may be sent.
+        """
+        while True:
+            with self._state.get_lock():
+                now = time.time()
+                self._refill(now)
+                state = self._state
+                wait = state[3] - now
+                if wait <= 0:
+                    waits = [0.0]
+                    if self.rpm and state[0] < 1:
+                        waits.append((1 - state[0]) * 60.0 / self.rpm)
+                    # A request larger than the bucket only waits for a full bucket
+                    # and then runs the level negative.
+                    needed = min(tokens, self._tok_capacity)
+                    if self.tpm and state[1] < needed:
+                        waits.append((needed - state[1]) * 60.0 / self.tpm)
+                    wait = max(waits)
+                    if wait <= 0:
+                        if self.rpm:
+                            state[0] -= 1
+                        if self.tpm:
+                            state[1] -= tokens
+                        return
+            time.sleep(wait)
+
+    def settle(self, estimated, actual):
+        """
+        Correct the token bucket once the real usage of a request is known.
+        """
+        if not self.tpm or not actual:
+            return
+        with self._state.get_lock():
+            self._state[1] = min(self._tok_capacity, self._state[1] + estimated - actual)
+
+    def pause(self, seconds=None):
+        """
+        Stop all workers for `seconds` (default retry_delay) after a rate limit answer.
+        """
+        if seconds is None:
+            seconds = self.retry_delay
+        with self._state.get_lock():
+            self._state[3] = max(self._state[3], time.time() + seconds)
+
+
+def _retry_after(error):
+    """
+    Seconds to wait according to the Retry-After headers of an API error.
+    """
+    headers = getattr(error, "headers", None) or {}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000.0
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+RATE_LIMIT_RETRIES = 8
+
+
+class BackendError(Exception):
+    """
+    A translation request failed in the backend.
+    """
+
+
+class TransientBackendError(BackendError):
+    """
+    A failure worth retrying (server error, timeout, dropped connection).
+    """
+
+
+class RateLimitedError(BackendError):
+    """
+    The backend asked us to slow down, optionally saying for how long.
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Completion(NamedTuple):
+    text: str
+    tokens: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+class TranslationBackend:
+    """
+    Interface every translation service implements.
+
+    complete() turns one request into a Completion and raises BackendError
+    subclasses on failure.  Backends that cannot follow system prompts set
+    supports_prompts = False; batching and packing are then skipped and
+    every text is sent on its own.
+    """
+
+    name = "base"
+    supports_prompts = True
+    # Added to cache keys so different services never share entries.
+    cache_tag = ""
+
+    def complete(self, system_msg, content, dest_language, model, temperature) -> Completion:
+        raise NotImplementedError
+
+    def worker_config(self):
+        """
+        Keyword arguments for make_backend() that rebuild this backend in a worker process.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class OpenAIBackend(TranslationBackend):
+    """
+    OpenAI chat completions (or any OpenAI-compatible server via api_base).
+
+    Holds one keep-alive requests.Session for all threads of the process,
+    created (and openai imported) on the first complete(), so runs that
+    send nothing never load the client libraries.  With stream=True answers
+    are read incrementally as server-sent events, so timeout applies between
+    chunks rather than to the whole answer.
+    """
+
+    name = "openai"
+
+    def __init__(self, api_key=None, api_base=None, timeout=120, pool_size=16, stream=False,
+                 cache_tag=None):
+        self._api_key = api_key
+        self.api_base = api_base
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.stream = stream
+        self.cache_tag = (api_base or "") if cache_tag is None else cache_tag
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    def _open_session(self):
+        if self._session is not None:
+            return
+        with self._session_lock:
+            if self._session is None:
+                import requests
+                openai = _import_openai()
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size,
+                                                        pool_maxsize=self.pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                openai.requestssession = session
+                self._session = session
+
+    @property
+    def api_key(self):
+        if self._api_key:
+            return self._api_key
+        load_env()
+        return os.getenv("OPENAI_API_KEY")
+
+    def complete(self, system_msg, content, dest_language, model, temperature) -> Completion:
+        self._open_session()
+        import requests
+        openai = _import_openai()
+        if not self.api_key:
+            raise RuntimeError("OPENAI_API_KEY environment variable not set")
+        messages = [
+            {"role": "system", "content": system_msg},
+            {"role": "user",   "content": f"Translate into {dest_language}:\n\n{content}"}
+        ]
+        extra = {"api_base": self.api_base} if self.api_base else {}
+        try:
+            resp = openai.ChatCompletion.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                api_key=self.api_key,
+                request_timeout=self.timeout,
+                stream=self.stream,
+                **extra
+            )
+            if self.stream:
+                text = "".join(chunk.choices[0].delta.get("content") or ""
+                               for chunk in resp if chunk.choices)
+        except openai.error.RateLimitError as e:
+            raise RateLimitedError(str(e), retry_after=_retry_after(e)) from e
+        except (openai.error.APIError, openai.error.Timeout,
+                openai.error.APIConnectionError, openai.error.ServiceUnavailableError,
+                requests.exceptions.RequestException) as e:
+            raise TransientBackendError(str(e)) from e
+        except openai.error.OpenAIError as e:
+            raise BackendError(str(e)) from e
+        if self.stream:
+            # Streamed answers carry no usage block; estimate it instead.
+            prompt_tokens = sum(estimate_tokens(m["content"]) for m in messages)
+            completion_tokens = estimate_tokens(text)
+            return Completion(text.strip(), prompt_tokens + completion_tokens,
+                              prompt_tokens, completion_tokens)
+        usage = getattr(resp, "usage", None)
+        tokens = int(getattr(usage, "total_tokens", 0) or 0)
+        prompt_tokens = int(getattr(usage, "prompt_tokens", 0) or 0)
+        completion_tokens = int(getattr(usage, "completion_tokens", 0) or 0)
+        return Completion(resp.choices[0].message.content.strip(), tokens,
+                          prompt_tokens, completion_tokens)
+
+    def worker_config(self):
+        return dict(backend=self.name, api_key=self._api_key, api_base=self.api_base,
+                    timeout=self.timeout, pool_size=self.pool_size, stream=self.stream,
+                    cache_tag=self.cache_tag)
+
+    def close(self):
+        if self._session is None:
+            return
+        openai = _import_openai()
+        if openai.requestssession is self._session:
+            openai.requestssession = None
+        self._session.close()
+
+
+class GoogleTransBackend(TranslationBackend):
+    """
+    Free Google Translate through googletrans, as used by legacy/jupyter_translate.py.
+
+    Ignores system prompts and model; needs `pip install googletrans==3.1.0a0`.
+    """
+
+    name = "google"
+    supports_prompts = False
+    cache_tag = "googletrans"
+
+    def __init__(self):
+        try:
+            from googletrans import Translator
+        except ImportError as e:
+            raise RuntimeError("The google backend needs the googletrans package") from e
+        self._translator = Translator()
+        self._lock = threading.Lock()
+
+    def complete(self, system_msg, content, dest_language, model, temperature) -> Completion:
+        try:
+            with self._lock:  # googletrans.Translator is not thread-safe
+                text = self._translator.translate(content, dest=dest_language).text
+        except Exception as e:
+            raise TransientBackendError(str(e)) from e
+        return Completion(text, 0)
+
+    def worker_config(self):
+        return dict(backend=self.name)
+
+
+class FakeBackend(TranslationBackend):
+    """
+    In-process echo backend for tests and benchmarks.
+
+    Returns the text unchanged after sleeping latency + per_token_latency
+    per answer token, and reports estimated prompt plus answer tokens.  With
+    error_rate > 0 that share of requests is answered with a rate limit
+    (retry_after seconds).  Which attempts fail depends only on seed, the
+    text and how often it was sent before, so runs are reproducible even
+    with many threads.
+    """
+
+    name = "fake"
+    cache_tag = "fake"
+
+    def __init__(self, latency=0.0, per_token_latency=0.0, error_rate=0.0, retry_after=0.01,
+                 seed=0):
+        self.latency = latency
+        self.per_token_latency = per_token_latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.seed = seed
+        self._attempts = {}
+        self._lock = threading.Lock()
+
+    def _fails(self, content):
+        if self.error_rate <= 0:
+            return False
+        with self._lock:
+            attempt = self._attempts.get(content, 0)
+            self._attempts[content] = attempt + 1
+        digest = hashlib.blake2b(f"{self.seed}:{attempt}:{content}".encode("utf-8"),
+                                 digest_size=8).digest()
+        return int.from_bytes(digest, "big") / 2 ** 64 < self.error_rate
+
+    def complete(self, system_msg, content, dest_language, model, temperature) -> Completion:
+        if self._fails(content):
+            raise RateLimitedError("fake rate limit", retry_after=self.retry_after)
+        answer_tokens = estimate_tokens(content)
+        time.sleep(self.latency + self.per_token_latency * answer_tokens)
+        prompt_tokens = estimate_tokens(system_msg) + estimate_tokens(content)
+        return Completion(content, prompt_tokens + answer_tokens, prompt_tokens, answer_tokens)
+
+    def worker_config(self):
+        return dict(backend=self.name, latency=self.latency,
+                    per_token_latency=self.per_token_latency, error_rate=self.error_rate,
+                    retry_after=self.retry_after, seed=self.seed)
+
+
+class StubServer:
+    """
+    Local OpenAI-compatible chat completions server for offline runs.
+
+    Answers POST .../chat/completions by echoing the text after the
+    "Translate into ...:" line, after sleeping latency + per_token_latency
+    per completion token.  Requests with "stream": true are answered as
+    server-sent events, one chunk per line of the text.  With error_rate > 0
+    that share of requests fails
+    with a 429 (carrying a Retry-After header) or a 500, drawn from a
+    random.Random(seed) so runs are reproducible.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, per_token_latency=0.0,
+                 error_rate=0.0, retry_after=1, seed=0):
+        self.latency = latency
+        self.per_token_latency = per_token_latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        from http.server import ThreadingHTTPServer
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _draw_error(self):
+        with self._lock:
+            self.requests += 1
+            if self.error_rate <= 0 or self._random.random() >= self.error_rate:
+                return None
+            return 429 if self._random.random() < 0.5 else 500
+
+    def answer(self, body):
+        """
+        Build the completion payload for a decoded request body.
+        """
+        messages = body.get("messages", [])
+        prompt = "\n".join(m.get("content", "") for m in messages)
+        user = messages[-1].get("content", "") if messages else ""
+        text = user.split("\n\n", 1)[1] if user.startswith("Translate into ") else user
+        prompt_tokens = estimate_tokens(prompt)
+        completion_tokens = estimate_tokens(text)
+        return {
+            "id": f"stub-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "stub"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": text}}],
+            "usage": {"prompt_tokens": prompt_tokens,
+                      "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+    def _make_handler(self):
+        from http.server import BaseHTTPRequestHandler
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, payload, headers=()):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self._send(404, {"error": {"message": "not found"}})
+                    return
+                status = stub._draw_error()
+                if status == 429:
+                    self._send(429, {"error": {"message": "stub rate limit",
+                                               "type": "rate_limit_error"}},
+                               headers=[("Retry-After", str(stub.retry_after))])
+                    return
+                if status == 500:
+                    self._send(500, {"error": {"message": "stub server error",
+                                               "type": "server_error"}})
+                    return
+                payload = stub.answer(body)
+                if body.get("stream"):
+                    self._stream(payload)
+                    return
+                usage = payload["usage"]
+                time.sleep(stub.latency + stub.per_token_latency * usage["completion_tokens"])
+                self._send(200, payload)
+
+            def _stream(self, payload):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                time.sleep(stub.latency)
+                text = payload["choices"][0]["message"]["content"]
+                for piece in text.splitlines(True) + [None]:
+                    delta = {"content": piece} if piece is not None else {}
+                    chunk = {"id": payload["id"], "object": "chat.completion.chunk",
+                             "created": payload["created"], "model": payload["model"],
+                             "choices": [{"index": 0, "delta": delta,
+                                          "finish_reason": None if piece is not None
+                                          else "stop"}]}
+                    if piece:
+                        time.sleep(stub.per_token_latency * estimate_tokens(piece))
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+
+        return Handler
+
+
+BACKENDS = ("openai", "google", "stub", "fake")
+
+
+def make_backend(backend="openai", **options):
+    """
+    Build a TranslationBackend by name.
+
+    "stub" starts a StubServer (latency, per_token_latency, error_rate, seed
+    go to the server) and returns an OpenAIBackend pointed at it; the server
+    is kept on the backend as .stub_server and its cache_tag is "stub".
+    "fake" is the in-process FakeBackend.
+    """
+    if backend == "openai":
+        return OpenAIBackend(**options)
+    if backend == "google":
+        return GoogleTransBackend()
+    if backend == "fake":
+        return FakeBackend(**options)
+    if backend == "stub":
+        stub_keys = ("latency", "per_token_latency", "error_rate", "seed")
+        server = StubServer(**{k: options.pop(k) for k in stub_keys if k in options}).start()
+        options.setdefault("api_key", "stub")
+        # The same cache_tag for every run, whatever port the server gets.
+        result = OpenAIBackend(api_base=server.url, cache_tag="stub", **options)
+        result.stub_server = server
+        return result
+    raise ValueError(f"Unknown backend {backend!r}; choose from {', '.join(BACKENDS)}")
+
+
+class TranslatorClient:
+    """
+    Everything the API requests of one run share.
+
+    Create one per run and pass it to jupyter_translate() and friends: it
+    holds the TranslationBackend (by default OpenAIBackend with its
+    keep-alive connection pool), the system prompts from prompts.json joined
+    once, the optional TranslationCache, the RateLimiter and the usage
+    counters.  The phrasebook holds strings translated ahead of time for
+    a whole directory (see translate_directory()); the optional
+    TranslationMemory supplies translations of similar Markdown cells.
+    """
+
+    def __init__(self, backend=None, cache=None, limiter=None, phrasebook=None,
+                 memory=None):
+        self.backend = backend if backend is not None else OpenAIBackend()
+        self.cache = cache
+        self.memory = memory
+        self.limiter = limiter if limiter is not None else RateLimiter()
+        self.usage = UsageCounter()
+        self.metrics = CallMetrics()
+        self.phrasebook = phrasebook if phrasebook is not None else {}
+        self._prompts = {name: "\n".join(lines) for name, lines in get_prompts().items()}
+        self._prompt_labels = {text: name for name, text in self._prompts.items()}
+
+    @property
+    def supports_prompts(self):
+        return self.backend.supports_prompts
+
+    def worker_config(self):
+        """
+        Arguments to rebuild an equivalent client inside a worker process.
+        """
+        cache_config = (self.cache.path, self.cache.max_bytes) if self.cache else None
+        memory_config = None
+        if self.memory is not None:
+            memory_config = (self.memory.path, self.memory.reuse_threshold,
+                             self.memory.reference_threshold)
+        return dict(backend_config=self.backend.worker_config(), limiter=self.limiter,
+                    cache_config=cache_config, phrasebook=self.phrasebook,
+                    memory_config=memory_config)
+
+    @classmethod
+    def from_worker_config(cls, backend_config, limiter, cache_config=None, phrasebook=None,
+                           memory_config=None):
+        cache = TranslationCache(*cache_config) if cache_config else None
+        memory = TranslationMemory(*memory_config) if memory_config else None
+        return cls(backend=make_backend(**backend_config), cache=cache, limiter=limiter,
+                   phrasebook=phrasebook, memory=memory)
+
+    def remember(self, kind, dest_language, text, translation):
+        """
+        Add a translation of a "code" fragment or "markdown" cell to the phrasebook.
+        """
+        self.phrasebook[(kind, dest_language, normalize_text(text))] = translation.strip()
+
+    def recall(self, kind, dest_language, text):
+        """
+        Known translation of text, or None.
+
+        Looks in the phrasebook (compared after normalize_text()) and, for
+        Markdown, in the translation memory (see TranslationMemory.reusable()).
+        """
+        known = None
+        if self.phrasebook:
+            known = self.phrasebook.get((kind, dest_language, normalize_text(text)))
+        if known is None and kind == "markdown" and self.memory is not None:
+            match = self.memory.lookup(self.memory_language(dest_language), text)
+            if match is not None and self.memory.reusable(match, text):
+                known = self.memory.restore(match, text)
+                if known is not None:
+                    self.memory.reused += 1
+        return known
+
+    def learn(self, dest_language, source, translation):
+        """
+        Store a Markdown translation in the memory if it passes validation.
+        """
+        if self.memory is not None and not validate_markdown_translation(source, translation):
+            self.memory.add(self.memory_language(dest_language), source.strip(),
+                            translation.strip())
+
+    def memory_language(self, dest_language):
+        """
+        Language key for the translation memory; like cache keys it includes
+        the backend's cache_tag, so e.g. echoed stub answers are never reused.
+        """
+        tag = self.backend.cache_tag
+        return f"{tag}:{dest_language}" if tag else dest_language
+
+    def system_prompt(self, *names):
+        """
+        The named prompts from prompts.json, joined by blank lines.
+        """
+        key = "\n\n".join(names)
+        if key not in self._prompts:
+            for name in names:
+                if not self._prompts.get(name):
+                    logging.error(f"Missing '{name}' in prompts.json")
+                    raise RuntimeError(f"'{name}' not found in prompts.json")
+            self._prompts[key] = "\n\n".join(self._prompts[name] for name in names)
+            self._prompt_labels[self._prompts[key]] = "+".join(names)
+        return self._prompts[key]
+
+    def _prompt_label(self, system_msg):
+        label = self._prompt_labels.get(system_msg)
+        if label is None:
+            # Retry feedback or references appended to a known prompt.
+            matches = [text for text in self._prompt_labels if system_msg.startswith(text)]
+            label = self._prompt_labels[max(matches, key=len)] if matches else "other"
+        return label
+
+    def complete(self, content, system_msg, dest_language, model, temperature) -> str:
+        """
+        Translate content through the backend, consulting the cache first.
+        """
+        backend = self.backend
+        notebook, cells = _CALL_CONTEXT.get()
+        stats = {"queue_wait": 0.0, "latency": 0.0, "retries": 0}
+
+        def _record(cache, completion=None, error=""):
+            self.metrics.add(CallRecord(
+                notebook, cells, self._prompt_label(system_msg), model, cache,
+                stats["queue_wait"], stats["latency"], stats["retries"],
+                completion.prompt_tokens if completion else 0,
+                completion.completion_tokens if completion else 0, error, dest_language))
+
+        key = None
+        if self.cache is not None:
+            cache_model = f"{backend.cache_tag}:{model}" if backend.cache_tag else model
+            key = TranslationCache.make_key(content, dest_language, cache_model, system_msg,
+                                            temperature)
+            hit = self.cache.get(key)
+            if hit is not None:
+                _record("hit")
+                return hit
+
+        limiter = self.limiter
+        # Prompt plus an answer of about the same length as the text.
+        estimated = estimate_tokens(system_msg) + 2 * estimate_tokens(content)
+
+        import backoff
+
+        def _count_retry(details):
+            stats["retries"] += 1
+
+        @backoff.on_exception(backoff.expo, TransientBackendError, max_tries=3,
+                              on_backoff=_count_retry)
+        def _call():
+            for attempt in range(RATE_LIMIT_RETRIES):
+                waited = time.perf_counter()
+                limiter.acquire(estimated)
+                started = time.perf_counter()
+                stats["queue_wait"] += started - waited
+                try:
+                    completion = backend.complete(system_msg, content, dest_language, model,
+                                                  temperature)
+                except RateLimitedError as e:
+                    if attempt == RATE_LIMIT_RETRIES - 1:
+                        raise
+                    stats["retries"] += 1
+                    logging.debug(f"Rate limited, pausing for "
+                                  f"{e.retry_after or limiter.retry_delay}s")
+                    limiter.pause(e.retry_after)
+                    continue
+                stats["latency"] = time.perf_counter() - started
+                return completion
+
+        try:
+            completion = _call()
+        except BackendError as e:
+            _record("miss" if key else "off", error=str(e) or type(e).__name__)
+            raise
+        if not completion.prompt_tokens and not completion.completion_tokens:
+            completion = completion._replace(
+                prompt_tokens=estimate_tokens(system_msg) + estimate_tokens(content),
+                completion_tokens=estimate_tokens(completion.text))
+        _record("miss" if key else "off", completion)
+        limiter.settle(estimated, completion.tokens)
+        self.usage.add(completion.tokens, dest_language)
+        if self.cache is not None:
+            self.cache.put(key, completion.text)
+        return completion.text
+
+    def close(self):
+        self.backend.close()
+        server = getattr(self.backend, "stub_server", None)
+        if server is not None:
+            server.stop()
+        if self.cache is not None:
+            self.cache.close()
+        if self.memory is not None:
+            self.memory.close()
+
+
+_FENCE_LINE_RE = re.compile(r'^[ \t]*(`{3,}|~{3,})')
+
+
+def normalize_text(text: str) -> str:
+    """
+    Key for deduplication: blank lines at either end and trailing spaces
+    dropped, inner runs of spaces and tabs collapsed.  Indentation and line
+    breaks are kept, as is everything inside code fences, so a nested list
+    or an indented code block never shares a key with its flat version.
+    """
+    lines = []
+    fence = None
+    for line in text.strip("\r\n").splitlines():
+        line = line.rstrip()
+        opener = _FENCE_LINE_RE.match(line)
+        if fence is None:
+            if opener:
+                fence = opener.group(1)[0]
+            indent = line[:len(line) - len(line.lstrip())]
+            line = indent + " ".join(line.split())
+        elif opener and opener.group(1)[0] == fence:
+            fence = None
+        lines.append(line)
+    return "\n".join(lines).strip("\n")
+
+
+_DEFAULT_CLIENT = None
+_DEFAULT_CLIENT_LOCK = threading.Lock()
+
+
+def get_default_client():
+    """
+    Client used when a function is called without one (no cache, no limits).
+    """
+    global _DEFAULT_CLIENT
+    with _DEFAULT_CLIENT_LOCK:
+        if _DEFAULT_CLIENT is None:
+            _DEFAULT_CLIENT = TranslatorClient()
+        return _DEFAULT_CLIENT
+
+
+def _request_completion(content: str,
+                        system_msg: str,
+                        dest_language: str,
+                        model: str,
+                        temperature: float,
+                        client=None) -> str:
+    client = client or get_default_client()
+    return client.complete(content, system_msg, dest_language, model, temperature)
+
+
+# Helper: translate code comments / print strings via OpenAI API
+def translate_code_text(text: str,
+                        dest_language: str,
+                        model: str = DEFAULT_MODEL,
+                        client=None) -> str:
+    """
+    Uses ChatGPT to translate a single comment or string literal into dest_language.
+    """
+    client = client or get_default_client()
+    system_msg = client.system_prompt("code_translation_system_prompt_lines")
+    return _request_completion(text, system_msg, dest_language, model,
+                               temperature=0.7, client=client)
+
+
+IMAGE_ONLY_PATTERN = re.compile(
+    r'^(?:!\[[^\]]*\]\((?:data:image/[^)]+|attachment:[^)]+)\)\s*)+$'
+)
+PACK_DELIMITER = "<<<CELL {}>>>"
+_PACK_SPLIT_RE = re.compile(r'^<<<CELL (\d+)>>>[ \t]*\n?', re.MULTILINE)
+
+
+PLACEHOLDER = "@@P{}@@"
+_PLACEHOLDER_RE = re.compile(r'@@\s*P(\d+)\s*@@')
+# Order matters: fences and display math first so their contents are not
+# matched again by the inline patterns below.
+_MASK_PATTERNS = [
+    re.compile(r'^[ \t]*(`{3,}|~{3,})[^\n]*\n[\s\S]*?^[ \t]*\1[ \t]*$', re.MULTILINE),  # fenced code
+    re.compile(r'\$\$[\s\S]+?\$\$'),                                  # display math
+    re.compile(r'\\\[[\s\S]+?\\\]|\\begin\{(\w+\*?)\}[\s\S]+?\\end\{\1\}'),  # \[..\], environments
+    re.compile(r'!\[[^\]\n]*\]\(data:[^)]+\)'),                        # inline base64 images
+    re.compile(r'(?<![\\$])\$(?![\s$])[^$\n]+?(?<![\s\\])\$(?!\d)'),   # inline math
+    re.compile(r'`[^`\n]+`'),                                          # inline code
+    re.compile(r'<!--[\s\S]*?-->|</?[A-Za-z][^<>\n]*>'),              # HTML tags and comments
+    re.compile(r'(?<=\]\()[^)\s]+(?=[^)]*\))'),                        # link / image targets
+    re.compile(r'https?://[^\s<>()\[\]"\']*[^\s<>()\[\]"\'.,;:!?]'),  # bare URLs
+]
+
+
+def mask_markdown(text: str):
+    """
+    Replace spans that must survive translation verbatim with placeholders.
+
+    Covers fenced code, display and inline math, inline code, data-URI
+    images, link targets, bare URLs and HTML tags.  Returns the masked text
+    and the list of original spans; placeholder n stands for spans[n].
+    """
+    spans = []
+
+    def _sub(match):
+        spans.append(match.group(0))
+        return PLACEHOLDER.format(len(spans) - 1)
+
+    for pattern in _MASK_PATTERNS:
+        text = pattern.sub(_sub, text)
+    return text, spans
+
+
+def unmask_markdown(text: str, spans):
+    """
+    Put the original spans back, or return None if the model dropped,
+    duplicated or invented a placeholder.
+    """
+    nested = {int(n) for span in spans for n in _PLACEHOLDER_RE.findall(span)}
+    found = [int(n) for n in _PLACEHOLDER_RE.findall(text)]
+    if sorted(found) != [n for n in range(len(spans)) if n not in nested]:
+        return None
+
+    def _restore(match):
+        return spans[int(match.group(1))]
+
+    # A span can itself contain placeholders masked by an earlier pattern,
+    # so restore until none are left.
+    for _ in range(len(spans) + 1):
+        if not _PLACEHOLDER_RE.search(text):
+            break
+        text = _PLACEHOLDER_RE.sub(_restore, text)
+    return text
+
+
+def _has_translatable_text(masked: str) -> bool:
+    return bool(re.search(r'\w', _PLACEHOLDER_RE.sub('', masked)))
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough token count: ~4 ASCII characters per token, one per other character.
+    """
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return ascii_chars // 4 + (len(text) - ascii_chars) + 1
+
+
+# Blocks a chunk boundary must not fall into: fences, $$ math, \[..\] and environments.
+_UNSPLITTABLE_PATTERNS = _MASK_PATTERNS[:3]
+# A blank line, or the line break before a heading.
+_CHUNK_BOUNDARY_RE = re.compile(r'\n[ \t]*\n\s*|\n(?=[ \t]{0,3}#{1,6}\s)')
+
+
+def split_markdown(text: str, max_tokens: int) -> list:
+    """
+    Split a long Markdown cell into chunks of about max_tokens or less.
+
+    Chunks end at blank lines or before headings, never inside code fences,
+    $$ math or LaTeX environments.  Sizes are estimated on the masked text,
+    so embedded images do not count.  A block larger than max_tokens becomes
+    a chunk of its own.  ''.join() of the chunks gives back text.
+    """
+    def _size(piece):
+        return estimate_tokens(mask_markdown(piece)[0])
+
+    if max_tokens <= 0 or _size(text) <= max_tokens:
+        return [text]
+    blocked = [m.span() for pattern in _UNSPLITTABLE_PATTERNS for m in pattern.finditer(text)]
+    cuts = [m.end() for m in _CHUNK_BOUNDARY_RE.finditer(text)
+            if not any(start < m.end() < end for start, end in blocked)]
+    chunks, size = [], 0
+    for start, end in zip([0] + cuts, cuts + [len(text)]):
+        piece = text[start:end]
+        piece_size = _size(piece)
+        if chunks and size + piece_size <= max_tokens:
+            chunks[-1] += piece
+            size += piece_size
+        else:
+            chunks.append(piece)
+            size = piece_size
+    return [chunk for chunk in chunks if chunk]
+
+
+# Letters of each script; CJK and Thai count per character, the others per word.
+_SCRIPT_PATTERNS = {
+    "kana": re.compile(r'[\u3040-\u30ff\u31f0-\u31ff\uff66-\uff9f]'),
+    "han": re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]'),
+    "hangul": re.compile(r'[\u1100-\u11ff\u3130-\u318f\uac00-\ud7af]+'),
+    "thai": re.compile(r'[\u0e00-\u0e7f]'),
+    "cyrillic": re.compile(r'[\u0400-\u04ff]+'),
+    "greek": re.compile(r'[\u0370-\u03ff]+'),
+    "arabic": re.compile(r'[\u0600-\u06ff]+'),
+    "hebrew": re.compile(r'[\u0590-\u05ff]+'),
+    "devanagari": re.compile(r'[\u0900-\u097f]+'),
+    "latin": re.compile(r"[A-Za-z\u00c0-\u024f]+(?:'[A-Za-z]+)?"),
+}
+_SCRIPT_LANGUAGES = {"hangul": "ko", "thai": "th", "cyrillic": "ru", "greek": "el",
+                     "arabic": "ar", "hebrew": "he", "devanagari": "hi"}
+# Frequent words (of two letters or more) that tell Latin-script languages apart.
+_FUNCTION_WORDS = {
+    "en": set("the an and or of to in is are was were be been it its this that these "
+              "those with for on as at by from you your we our he she they them me my "
+              "not do does don't can will would have has had if so but all any what which "
+              "there here let's it's how when then".split()),
+    "es": set("el la los las un una unos de del que en es son está por para con no "
+              "se su sus lo como más pero este esta al muy también hay ya cuando sí "
+              "porque sobre entre".split()),
+    "fr": set("le la les un une des et ou de du que qui en est sont pour avec pas ne se "
+              "sur dans ce cette il elle nous vous je au aux mais plus comme très".split()),
+    "de": set("der die das den dem des ein eine einen und oder ist sind nicht mit für auf "
+              "zu von im es sie wir ich du auch dass wie aber sich noch wird werden".split()),
+    "pt": set("os as um uma ou do da dos das que em no na são para com não se por "
+              "mais mas como ao você isso este esta".split()),
+    "it": set("il lo gli le un una di del della che sono per con non si su da come "
+              "ma anche questo questa nel alla".split()),
+}
+LANGUAGE_MIN_UNITS = 5
+
+
+def detect_language(text: str):
+    """
+    Guess the language of Markdown text from its scripts and function words.
+
+    Code, math, URLs and HTML are masked first.  Text that is mostly kana
+    and kanji is "ja" (without kana "zh"); Hangul, Cyrillic, Greek, Arabic,
+    Hebrew, Thai and Devanagari map to one language each; Latin text is
+    the language of _FUNCTION_WORDS with clearly the most hits.  Returns
+    None for short, mixed or otherwise undecided text.
+    """
+    masked = _PLACEHOLDER_RE.sub(' ', mask_markdown(text)[0])
+    counts = {script: len(pattern.findall(masked))
+              for script, pattern in _SCRIPT_PATTERNS.items()}
+    total = sum(counts.values())
+    if total < LANGUAGE_MIN_UNITS:
+        return None
+    if (counts["kana"] + counts["han"]) * 2 >= total:
+        return "ja" if counts["kana"] else "zh"
+    script = max(counts, key=counts.get)
+    if counts[script] < 0.8 * total:
+        return None
+    if script != "latin":
+        return _SCRIPT_LANGUAGES.get(script)
+
+    # Single letters are as often quoted characters or variables as words.
+    words = [w.lower() for w in _SCRIPT_PATTERNS["latin"].findall(masked) if len(w) > 1]
+    hits = sorted(((sum(w in vocabulary for w in words), lang)
+                   for lang, vocabulary in _FUNCTION_WORDS.items()), reverse=True)
+    (best, lang), (runner_up, _) = hits[0], hits[1]
+    if best >= 2 and best >= 0.15 * len(words) and best > 1.5 * runner_up:
+        return lang
+    return None
+
+
+def _markdown_needs_translation(text: str) -> bool:
+    if not text.strip():
+        return False
+    if IMAGE_ONLY_PATTERN.match(text.strip()):
+        return False
+    return True
+
+
+def translate_markdown(text: str,
+                       *_,
+                       delay: int,
+                       dest_language: str,
+                       model: str = DEFAULT_MODEL,
+                       client=None,
+                       problems=None,
+                       mask=True,
+                       chunk_tokens=0,
+                       workers=1
+                      ) -> str:
+    """
+    Translate one Markdown cell with ChatGPT.
+
+    With a translation memory on the client, a close enough earlier cell is
+    reused outright, and a merely similar one is sent along as a reference.
+
+    Code, math, URLs and HTML are swapped for placeholders before the request
+    (see mask_markdown()) and restored afterwards; if the model mangles the
+    placeholders the cell is sent again without masking.
+
+    problems lists defects found in an earlier attempt (see
+    validate_markdown_translation()); they are appended to the system prompt
+    so the model can avoid them this time.
+
+    With chunk_tokens > 0 a longer cell is cut by split_markdown() and its
+    chunks are translated as cells of their own, up to workers at a time.
+    """
+    if not _markdown_needs_translation(text):
+        return text
+
+    client = client or get_default_client()
+    known = None if problems else client.recall("markdown", dest_language, text)
+    if known is not None:
+        return known + "\n" if text.endswith("\n") else known
+    chunks = split_markdown(text, chunk_tokens) if mask else [text]
+    if len(chunks) > 1:
+        translated = _translate_markdown_chunks(chunks, delay=delay,
+                                                dest_language=dest_language, model=model,
+                                                client=client, problems=problems,
+                                                workers=workers)
+        client.learn(dest_language, text, translated)
+        return translated
+    masked, spans = mask_markdown(text) if mask else (text, [])
+    if not _has_translatable_text(masked):
+        return text
+    reference = None
+    if client.memory is not None and not problems:
+        reference = client.memory.lookup(client.memory_language(dest_language), text)
+
+    prompt_names = ["translation_system_prompt_lines"]
+    if spans:
+        prompt_names.append("placeholder_instruction_lines")
+    if problems:
+        prompt_names.append("validation_retry_instruction_lines")
+    if reference is not None:
+        prompt_names.append("translation_memory_reference_lines")
+    system_msg = client.system_prompt(*prompt_names)
+    if problems:
+        system_msg += "\n" + "\n".join(f"- {p}" for p in problems)
+    if reference is not None:
+        client.memory.referenced += 1
+        system_msg += f"\n\n{reference.source}\n---\n{reference.translation}"
+    translated = _request_completion(masked, system_msg, dest_language, model,
+                                     temperature=1.0, client=client)
+    if spans:
+        restored = unmask_markdown(translated, spans)
+        if restored is None:
+            logging.warning("Placeholders were not preserved; translating the cell unmasked")
+            return translate_markdown(text, delay=delay, dest_language=dest_language,
+                                      model=model, client=client, problems=problems,
+                                      mask=False)
+        translated = restored
+    if text.endswith("\n") and not translated.endswith("\n"):
+        translated += "\n"
+    client.learn(dest_language, text, translated)
+    return translated
+
+
+def _translate_markdown_chunks(chunks, *, delay, dest_language, model, client, problems,
+                               workers=1):
+    """
+    Translate the chunks of one cell, up to workers at a time, and join them in order.
+
+    Called from the cell threads of jupyter_translate(), so a notebook runs at
+    most workers * workers requests at once, however long its cells are.
+    """
+    def _one(chunk):
+        body = chunk.strip()
+        if not body:
+            return chunk
+        head = chunk[:len(chunk) - len(chunk.lstrip())]
+        tail = chunk[len(chunk.rstrip()):]
+        translated = translate_markdown(body, delay=delay, dest_language=dest_language,
+                                        model=model, client=client, problems=problems)
+        return head + translated.strip() + tail
+
+    with ThreadPoolExecutor(max_workers=max(min(len(chunks), workers), 1)) as pool:
+        # Each chunk keeps the caller's CallMetrics context.
+        futures = [pool.submit(contextvars.copy_context().run, _one, chunk)
+                   for chunk in chunks]
+        return "".join(fut.result() for fut in futures)
+
+
+_MATH_BLOCK_RE = re.compile(r'\$\$(.+?)\$\$', re.DOTALL)
+_FENCE_RE = re.compile(r'^\s*```', re.MULTILINE)
+_HEADING_RE = re.compile(r'^\s{0,3}#{1,6}\s', re.MULTILINE)
+_STRAY_AFTER_MATH_RE = re.compile(r'\$\$[ \t]*(?:>|<br\s*/?>)')
+_NOT_TRANSLATED_RE = re.compile(
+    r'翻訳しませんでした|翻訳していません|翻訳は不要|already (?:in )?English|'
+    r'(?:did not|didn\'t|do not need to) translate|no translation (?:is )?needed',
+    re.IGNORECASE
 )
 
-# 2) このモジュール (__name__) のみ DEBUG
-logging.getLogger(__name__).setLevel(logging.DEBUG)
 
-# 3) 外部ライブラリのログは WARNING 以上に引き上げ
-logging.getLogger("openai").setLevel(logging.WARNING)
-logging.getLogger("urllib3").setLevel(logging.WARNING)
-logging.getLogger("http.client").setLevel(logging.WARNING)
-logging.getLogger("backoff").setLevel(logging.WARNING)
+def validate_markdown_translation(source: str, translated: str, protected_terms=None) -> list:
+    """
+    Compare the structure of a translated Markdown cell with its source.
+
+    Returns a list of human-readable problems (empty when the cell looks
+    fine): $$ math blocks that changed, code fences or headings that were
+    added or dropped, protected terms from prompts.json whose count changed,
+    stray ">" / "<br>" after $$, notes like "this is already English", and
+    a lost or added trailing newline.
+    """
+    if protected_terms is None:
+        protected_terms = get_prompts().get("protected_terms", [])
+    problems = []
+
+    def _norm(block):
+        return re.sub(r'\s+', '', block)
+
+    src_math = [_norm(m) for m in _MATH_BLOCK_RE.findall(source)]
+    out_math = [_norm(m) for m in _MATH_BLOCK_RE.findall(translated)]
+    if len(src_math) != len(out_math):
+        problems.append(f"expected {len(src_math)} $$ math blocks, found {len(out_math)}")
+    elif src_math != out_math:
+        problems.append("the contents of a $$ math block changed (keep every symbol, including ~)")
+
+    if len(_STRAY_AFTER_MATH_RE.findall(translated)) > len(_STRAY_AFTER_MATH_RE.findall(source)):
+        problems.append("stray '>' or '<br>' right after a closing $$")
+
+    src_fences, out_fences = len(_FENCE_RE.findall(source)), len(_FENCE_RE.findall(translated))
+    if src_fences != out_fences:
+        problems.append(f"expected {src_fences} ``` code fence lines, found {out_fences}")
+
+    src_heads, out_heads = len(_HEADING_RE.findall(source)), len(_HEADING_RE.findall(translated))
+    if src_heads != out_heads:
+        problems.append(f"expected {src_heads} headings, found {out_heads}")
+
+    for term in protected_terms:
+        want, got = source.count(term), translated.count(term)
+        if want != got:
+            problems.append(f"'{term}' appears {got} times instead of {want}; keep it untranslated")
+
+    if _NOT_TRANSLATED_RE.search(translated) and not _NOT_TRANSLATED_RE.search(source):
+        problems.append("contains a note about not translating; output only the translation")
+
+    if source.endswith("\n") != translated.endswith("\n"):
+        problems.append("trailing newline differs from the source")
+    return problems
+
+
+def _split_packed_response(raw: str, expected: int):
+    """
+    Split a packed answer on its <<<CELL n>>> delimiters, or return None.
+    """
+    parts = _PACK_SPLIT_RE.split(raw.strip())
+    if parts[0].strip():
+        return None
+    numbers = parts[1::2]
+    if numbers != [str(n) for n in range(1, expected + 1)]:
+        return None
+    return [seg.strip() for seg in parts[2::2]]
+
+
+def translate_markdown_batch(texts,
+                             *_,
+                             delay: int,
+                             dest_language: str,
+                             model: str = DEFAULT_MODEL,
+                             client=None,
+                             chunk_tokens=0,
+                             workers=1) -> list:
+    """
+    Translate several short Markdown cells with a single request.
+
+    The cells are joined with numbered delimiter lines.  When the answer does
+    not come back with exactly the same segments, every cell is translated on
+    its own instead.  A single cell goes to translate_markdown(), which
+    splits it into chunks of chunk_tokens if it is longer and translates up
+    to workers of them at a time.
+    """
+    client = client or get_default_client()
+    known = [client.recall("markdown", dest_language, t) for t in texts]
+    if any(k is not None for k in known):
+        pending = [t for t, k in zip(texts, known) if k is None]
+        done = iter(translate_markdown_batch(pending, delay=delay, dest_language=dest_language,
+                                             model=model, client=client,
+                                             chunk_tokens=chunk_tokens,
+                                             workers=workers) if pending else [])
+        return [next(done) if k is None else k + "\n" if t.endswith("\n") else k
+                for t, k in zip(texts, known)]
+    if len(texts) == 1 or not client.supports_prompts:
+        return [translate_markdown(t, delay=delay, dest_language=dest_language,
+                                   model=model, client=client, chunk_tokens=chunk_tokens,
+                                   workers=workers)
+                for t in texts]
+
+    masked = [mask_markdown(t) for t in texts]
+    prompt_names = ["translation_system_prompt_lines", "packed_cells_instruction_lines"]
+    if any(spans for _, spans in masked):
+        prompt_names.append("placeholder_instruction_lines")
+    system_msg = client.system_prompt(*prompt_names)
+    payload = "\n\n".join(f"{PACK_DELIMITER.format(n)}\n{m}"
+                           for n, (m, _) in enumerate(masked, 1))
+    raw = _request_completion(payload, system_msg, dest_language, model,
+                              temperature=1.0, client=client)
+    segments = _split_packed_response(raw, len(texts))
+    if segments is None:
+        logging.warning(f"Packed response for {len(texts)} cells did not split cleanly; "
+                        "translating the cells one by one")
+        return [translate_markdown(t, delay=delay, dest_language=dest_language,
+                                   model=model, client=client) for t in texts]
+
+    out = []
+    for text, (_, spans), seg in zip(texts, masked, segments):
+        seg = unmask_markdown(seg, spans)
+        if seg is None:
+            seg = translate_markdown(text, delay=delay, dest_language=dest_language,
+                                     model=model, client=client)
+        if text.endswith("\n") and not seg.endswith("\n"):
+            seg += "\n"
+        client.learn(dest_language, text, seg)
+        out.append(seg)
+    return out
+
+
+def _plan_jobs(cells, pack_tokens: int = 0, skip=()):
+    """
+    Group cell indices into translation jobs.
+
+    Markdown cells up to pack_tokens (estimated) are packed together in
+    document order until the budget is full; code cells and larger markdown
+    cells form jobs of their own.  Cells that need no request (empty or
+    image-only markdown) are still scheduled so the progress bar counts them.
+    Indices in skip are left out entirely.
+    """
+    jobs = []
+    pack, pack_size = [], 0
+    for i, cell in enumerate(cells):
+        if i in skip:
+            continue
+        if cell['cell_type'] != 'markdown' or pack_tokens <= 0:
+            jobs.append([i])
+            continue
+        text = ''.join(cell['source'])
+        if not _markdown_needs_translation(text):
+            jobs.append([i])
+            continue
+        size = estimate_tokens(text)
+        if size > pack_tokens:
+            jobs.append([i])
+            continue
+        if pack and pack_size + size > pack_tokens:
+            jobs.append(pack)
+            pack, pack_size = [], 0
+        pack.append(i)
+        pack_size += size
+    if pack:
+        jobs.append(pack)
+    return jobs
+
+
+# 変換時のデバッグログを有効化
+# logging.getLogger().setLevel(logging.DEBUG)
+
+
+def _decode_json_answer(raw: str):
+    """
+    Parse a JSON answer, tolerating a surrounding code fence; None if invalid.
+    """
+    body = raw.strip()
+    fence = re.match(r"^```[a-zA-Z]*\n(.*)\n```$", body, re.DOTALL)
+    if fence:
+        body = fence.group(1)
+    try:
+        return json.loads(body)
+    except ValueError:
+        return None
+
+
+def _parse_batch_response(raw: str, expected: int):
+    """
+    Decode a JSON array answer to a batched request, or return None.
+    """
+    items = _decode_json_answer(raw)
+    if not isinstance(items, list) or len(items) != expected:
+        return None
+    return items
+
+
+CODE_BATCH_SIZE = 40
+
+
+def translate_code_texts(texts,
+                         dest_language: str,
+                         model: str = DEFAULT_MODEL,
+                         client=None,
+                         max_batch: int = CODE_BATCH_SIZE) -> list:
+    """
+    Translate many comments / string literals with as few requests as possible.
+
+    Unique texts are sent as a JSON array (up to max_batch per request) and
+    mapped back by index.  Items the batch answer does not cover are retried
+    one by one through translate_code_text().  Texts already in the client's
+    phrasebook are not sent at all.
+    """
+    client = client or get_default_client()
+    done = {}
+    for t in dict.fromkeys(texts):
+        known = client.recall("code", dest_language, t)
+        if known is not None:
+            done[t] = known
+    unique = [t for t in dict.fromkeys(texts) if t not in done]
+    if len(unique) <= 1 or not client.supports_prompts:
+        done.update({t: translate_code_text(t, dest_language=dest_language, model=model,
+                                            client=client) for t in unique})
+        return [done[t] for t in texts]
+
+    system_msg = client.system_prompt("code_translation_system_prompt_lines",
+                                      "batch_translation_instruction_lines")
+    for start in range(0, len(unique), max_batch):
+        chunk = unique[start:start + max_batch]
+        payload = json.dumps(chunk, ensure_ascii=False)
+        raw = _request_completion(payload, system_msg, dest_language, model,
+                                  temperature=0.7, client=client)
+        items = _parse_batch_response(raw, len(chunk))
+        if items is None:
+            logging.warning(f"Batch response for {len(chunk)} items did not parse; "
+                            "falling back to one request per item")
+            items = [None] * len(chunk)
+        for src, res in zip(chunk, items):
+            if not isinstance(res, str) or not res.strip():
+                res = translate_code_text(src, dest_language=dest_language,
+                                          model=model, client=client)
+            done[src] = res
+    return [done[t] for t in texts]
+
+
+class CodeFragment(NamedTuple):
+    """
+    One translatable piece of a code cell.
+
+    code[start:end] is replaced by head + translation + tail.  Lines after
+    the first get indent prepended (docstrings); fields are the masked
+    {...} replacement fields of the text, restored after translation.
+    """
+    start: int
+    end: int
+    head: str
+    text: str
+    tail: str
+    indent: str = ""
+    fields: tuple = ()
+    quote: str = ""
+
+
+# Calls whose positional string arguments are user-facing messages.
+TRANSLATED_CALLS = ("print", "print_formatted_tensor")
+_MAGIC_LINE_RE = re.compile(r'[ \t]*(?:[%!].*|[\w.]+\?{1,2}|\?{1,2}[\w.]+)[ \t]*')
+_STRING_PREFIX_RE = re.compile(r"^([rRbBuUfF]*)('''|\"\"\"|'|\")")
+_FORMAT_FIELD_RE = re.compile(r'\{[^{}]*\}')
+_TODO_RE = re.compile(r'^(TODO:)[ \t]*', re.IGNORECASE)
+_FSTRING_START = getattr(tokenize, "FSTRING_START", None)
+_FSTRING_END = getattr(tokenize, "FSTRING_END", None)
+_STATEMENT_START = (None, tokenize.NEWLINE, tokenize.INDENT, tokenize.DEDENT)
+
+
+def _begins_logical_line(lines, row: int) -> bool:
+    """True if line number row (1-based) of lines starts a new statement."""
+    last = None
+    try:
+        for tok in tokenize.generate_tokens(io.StringIO("".join(lines)).readline):
+            if tok.start[0] >= row:
+                break
+            if tok.type not in (tokenize.NL, tokenize.COMMENT,
+                                tokenize.INDENT, tokenize.DEDENT):
+                last = tok
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        return False
+    return last is None or last.type == tokenize.NEWLINE
+
+
+def _tokenize_code(code: str):
+    """
+    Tokens of code, with IPython magic / shell / help lines blanked out.
+
+    Only lines that begin a statement are blanked, so a docstring line or
+    a comment ending in "?" is left alone.  Stops quietly at the first
+    tokenize error; the tokens before it are complete and still usable.
+    """
+    lines = io.StringIO(code).readlines()
+    for row, line in enumerate(lines, 1):
+        content = line.rstrip("\r\n")
+        if _MAGIC_LINE_RE.fullmatch(content) and _begins_logical_line(lines, row):
+            lines[row - 1] = " " * len(content) + line[len(content):]
+    masked = "".join(lines)
+    tokens = []
+    try:
+        for tok in tokenize.generate_tokens(io.StringIO(masked).readline):
+            tokens.append(tok)
+    except (tokenize.TokenError, IndentationError, SyntaxError) as e:
+        logging.debug(f"Stopped tokenizing code cell early: {e}")
+    return tokens
+
+
+def _comment_fragment(tok, start):
+    body = tok.string[1:]
+    if not re.search(r'[^\W\d_]', body) or body.startswith(('!', '%%')):
+        return None
+    lead = len(body) - len(body.lstrip())
+    head = "#" + body[:lead]
+    body = body[lead:].rstrip()
+    todo = _TODO_RE.match(body)
+    if todo:
+        head += todo.group(0)
+        body = body[todo.end():]
+        if not body:
+            return None
+    return CodeFragment(start, start + len(tok.string.rstrip()), head, body, "")
+
+
+def _string_fragment(literal, start, docstring=False):
+    m = _STRING_PREFIX_RE.match(literal)
+    if not m or 'b' in m.group(1).lower():
+        return None
+    quote = m.group(2)
+    body = literal[m.end():len(literal) - len(quote)]
+    core = body.strip()
+    if not re.search(r'[^\W\d_]', core):
+        return None
+    lead = body[:len(body) - len(body.lstrip())]
+    trail = body[len(body.rstrip()):]
+
+    indent = ""
+    if docstring and "\n" in core:
+        rest = [ln for ln in core.split("\n")[1:] if ln.strip()]
+        indent = os.path.commonprefix([ln[:len(ln) - len(ln.lstrip())] for ln in rest])
+        core = "\n".join(ln[len(indent):] if n else ln
+                         for n, ln in enumerate(core.split("\n")))
+
+    fields = []
+
+    def _mask(field):
+        fields.append(field.group(0))
+        return PLACEHOLDER.format(len(fields) - 1)
+
+    core = _FORMAT_FIELD_RE.sub(_mask, core)
+    if not re.search(r'[^\W\d_]', _PLACEHOLDER_RE.sub('', core)):
+        return None  # only format fields and punctuation, nothing to translate
+    return CodeFragment(start, start + len(literal), literal[:m.end()] + lead, core,
+                        trail + quote, indent, tuple(fields), quote)
+
+
+@functools.lru_cache(maxsize=4096)
+def _extract_code_fragments(code: str) -> tuple:
+    """
+    Find the comments, docstrings and print messages of code in one pass.
+
+    Uses tokenize, so a "#" inside a string is not a comment and f-strings
+    are handled like other literals (their {...} fields are masked).
+    Returns CodeFragments in source order.  Results are cached, so a cell
+    translated into several languages (or repeated across notebooks) is
+    tokenized once.
+    """
+    line_starts = [0]
+    for line in code.splitlines(True):
+        line_starts.append(line_starts[-1] + len(line))
+
+    def offset(pos):
+        row, col = pos
+        return line_starts[row - 1] + col
+
+    tokens = _tokenize_code(code)
+    significant = [t for t in tokens
+                   if t.type not in (tokenize.NL, tokenize.COMMENT, tokenize.ENDMARKER)]
+    fragments = []
+    calls = []          # one entry per open bracket: is it a translated call?
+    prev = None         # previous significant token
+    n = 0
+    while n < len(significant):
+        tok = significant[n]
+        if tok.type == _FSTRING_START:
+            # Python 3.12+ splits f-strings into many tokens; take the literal whole.
+            depth, end = 0, n
+            while end < len(significant):
+                depth += {_FSTRING_START: 1, _FSTRING_END: -1}.get(significant[end].type, 0)
+                if depth == 0:
+                    break
+                end += 1
+            end = min(end, len(significant) - 1)
+            literal = code[offset(tok.start):offset(significant[end].end)]
+            tok = tokenize.TokenInfo(tokenize.STRING, literal, tok.start,
+                                     significant[end].end, tok.line)
+            n = end
+        nxt = significant[n + 1] if n + 1 < len(significant) else None
+
+        if tok.type == tokenize.OP and tok.string in "([{":
+            calls.append(tok.string == "(" and prev is not None
+                         and prev.type == tokenize.NAME and prev.string in TRANSLATED_CALLS)
+        elif tok.type == tokenize.OP and tok.string in ")]}":
+            if calls:
+                calls.pop()
+        elif tok.type == tokenize.STRING:
+            start = offset(tok.start)
+            docstring = ((prev is None or prev.type in _STATEMENT_START)
+                         and (nxt is None or nxt.type == tokenize.NEWLINE))
+            in_call = (calls and calls[-1] and prev is not None
+                       and not (prev.type == tokenize.OP and prev.string == "=")
+                       and (nxt is None or nxt.string in (",", ")", "+")
+                            or nxt.type == tokenize.STRING))
+            if docstring or in_call:
+                frag = _string_fragment(tok.string, start, docstring=docstring)
+                if frag is not None:
+                    fragments.append(frag)
+        prev = tok
+        n += 1
+
+    for tok in tokens:
+        if tok.type == tokenize.COMMENT:
+            frag = _comment_fragment(tok, offset(tok.start))
+            if frag is not None:
+                fragments.append(frag)
+    return tuple(sorted(fragments))
+
+
+def _render_fragment(frag, translation):
+    # Escape while the format fields are still placeholders: the code
+    # inside {...} must be written back untouched.
+    text = translation.strip()
+    if frag.indent:
+        text = re.sub(r'\n(?=[^\n])', "\n" + frag.indent, text)
+    if frag.quote in ("'", '"'):
+        if "r" in frag.head[:frag.head.index(frag.quote)].lower() and frag.quote in text:
+            return None
+        text = re.sub(r'(?<!\\)((?:\\\\)*)' + frag.quote, r'\1\\' + frag.quote, text)
+        text = text.replace("\n", "\\n")
+    elif frag.quote and frag.quote in text:
+        return None
+    elif not frag.quote:
+        text = " ".join(text.splitlines())  # a comment must stay on its line
+    if frag.fields:
+        text = unmask_markdown(text, list(frag.fields))
+        if text is None:
+            return None
+    return frag.head + text + frag.tail
+
+
+def _join_code_fragments(code, fragments, translations) -> str:
+    """
+    Splice translations into code at the fragment spans.
+
+    A translation that cannot be written back safely (lost format fields,
+    an unescapable quote) keeps the original text.
+    """
+    out = []
+    pos = 0
+    for frag, translation in zip(fragments, translations):
+        rendered = _render_fragment(frag, translation)
+        if rendered is None:
+            logging.debug(f"Keeping original text for {code[frag.start:frag.end]!r}")
+            continue
+        out.append(code[pos:frag.start])
+        out.append(rendered)
+        pos = frag.end
+    out.append(code[pos:])
+    return "".join(out)
+
 
-# Load prompts
-_PROMPTS_PATH = Path(__file__).parent / "prompts.json"
-try:
-    with open(_PROMPTS_PATH, encoding="utf-8") as f:
-        PROMPTS = json.load(f)
-except Exception as e:
-    logging.error(f"Failed to load prompts from {_PROMPTS_PATH}: {e}")
-    raise
+def translate_code_sources(codes,
+                           dest_language: str,
+                           model: str = DEFAULT_MODEL,
+                           client=None) -> list:
+    """
+    Translate several pieces of code, sending all their fragments as one batch.
+    """
+    extracted = []
+    texts = []
+    for code in codes:
+        frags = _extract_code_fragments(code) if code.strip() else []
+        extracted.append((frags, len(texts)))
+        texts.extend(f.text for f in frags)
 
-# Helper: translate code comments / print strings via OpenAI API
-def translate_code_text(text: str,
-                        dest_language: str,
-                        model: str = "gpt-4.1-mini") -> str:
+    translations = translate_code_texts(texts, dest_language=dest_language,
+                                        model=model, client=client) if texts else []
+
+    out = []
+    for code, (frags, offset) in zip(codes, extracted):
+        if not frags:
+            out.append(code)
+            continue
+        out.append(_join_code_fragments(code, frags,
+                                        translations[offset:offset + len(frags)]))
+    return out
+
+
+def translate_code_comments_and_prints(code: str,
+                                      dest_language: str,
+                                      model: str = DEFAULT_MODEL,
+                                      client=None) -> str:
     """
-    Uses ChatGPT to translate a single comment or string literal into dest_language.
+    Translate comments, docstrings, and simple print statements in code.
+    All pieces of text are translated together by translate_code_texts().
     """
-    openai.api_key = os.getenv("OPENAI_API_KEY")
-    if not openai.api_key:
-        raise RuntimeError("OPENAI_API_KEY environment variable not set")
+    return translate_code_sources([code], dest_language=dest_language,
+                                  model=model, client=client)[0]
 
-    system_lines = PROMPTS.get("code_translation_system_prompt_lines")
-    if not system_lines:
-        raise RuntimeError("'code_translation_system_prompt_lines' not found in prompts.json")
 
-    system_msg = "\n".join(system_lines)
-    messages = [
-        {"role": "system", "content": system_msg},
-        {"role": "user",   "content": f"Translate into {dest_language}:\n\n{text}"}
-    ]
+_JSON_WS = re.compile(rb'[ \t\n\r]*')
+_JSON_STRING = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"')
+_JSON_SCALAR = re.compile(rb'[^,\]\}\s]+')
+_JSON_STRUCT = re.compile(rb'["\[\]\{\}]')
 
-    @backoff.on_exception(
-        backoff.expo,
-        (openai.error.RateLimitError, openai.error.APIError, openai.error.Timeout),
-        max_tries=3
-    )
-    def _call():
-        return openai.ChatCompletion.create(
-            model=model,
-            messages=messages,
-            temperature=0.7
-        )
 
-    resp = _call()
-    return resp.choices[0].message.content.strip()
+class NotebookSource:
+    """
+    Read-only, memory-mapped view of a .ipynb file.
+
+    Only ``cell_type``, ``source`` and the (small) cell ``metadata`` are
+    decoded; everything else, in particular base64 ``outputs`` and
+    ``attachments``, stays in the mapped file and is copied byte-for-byte by
+    write().  Each entry of ``cells`` is a dict with ``cell_type``, ``source``
+    (list of lines) and ``metadata``.
+    """
 
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._buf = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError(f"{path} is empty, not a notebook")
+        self.cells = []
+        self._spans = []
+        self._index()
 
-def translate_markdown(text: str,
-                       *_,
-                       delay: int,
-                       dest_language: str,
-                       model: str = "gpt-4.1-mini"
-                      ) -> str:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._buf.close()
+        self._file.close()
+
+    # -- scanning -----------------------------------------------------------
+    def _ws(self, pos):
+        return _JSON_WS.match(self._buf, pos).end()
+
+    def _expect(self, pos, char):
+        pos = self._ws(pos)
+        if self._buf[pos:pos + 1] != char:
+            raise ValueError(f"{self.path}: expected {char!r} at byte {pos}")
+        return pos + 1
+
+    def _skip_value(self, pos):
+        buf = self._buf
+        first = buf[pos:pos + 1]
+        if first == b'"':
+            return _JSON_STRING.match(buf, pos).end()
+        if first not in (b'{', b'['):
+            return _JSON_SCALAR.match(buf, pos).end()
+        depth = 0
+        while True:
+            m = _JSON_STRUCT.search(buf, pos)
+            if m is None:
+                raise ValueError(f"{self.path}: unterminated JSON value")
+            char = m.group()
+            if char == b'"':
+                pos = _JSON_STRING.match(buf, m.start()).end()
+                continue
+            pos = m.end()
+            depth += 1 if char in (b'{', b'[') else -1
+            if depth == 0:
+                return pos
+
+    def _members(self, pos):
+        """Yield (key, value_start, value_end) for the object starting at pos."""
+        pos = self._expect(pos, b'{')
+        pos = self._ws(pos)
+        if self._buf[pos:pos + 1] == b'}':
+            return
+        while True:
+            key_end = _JSON_STRING.match(self._buf, pos).end()
+            key = json.loads(self._buf[pos:key_end])
+            start = self._ws(self._expect(key_end, b':'))
+            end = self._skip_value(start)
+            yield key, start, end
+            pos = self._ws(end)
+            if self._buf[pos:pos + 1] == b'}':
+                return
+            pos = self._ws(self._expect(pos, b','))
+
+    def _items(self, pos):
+        """Yield (start, end) for the elements of the array starting at pos."""
+        pos = self._ws(self._expect(pos, b'['))
+        if self._buf[pos:pos + 1] == b']':
+            return
+        while True:
+            end = self._skip_value(pos)
+            yield pos, end
+            pos = self._ws(end)
+            if self._buf[pos:pos + 1] == b']':
+                return
+            pos = self._ws(self._expect(pos, b','))
+
+    def _index(self):
+        for key, start, _ in self._members(self._ws(0)):
+            if key != 'cells':
+                continue
+            for cell_start, _ in self._items(start):
+                cell = {'cell_type': None, 'source': [], 'metadata': {}}
+                span = None
+                for ckey, vstart, vend in self._members(cell_start):
+                    if ckey in ('cell_type', 'source', 'metadata'):
+                        cell[ckey] = json.loads(self._buf[vstart:vend])
+                    if ckey == 'source':
+                        span = (vstart, vend)
+                if isinstance(cell['source'], str):
+                    cell['source'] = cell['source'].splitlines(True)
+                self.cells.append(cell)
+                self._spans.append((span, cell_start))
+
+    # -- writing ------------------------------------------------------------
+    def _line_indent(self, pos):
+        line_start = self._buf.rfind(b'\n', 0, pos) + 1
+        indent = self._buf[line_start:pos]
+        return indent.decode('ascii') if not indent.strip() else None
+
+    def _format_source(self, lines, span, cell_start):
+        key_indent = self._line_indent(self._buf.rfind(b'"source"', cell_start, span[0]))
+        if key_indent is None or not lines:
+            return json.dumps(lines, ensure_ascii=False)
+        cell_indent = self._line_indent(cell_start) or ""
+        step = " " * max(len(key_indent) - len(cell_indent), 1)
+        body = ",\n".join(f"{key_indent}{step}{json.dumps(line, ensure_ascii=False)}"
+                           for line in lines)
+        return f"[\n{body}\n{key_indent}]"
+
+    def write(self, out_path, sources):
+        """
+        Write a copy of the notebook with the cell sources replaced.
+
+        sources maps cell index -> new list of source lines; all other bytes
+        are copied unchanged from the input file.
+        """
+        edits = []
+        for i, lines in sources.items():
+            span, cell_start = self._spans[i]
+            if span is None:
+                continue
+            edits.append((span, self._format_source(lines, span, cell_start)))
+        edits.sort()
+
+        with open(out_path, 'wb') as f, memoryview(self._buf) as view:
+            pos = 0
+            for (start, end), text in edits:
+                f.write(view[pos:start])
+                f.write(text.encode('utf-8'))
+                pos = end
+            f.write(view[pos:])
+
+
+MANIFEST_VERSION = 1
+
+
+def _translate_override(cell):
     """
-    Translate one Markdown cell with ChatGPT.
+    The "translate" flag of the cell's jupyter_translate metadata, or None.
     """
-    if not text.strip():
-        return text
+    options = (cell.get('metadata') or {}).get('jupyter_translate')
+    return options.get('translate') if isinstance(options, dict) else None
 
-    image_only_pattern = re.compile(
-        r'^(?:!\[[^\]]*\]\((?:data:image/[^)]+|attachment:[^)]+)\)\s*)+$'
-    )
-    if image_only_pattern.match(text.strip()):
-        return text
 
-    openai.api_key = os.getenv("OPENAI_API_KEY")
-    if not openai.api_key:
-        raise RuntimeError("OPENAI_API_KEY environment variable not set")
+def _skip_reason(cell, dest_language):
+    """
+    Why cell needs no request at all: "metadata", "language" or None.
 
-    @backoff.on_exception(
-        backoff.expo,
-        (openai.error.RateLimitError, openai.error.APIError, openai.error.Timeout),
-        max_tries=3
-    )
-    def request_translation(content: str) -> str:
-        raw = PROMPTS["translation_system_prompt_lines"]
-        system_msg = "\n".join(raw)
-        if not system_msg:
-            logging.error("Missing 'translation_system_prompt_lines' in prompts.json")
-            raise RuntimeError("translation_system_prompt_lines not found in prompts.json")
+    {"jupyter_translate": {"translate": false}} in the cell metadata always
+    skips the cell and "translate": true always sends it.  Otherwise
+    Markdown cells that detect_language() finds already in dest_language
+    are skipped.
+    """
+    override = _translate_override(cell)
+    if override is not None:
+        return None if override else "metadata"
+    if (cell['cell_type'] == 'markdown'
+            and detect_language(''.join(cell['source'])) == dest_language.split('-')[0].lower()):
+        return "language"
+    return None
 
-        messages = [
-            {"role": "system", "content": system_msg},
-            {"role": "user",   "content": f"Translate into {dest_language}:\n\n{content}"}
-        ]
-        resp = openai.ChatCompletion.create(
-            model=model,
-            messages=messages,
-            temperature=1.0
-        )
-        return resp.choices[0].message.content.strip()
 
-    translated = request_translation(text)
-    if text.endswith("\n") and not translated.endswith("\n"):
-        translated += "\n"
-    return translated
+def cell_hash(cell) -> str:
+    """
+    Content hash of a source cell, used to detect unchanged cells between runs.
+    """
+    fields = [cell['cell_type'], ''.join(cell['source'])]
+    override = _translate_override(cell)
+    if override is not None:
+        fields.append(override)
+    payload = json.dumps(fields, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
 
 
-# 変換時のデバッグログを有効化
-# logging.getLogger().setLevel(logging.DEBUG)
+def _prompts_digest() -> str:
+    payload = json.dumps(get_prompts(), ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
 
 
-def translate_code_comments_and_prints(code: str,
-                                      dest_language: str,
-                                      model: str = "gpt-4.1-mini") -> str:
+def _run_settings(dest_language, backend_tag, model=DEFAULT_MODEL) -> dict:
     """
-    Translate comments, docstrings, and simple print statements in code.
-    Uses translate_code_text() for each piece of text.
+    What a manifest or journal must match for its translations to be reused:
+    the target language, the prompt set, the backend's cache_tag and the model.
     """
-    # logging.debug("Starting translate_code_comments_and_prints")
-    if not code.strip():
-        return code
+    return {"dest_language": dest_language, "prompts": _prompts_digest(),
+            "backend": backend_tag, "model": model}
 
-    def translate_text(txt):
-        # logging.debug(f"Translating text: '{txt[:30]}...'")
-        res = translate_code_text(txt, dest_language=dest_language, model=model)
-        # logging.debug(f"Result: '{res[:30]}...'")
-        return res
 
-    lines = code.split("\n")
-    out = []
-    i = 0
-    total = len(lines)
-
-    while i < total:
-        line = lines[i]
-
-        # Docstring handling
-        m = re.match(r"(\s*)(?P<delim>'''|\"\"\")", line)
-        if m:
-            indent, delim = m.group(1), m.group("delim")
-            stripped = line.strip()
-            # Single-line docstring?
-            if stripped.endswith(delim) and len(stripped) > len(delim)*2 - 2:
-                content = stripped[len(delim):-len(delim)]
-                out.append(f"{indent}{delim}{translate_text(content)}{delim}")
-                i += 1
-                continue
-            # Multi-line
-            out.append(line)
-            i += 1
-            buffer = []
-            while i < total and not lines[i].strip().endswith(delim):
-                buffer.append(lines[i])
-                i += 1
-            joined = "\n".join(buffer)
-            translated = translate_text(joined)
-            for tline in translated.split("\n"):
-                out.append(f"{indent}{tline}")
-            if i < total:
-                out.append(lines[i])
-            i += 1
-            continue
+def _write_manifest(path, hashes, dest_language, backend_tag, model=DEFAULT_MODEL):
+    manifest = {
+        "version": MANIFEST_VERSION,
+        **_run_settings(dest_language, backend_tag, model),
+        "cells": hashes,
+    }
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, path)
 
-        # Inline comment
-        if "#" in line:
-            code_part, comment = line.split("#", 1)
-            comment = comment.strip()
-            todo = re.match(r"(TODO:)(.*)", comment, re.IGNORECASE)
-            if todo:
-                prefix, rest = todo.groups()
-                new_comment = f"{prefix} {translate_text(rest.strip())}"
-            else:
-                new_comment = translate_text(comment)
-            out.append(f"{code_part}# {new_comment}")
-            i += 1
-            continue
 
-        # Skip f-string prints
-        if "print(f" in line:
-            out.append(line)
-            i += 1
-            continue
+JOURNAL_VERSION = 1
 
-        # Regular print(...)
-        pm = re.search(r'print\(\s*("|\')(.+?)\1', line)
-        if pm and "print_formatted_tensor" not in line:
-            quote, txt = pm.group(1), pm.group(2)
-            new_txt = translate_text(txt)
-            out.append(line.replace(f"{quote}{txt}{quote}", f"{quote}{new_txt}{quote}"))
-            i += 1
-            continue
 
-        # print_formatted_tensor(...)
-        tm = re.search(r'print_formatted_tensor\(\s*("|\')(.+?)\1', line)
-        if tm:
-            quote, txt = tm.group(1), tm.group(2)
-            new_txt = translate_text(txt)
-            out.append(line.replace(f"{quote}{txt}{quote}", f"{quote}{new_txt}{quote}"))
-            i += 1
-            continue
+class CheckpointJournal:
+    """
+    Append-only record of finished cells for one output notebook.
+
+    Every translated cell is written as one JSON line and flushed at once,
+    so an interrupted run can be resumed with at most one cell lost.  The
+    first line identifies the target language, prompt set, backend and model
+    (see _run_settings()); a journal written for other settings is ignored.
+    """
+
+    def __init__(self, path, dest_language, backend_tag, resume=False, model=DEFAULT_MODEL):
+        self.path = path
+        header = {"version": JOURNAL_VERSION,
+                  **_run_settings(dest_language, backend_tag, model)}
+        self.entries = self._read(header) if resume else {}
+        mode = 'a' if self.entries else 'w'
+        self._file = open(path, mode, encoding='utf-8')
+        if mode == 'w':
+            self._append(header)
+
+    def _read(self, header):
+        if not os.path.exists(self.path):
+            return {}
+        entries = {}
+        with open(self.path, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        try:
+            if not lines or json.loads(lines[0]) != header:
+                logging.warning(f"Ignoring journal {self.path} written with other settings")
+                return {}
+        except ValueError:
+            return {}
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break  # a line cut short by the interruption
+            entries[entry["hash"]] = entry["source"]
+        return entries
+
+    def _append(self, record):
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def record(self, cell_hash, source):
+        self._append({"hash": cell_hash, "source": source})
+
+    def close(self, remove=False):
+        self._file.close()
+        if remove:
+            os.remove(self.path)
+
+
+def _load_reusable_translations(manifest_path, out_fname, hashes, dest_language,
+                                backend_tag, model=DEFAULT_MODEL):
+    """
+    Map current cell index -> translated source taken from the previous output.
+
+    Nothing is reused when the manifest is missing, was written for another
+    language, prompt set, backend (by cache_tag) or model, or no longer
+    matches the previous output file.
+    """
+    if not (os.path.exists(manifest_path) and os.path.exists(out_fname)):
+        return {}
+    try:
+        with open(manifest_path, encoding='utf-8') as f:
+            manifest = json.load(f)
+    except ValueError:
+        logging.warning(f"Ignoring unreadable manifest {manifest_path}")
+        return {}
+    settings = _run_settings(dest_language, backend_tag, model)
+    if (manifest.get("version") != MANIFEST_VERSION
+            or any(manifest.get(key) != value for key, value in settings.items())):
+        return {}
+
+    old_index = {}
+    for j, h in enumerate(manifest.get("cells", [])):
+        old_index.setdefault(h, j)
+
+    with NotebookSource(out_fname) as previous:
+        if len(previous.cells) != len(manifest.get("cells", [])):
+            logging.warning(f"{out_fname} does not match its manifest; retranslating all cells")
+            return {}
+        return {i: previous.cells[old_index[h]]['source']
+                for i, h in enumerate(hashes) if h in old_index}
 
-        # Default
-        out.append(line)
-        i += 1
 
-    # logging.debug("Completed translate_code_comments_and_prints")
-    return "\n".join(out)
+def _translate_cell(cell, dest_language, delay, client=None, chunk_tokens=0,
+                    model=DEFAULT_MODEL, workers=1):
+    """
+    Translate the source of one notebook cell and return the new source list.
+    """
+    if cell['cell_type'] == 'markdown':
+        full = ''.join(cell['source'])
+        trans = translate_markdown(full, None,
+                                   delay=delay,
+                                   dest_language=dest_language,
+                                   model=model,
+                                   client=client,
+                                   chunk_tokens=chunk_tokens,
+                                   workers=workers)
+        return trans.splitlines(True)
+
+    if cell['cell_type'] == 'code':
+        # The cell is handled as one string so docstrings and statements
+        # spanning several lines are seen whole; the result is split back
+        # into the usual one-line-per-item source list.
+        full = ''.join(cell['source'])
+        trans = translate_code_comments_and_prints(full,
+                                                   dest_language=dest_language,
+                                                   model=model,
+                                                   client=client)
+        return cell['source'] if trans == full else trans.splitlines(True)
+
+    return cell['source']
 
 
 def jupyter_translate(fname, src_language, dest_language, delay,
-                      rename_source_file=False, print_translation=False):
+                      rename_source_file=False, print_translation=False,
+                      workers=1, client=None, pack_tokens=0, incremental=True,
+                      progress=None, max_fix_requests=0, resume=False, reuse_from=None,
+                      chunk_tokens=0, source=None, model=DEFAULT_MODEL):
     """
     Translates a Jupyter Notebook from one language to another.
+
+    All requests go through client (a TranslatorClient; a default one without
+    cache or rate limits is used if omitted).  With workers > 1 the cells are
+    sent concurrently from a thread pool; results are written back in the
+    original cell order.
+    With pack_tokens > 0 short Markdown cells share one request up to that
+    estimated token budget; with chunk_tokens > 0 Markdown cells above that
+    budget are split into chunks translated in parallel (see
+    split_markdown()).  The notebook is memory-mapped and only cell sources
+    are parsed; outputs are copied to the result file unchanged.
+
+    A <name>_<lang>.manifest.json sidecar records the hash of every source
+    cell.  With incremental=True, cells whose hash is unchanged since the last
+    run take their translation from the existing <name>_<lang>.ipynb and only
+    new or edited cells are sent to the API.
+
+    progress, if given, is called with the number of finished cells instead
+    of drawing a progress bar.  Cells whose API requests keep failing are
+    left untranslated and counted in the returned summary dict.
+
+    Translated Markdown cells are checked with validate_markdown_translation();
+    up to max_fix_requests broken cells are translated again.
+
+    Finished cells are appended to a <name>_<lang>.journal.jsonl checkpoint
+    as they complete; it is removed once the notebook is saved.  After a
+    crash or Ctrl-C, resume=True takes the journaled cells instead of
+    requesting them again.
+
+    reuse_from names a related notebook already translated to dest_language
+    (e.g. the TODO version of an answer notebook); cells identical to one
+    of its cells take that translation.
+
+    Markdown cells that detect_language() finds already in dest_language
+    are not sent ("skipped" in the summary), nor are cells whose metadata
+    holds {"jupyter_translate": {"translate": false}} ("excluded");
+    "translate": true sends a cell regardless.
+
+    source may be an open NotebookSource of fname to use instead of reading
+    the file again (see translate_languages()).
+
+    Every request asks for model, which the manifest and journal record
+    too: outputs written with another model are not reused.
     """
-    with open(fname, 'r', encoding='utf-8') as f:
-        nb = json.load(f)
+    started = time.time()
+    client = client or get_default_client()
+    requests_before, tokens_before = client.usage.snapshot(dest_language)
+    metrics_start = client.metrics.mark()
+    with contextlib.nullcontext(source) if source is not None else NotebookSource(fname) as nb:
+        summary = _translate_notebook(nb, fname, dest_language, delay, print_translation,
+                                      workers, client, pack_tokens, incremental, progress,
+                                      max_fix_requests, resume, reuse_from, chunk_tokens,
+                                      model)
+    requests_after, tokens_after = client.usage.snapshot(dest_language)
+    calls = [r._asdict()
+             for r in client.metrics.for_notebook(fname, metrics_start, dest_language)]
+    summary.update(language=dest_language, seconds=time.time() - started,
+                   requests=requests_after - requests_before,
+                   tokens=tokens_after - tokens_before,
+                   calls=calls)
+    summary["metrics"] = summarize_calls(calls, summary["seconds"])
+    return summary
+
 
-    total = len(nb['cells'])
-    code_cells = sum(1 for c in nb['cells'] if c['cell_type'] == 'code')
-    md_cells = sum(1 for c in nb['cells'] if c['cell_type'] == 'markdown')
+def _translate_notebook(nb, fname, dest_language, delay, print_translation,
+                        workers, client, pack_tokens, incremental, progress,
+                        max_fix_requests, resume, reuse_from, chunk_tokens, model):
+    cells = nb.cells
+    total = len(cells)
+    code_cells = sum(1 for c in cells if c['cell_type'] == 'code')
+    md_cells = sum(1 for c in cells if c['cell_type'] == 'markdown')
     print(f"Total cells: {total}, code: {code_cells}, markdown: {md_cells}")
 
-    for i, cell in enumerate(tqdm(nb['cells'], desc="Translating cells")):
-        if cell['cell_type'] == 'markdown':
-            full = ''.join(cell['source'])
-            trans = translate_markdown(full, None,
-                                       delay=delay,
-                                       dest_language=dest_language)
-            nb['cells'][i]['source'] = trans.splitlines(True)
-            if print_translation:
-                print(f"MD cell {i}:\n{trans}")
-
-        elif cell['cell_type'] == 'code':
-            translated_src = [
-                translate_code_comments_and_prints(
-                    line,
-                    dest_language=dest_language
-                )
-                for line in cell['source']
-            ]
-            nb['cells'][i]['source'] = translated_src
-            if print_translation:
-                print(f"Code cell {i}:\n{''.join(translated_src)}")
+    translated = {}
+    failed_set = set()
+
+    def _store(i, new_source):
+        translated[i] = new_source
+        if i not in failed_set:
+            journal.record(hashes[i], new_source)
+        if print_translation:
+            kind = "MD" if cells[i]['cell_type'] == 'markdown' else "Code"
+            print(f"{kind} cell {i}:\n{''.join(new_source)}")
+
+    def _run(job):
+        context = CallMetrics.context(fname, job)
+        try:
+            if len(job) == 1:
+                return {job[0]: _translate_cell(cells[job[0]], dest_language, delay, client,
+                                                chunk_tokens, model, workers)}
+            texts = [''.join(cells[i]['source']) for i in job]
+            results = translate_markdown_batch(texts, delay=delay,
+                                               dest_language=dest_language, model=model,
+                                               client=client, chunk_tokens=chunk_tokens,
+                                               workers=workers)
+            return {i: t.splitlines(True) for i, t in zip(job, results)}
+        except BackendError as e:
+            logging.error(f"{fname}: giving up on cell(s) {job}: {e}")
+            failed_set.update(job)
+            return {i: cells[i]['source'] for i in job}
+        finally:
+            CallMetrics.reset_context(context)
 
     base, ext = os.path.splitext(fname)
     out_fname = f"{base}_{dest_language}{ext}"
-    with open(out_fname, 'w', encoding='utf-8') as f:
-        json.dump(nb, f, ensure_ascii=False, indent=2)
+    manifest_path = f"{base}_{dest_language}.manifest.json"
+    hashes = [cell_hash(c) for c in cells]
+
+    reused = {}
+    if incremental:
+        reused = _load_reusable_translations(manifest_path, out_fname, hashes, dest_language,
+                                             client.backend.cache_tag, model)
+        if reused:
+            print(f"Reusing {len(reused)} unchanged cell{'s' if len(reused) != 1 else ''} "
+                  f"from {out_fname}")
+
+    if reuse_from:
+        other_base, other_ext = os.path.splitext(reuse_from)
+        borrowed = _load_reusable_translations(f"{other_base}_{dest_language}.manifest.json",
+                                               f"{other_base}_{dest_language}{other_ext}",
+                                               hashes, dest_language, client.backend.cache_tag,
+                                               model)
+        borrowed = {i: src for i, src in borrowed.items() if i not in reused}
+        if borrowed:
+            print(f"Taking {len(borrowed)} cell{'s' if len(borrowed) != 1 else ''} "
+                  f"shared with {reuse_from}")
+        reused.update(borrowed)
+    else:
+        borrowed = {}
+
+    journal = CheckpointJournal(f"{base}_{dest_language}.journal.jsonl", dest_language,
+                                client.backend.cache_tag, resume=resume, model=model)
+    resumed = {i: journal.entries[h] for i, h in enumerate(hashes)
+               if i not in reused and h in journal.entries}
+    if resumed:
+        print(f"Resuming {len(resumed)} cell{'s' if len(resumed) != 1 else ''} "
+              f"from {journal.path}")
+
+    skipped = {}
+    for i, cell in enumerate(cells):
+        if i not in reused and i not in resumed:
+            reason = _skip_reason(cell, dest_language)
+            if reason:
+                skipped[i] = reason
+    excluded = sum(reason == "metadata" for reason in skipped.values())
+    detected = len(skipped) - excluded
+    if skipped:
+        print(f"Skipping {detected} cell{'s' if detected != 1 else ''} already in "
+              f"{dest_language} and {excluded} excluded by cell metadata")
+
+    bar = None
+    if progress is None:
+        from tqdm import tqdm  # For progress bar
+        bar = tqdm(total=total, desc="Translating cells")
+    advance = bar.update if bar is not None else progress
+
+    jobs = _plan_jobs(cells, pack_tokens, skip=reused.keys() | resumed.keys() | skipped.keys())
+    try:
+        for i, new_source in {**reused, **resumed}.items():
+            translated[i] = new_source
+        advance(len(reused) + len(resumed) + len(skipped))
+        if workers <= 1:
+            for job in jobs:
+                for i, new_source in _run(job).items():
+                    _store(i, new_source)
+                advance(len(job))
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(_run, job) for job in jobs]
+                try:
+                    for fut in as_completed(futures):
+                        result = fut.result()
+                        for i, new_source in result.items():
+                            _store(i, new_source)
+                        advance(len(result))
+                except BaseException:
+                    for fut in futures:
+                        fut.cancel()
+                    raise
+    except BaseException:
+        journal.close()
+        print(f"Interrupted; finished cells are kept in {journal.path} "
+              f"(rerun with --resume to continue)")
+        raise
+    finally:
+        if bar is not None:
+            bar.close()
+
+    checked = [i for i in translated
+               if i not in reused and i not in resumed and i not in failed_set
+               and cells[i]['cell_type'] == 'markdown'
+               and translated[i] != cells[i]['source']]
+    repaired, invalid = _repair_markdown_cells(cells, translated, checked, dest_language,
+                                               delay, client, workers, max_fix_requests,
+                                               notebook=fname, chunk_tokens=chunk_tokens,
+                                               model=model)
+    for i in repaired:
+        _store(i, translated[i])
+
+    nb.write(out_fname, translated)
+    # Failed cells stay out of the manifest so the next run retries them.
+    _write_manifest(manifest_path,
+                    [None if i in failed_set else h for i, h in enumerate(hashes)],
+                    dest_language, client.backend.cache_tag, model)
+    journal.close(remove=True)
     print(f"Saved translated notebook to: {out_fname}")
+    if failed_set:
+        print(f"Warning: {len(failed_set)} cell{'s' if len(failed_set) != 1 else ''} "
+              f"left untranslated in {out_fname}")
+    if invalid:
+        print(f"Warning: cells {sorted(invalid)} still fail validation in {out_fname}")
+    return {"file": fname, "output": out_fname, "cells": total,
+            "reused": len(reused) - len(borrowed), "shared": len(borrowed),
+            "resumed": len(resumed), "skipped": detected,
+            "excluded": excluded, "failures": len(failed_set),
+            "repaired": len(repaired), "invalid": len(invalid)}
+
+
+def _repair_markdown_cells(cells, translated, indices, dest_language, delay, client,
+                           workers, max_fix_requests, notebook=None, chunk_tokens=0,
+                           model=DEFAULT_MODEL):
+    """
+    Validate translated Markdown cells and re-request only the broken ones.
+
+    At most max_fix_requests cells are sent again, each once, with the
+    problems found added to the prompt.  A new answer replaces the old one
+    only if it has fewer problems.  Returns (repaired indices, indices that
+    still fail validation).
+    """
+    broken = {}
+    for i in indices:
+        problems = validate_markdown_translation(''.join(cells[i]['source']),
+                                                 ''.join(translated[i]))
+        if problems:
+            logging.debug(f"Cell {i} failed validation: {problems}")
+            broken[i] = problems
+    if not broken:
+        return [], []
+
+    to_fix = sorted(broken)[:max(max_fix_requests, 0)]
+
+    def _fix(i):
+        source = ''.join(cells[i]['source'])
+        context = CallMetrics.context(notebook, [i])
+        try:
+            retry = translate_markdown(source, delay=delay, dest_language=dest_language,
+                                       model=model, client=client, problems=broken[i],
+                                       chunk_tokens=chunk_tokens, workers=workers)
+        except BackendError as e:
+            logging.error(f"Re-request for cell {i} failed: {e}")
+            return i, None, broken[i]
+        finally:
+            CallMetrics.reset_context(context)
+        return i, retry, validate_markdown_translation(source, retry)
+
+    repaired = []
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        for i, retry, problems in pool.map(_fix, to_fix):
+            if retry is not None and len(problems) < len(broken[i]):
+                translated[i] = retry.splitlines(True)
+                repaired.append(i)
+                if problems:
+                    broken[i] = problems
+                else:
+                    del broken[i]
+    return repaired, sorted(broken)
+
+
+MULTI_LANGUAGE_MAX_TOKENS = 40
+
+
+def _parse_language_batch_response(raw: str, languages, expected: int):
+    """
+    Decode a {language: [translations]} answer to a multi-language batch.
+
+    Returns the lists of the languages answered with exactly expected
+    non-empty strings; the others are left out.
+    """
+    answer = _decode_json_answer(raw)
+    if not isinstance(answer, dict):
+        return {}
+    return {lang: items for lang, items in answer.items()
+            if lang in languages and isinstance(items, list) and len(items) == expected
+            and all(isinstance(item, str) and item.strip() for item in items)}
+
+
+def pretranslate_languages(cells, dest_languages, client, skip=None,
+                           max_tokens=MULTI_LANGUAGE_MAX_TOKENS, model=DEFAULT_MODEL):
+    """
+    Translate the short code fragments of cells into all dest_languages at once.
+
+    Each request carries up to CODE_BATCH_SIZE fragments and asks for every
+    language that still needs them; the answers go to client.phrasebook,
+    where the per-language runs find them.  Fragments above max_tokens, in
+    cells listed in skip[language], already known, or missing from an
+    answer are left to the normal requests.  Returns the number of
+    translations added.
+    """
+    skip = skip or {}
+    wanted = {}
+    for i, cell in enumerate(cells):
+        if cell['cell_type'] != 'code' or _translate_override(cell) is False:
+            continue
+        for frag in _extract_code_fragments(''.join(cell['source'])):
+            if estimate_tokens(frag.text) > max_tokens:
+                continue
+            wanted.setdefault(frag.text, set()).update(
+                lang for lang in dest_languages
+                if i not in skip.get(lang, ()) and client.recall("code", lang, frag.text) is None)
+    groups = {}
+    for text, langs in wanted.items():
+        # A fragment only one language needs gains nothing from sharing a request.
+        if len(langs) > 1:
+            groups.setdefault(tuple(lang for lang in dest_languages if lang in langs),
+                              []).append(text)
+    if not groups:
+        return 0
+
+    system_msg = client.system_prompt("code_translation_system_prompt_lines",
+                                      "multi_language_batch_instruction_lines")
+    added = 0
+    for langs, texts in groups.items():
+        for start in range(0, len(texts), CODE_BATCH_SIZE):
+            chunk = texts[start:start + CODE_BATCH_SIZE]
+            try:
+                raw = _request_completion(json.dumps(chunk, ensure_ascii=False), system_msg,
+                                          ", ".join(langs), model, temperature=0.7,
+                                          client=client)
+            except BackendError as e:
+                logging.error(f"Multi-language batch of {len(chunk)} fragments failed: {e}")
+                continue
+            for lang, items in _parse_language_batch_response(raw, langs, len(chunk)).items():
+                for text, translation in zip(chunk, items):
+                    client.remember("code", lang, text, translation)
+                    added += 1
+    return added
+
+
+def translate_languages(fname, src_language, dest_languages, delay, client=None,
+                        progress=None, batch_languages=False, **options):
+    """
+    Translate one notebook into several languages in one pass.
+
+    The notebook is read once and its code fragments are extracted once;
+    one thread per language then runs jupyter_translate() on it.  All
+    threads share client, and so its RateLimiter, cache and memory.  Every
+    <name>_<lang>.ipynb is written from the same memory-mapped source.
+
+    With batch_languages=True the short code fragments are first sent for
+    all languages together by pretranslate_languages().  options go to
+    jupyter_translate().  Returns its summaries in the order of
+    dest_languages.
+    """
+    client = client or get_default_client()
+    with NotebookSource(fname) as nb:
+        bar = None
+        if progress is None:
+            from tqdm import tqdm
+            bar = tqdm(total=len(nb.cells) * len(dest_languages),
+                       desc=f"Translating cells into {', '.join(dest_languages)}")
+            lock = threading.Lock()
+
+            def progress(n):
+                with lock:
+                    bar.update(n)
+
+        # Multi-language translations only belong to this run.
+        saved_phrasebook, client.phrasebook = client.phrasebook, dict(client.phrasebook)
+        model = options.get("model", DEFAULT_MODEL)
+        try:
+            if batch_languages and len(dest_languages) > 1 and client.supports_prompts:
+                skip = {}
+                if options.get("incremental", True):
+                    base, ext = os.path.splitext(fname)
+                    hashes = [cell_hash(c) for c in nb.cells]
+                    skip = {lang: _load_reusable_translations(
+                                f"{base}_{lang}.manifest.json", f"{base}_{lang}{ext}",
+                                hashes, lang, client.backend.cache_tag, model).keys()
+                            for lang in dest_languages}
+                pretranslate_languages(nb.cells, dest_languages, client, skip=skip,
+                                       model=model)
+            with ThreadPoolExecutor(max_workers=len(dest_languages)) as pool:
+                futures = [pool.submit(jupyter_translate, fname, src_language, lang, delay,
+                                       client=client, progress=progress, source=nb, **options)
+                           for lang in dest_languages]
+                return [fut.result() for fut in futures]
+        finally:
+            client.phrasebook = saved_phrasebook
+            if bar is not None:
+                bar.close()
+
+
+def find_notebooks(directory, dest_language, recursive=True):
+    """
+    List the notebooks under directory, skipping earlier outputs for dest_language
+    (a language code or a list of them).
+    """
+    languages = [dest_language] if isinstance(dest_language, str) else dest_language
+    walker = os.walk(directory) if recursive else [(directory, [], os.listdir(directory))]
+    paths = []
+    for root, _, files in walker:
+        for fn in sorted(files):
+            if fn.endswith('.ipynb') and not any(fn.endswith(f'_{lang}.ipynb')
+                                                 for lang in languages):
+                paths.append(os.path.join(root, fn))
+    return paths
+
+
+_WORKER_STATE = {}
+
+
+def _init_directory_worker(client_config, progress_queue):
+    _WORKER_STATE["progress"] = progress_queue
+    _WORKER_STATE["client"] = TranslatorClient.from_worker_config(**client_config)
+
+
+def _translate_group(group, src_language, dest_language, delay, client, options,
+                     progress=None):
+    """
+    Translate a notebook and its paired variants; the later ones reuse the first.
+
+    A list of dest_language codes goes through translate_languages().
+    """
+    summaries = []
+    for n, path in enumerate(group):
+        if progress is None:
+            print(f"Translating {path}...")
+        if isinstance(dest_language, str):
+            summaries.append(jupyter_translate(path, src_language, dest_language, delay,
+                                               client=client, progress=progress,
+                                               reuse_from=group[0] if n else None,
+                                               **options))
+        else:
+            summaries.extend(translate_languages(path, src_language, dest_language, delay,
+                                                 client=client, progress=progress,
+                                                 reuse_from=group[0] if n else None,
+                                                 **options))
+    return summaries
+
+
+def _translate_in_worker(group, src_language, dest_language, delay, options):
+    queue = _WORKER_STATE["progress"]
+    return _translate_group(group, src_language, dest_language, delay,
+                            _WORKER_STATE["client"], options, progress=queue.put)
+
+
+def _translate_with_processes(groups, src_language, dest_language, delay,
+                              jobs, client, options):
+    total_cells = 0
+    for path in (p for group in groups for p in group):
+        with NotebookSource(path) as nb:
+            total_cells += len(nb.cells)
+    if not isinstance(dest_language, str):
+        total_cells *= len(dest_language)
+
+    from concurrent.futures import ProcessPoolExecutor
+    from tqdm import tqdm
+    manager = multiprocessing.Manager()
+    queue = manager.Queue()
+    summaries = []
+
+    def _drain(bar):
+        while not queue.empty():
+            bar.update(queue.get())
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_directory_worker,
+                             initargs=(client.worker_config(), queue)) as pool, \
+            tqdm(total=total_cells, desc="Translating notebooks") as bar:
+        futures = {pool.submit(_translate_in_worker, group, src_language, dest_language,
+                               delay, options): group
+                   for group in groups}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=0.2)
+            _drain(bar)
+            for fut in done:
+                try:
+                    summaries.extend(fut.result())
+                except Exception as e:
+                    logging.error(f"Failed to translate {', '.join(futures[fut])}: {e}")
+                    summaries.extend({"file": path, "error": str(e)} for path in futures[fut])
+        _drain(bar)
+    manager.shutdown()
+
+    order = {path: n for n, path in enumerate(p for group in groups for p in group)}
+    return sorted(summaries, key=lambda item: order[item["file"]])
+
+
+_PAIR_SUFFIX_RE = re.compile(r'[_-]?(?:todo|answers?|solutions?)(?=[_.-]|$)', re.IGNORECASE)
+
+
+def pair_notebooks(paths, pair_paths):
+    """
+    Group each notebook with its counterpart from pair_paths.
+
+    Notebooks match when their names are equal after dropping a TODO /
+    answer / solution marker (Chapter03_TODO.ipynb pairs with
+    Chapter03_answer.ipynb).  Returns a list of (path, counterpart) tuples,
+    or 1-tuples for notebooks without one, in the order of paths followed by
+    the unmatched pair_paths.
+    """
+    def key(path):
+        return _PAIR_SUFFIX_RE.sub('', os.path.splitext(os.path.basename(path))[0]).lower()
+
+    partners = {}
+    for path in pair_paths:
+        partners.setdefault(key(path), []).append(path)
+    groups = []
+    for path in paths:
+        match = partners.get(key(path))
+        groups.append((path, match.pop(0)) if match else (path,))
+    groups.extend((path,) for rest in partners.values() for path in rest)
+    return groups
+
+
+def _collect_shared_texts(paths, dest_language, incremental, backend_tag="",
+                          model=DEFAULT_MODEL):
+    """
+    Count the markdown cells and code fragments of all notebooks by normalized text.
+
+    Cells that an incremental run with backend_tag and model would reuse or
+    skip are left out.  Returns
+    {(kind, normalized text): [occurrences, an original text]}.
+    """
+    counts = {}
+    for path in paths:
+        base, ext = os.path.splitext(path)
+        with NotebookSource(path) as nb:
+            cells = nb.cells
+            hashes = [cell_hash(c) for c in cells]
+            reused = {}
+            if incremental:
+                reused = _load_reusable_translations(f"{base}_{dest_language}.manifest.json",
+                                                     f"{base}_{dest_language}{ext}",
+                                                     hashes, dest_language, backend_tag,
+                                                     model)
+            for i, cell in enumerate(cells):
+                if i in reused or _skip_reason(cell, dest_language):
+                    continue
+                text = ''.join(cell['source'])
+                if cell['cell_type'] == 'markdown':
+                    items = [("markdown", text)] if _markdown_needs_translation(text) else []
+                elif cell['cell_type'] == 'code':
+                    items = [("code", f.text) for f in _extract_code_fragments(text)]
+                else:
+                    items = []
+                for kind, item in items:
+                    entry = counts.setdefault((kind, normalize_text(item)), [0, item])
+                    entry[0] += 1
+    return counts
+
+
+def pretranslate_shared_texts(paths, dest_language, delay, client, workers=1,
+                              pack_tokens=0, incremental=True, chunk_tokens=0,
+                              model=DEFAULT_MODEL):
+    """
+    Translate strings that occur more than once across paths, once each.
+
+    Repeated markdown cells and code fragments (TODO blocks, recurring
+    comments, standard print messages) are sent in batches and stored in
+    client.phrasebook, where every notebook then finds them.  Returns the
+    number of (unique, total) repeated strings.
+    """
+    counts = _collect_shared_texts(paths, dest_language, incremental,
+                                   client.backend.cache_tag, model)
+    shared = {key: text for key, (n, text) in counts.items()
+              if n > 1 and client.recall(key[0], dest_language, text) is None}
+    if not shared:
+        return 0, 0
+    occurrences = sum(counts[key][0] for key in shared)
+    print(f"Translating {len(shared)} strings shared by {occurrences} cells/fragments once")
+
+    code = [text for (kind, _), text in shared.items() if kind == "code"]
+    markdown = [text for (kind, _), text in shared.items() if kind == "markdown"]
+    chunks = []
+    if markdown:
+        cells = [{"cell_type": "markdown", "source": [t]} for t in markdown]
+        chunks = [[markdown[i] for i in job] for job in _plan_jobs(cells, pack_tokens)]
+
+    def _markdown_chunk(texts):
+        try:
+            results = translate_markdown_batch(texts, delay=delay,
+                                               dest_language=dest_language, model=model,
+                                               client=client, chunk_tokens=chunk_tokens,
+                                               workers=workers)
+        except BackendError as e:
+            logging.error(f"Shared-string pass skipped {len(texts)} cell(s): {e}")
+            return
+        for text, result in zip(texts, results):
+            client.remember("markdown", dest_language, text, result)
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        pending = [pool.submit(_markdown_chunk, chunk) for chunk in chunks]
+        if code:
+            try:
+                results = translate_code_texts(code, dest_language=dest_language, model=model,
+                                               client=client)
+            except BackendError as e:
+                logging.error(f"Shared-string pass skipped {len(code)} code fragment(s): {e}")
+            else:
+                for text, result in zip(code, results):
+                    client.remember("code", dest_language, text, result)
+        for fut in pending:
+            fut.result()
+    return len(shared), occurrences
+
+
+def print_run_summary(summaries):
+    """
+    Print one line per notebook with time, cells, API usage and failures.
+    """
+    if not summaries:
+        return
+    labels = _summary_labels(summaries)
+    width = max(len(label) for label in labels)
+    print(f"{'Notebook':<{width}}  {'Time':>8}  {'Cells':>6}  {'Skipped':>7}  {'Requests':>8}  "
+          f"{'Tokens':>9}  {'Failures':>8}")
+    for label, item in zip(labels, summaries):
+        if "error" in item:
+            print(f"{label:<{width}}  FAILED: {item['error']}")
+            continue
+        skipped = item.get('skipped', 0) + item.get('excluded', 0)
+        print(f"{label:<{width}}  {item['seconds']:>7.1f}s  {item['cells']:>6}  "
+              f"{skipped:>7}  {item['requests']:>8}  {item['tokens']:>9}  {item['failures']:>8}")
 
 
 def translate_directory(directory, src_language, dest_language, delay,
                         rename_source_file=False, print_translation=False,
-                        recursive=True):
+                        recursive=True, workers=1, client=None, pack_tokens=0,
+                        incremental=True, jobs=1, max_fix_requests=0, resume=False,
+                        dedupe=True, pair_with=None, chunk_tokens=0, batch_languages=False,
+                        model=DEFAULT_MODEL):
+    """
+    Translate every notebook in a directory.
+
+    pair_with names a second directory of variants of the same notebooks
+    (e.g. answer versions of TODO chapters).  Both are translated in one
+    pass: matching notebooks (see pair_notebooks()) are translated one after
+    the other and the second only sends the cells that differ from the first.
+
+    dest_language may be a list of language codes; every notebook is then
+    translated into all of them in one pass by translate_languages(), which
+    also gets batch_languages.
+
+    With dedupe=True, strings repeated across the notebooks are first
+    translated once each (per language) by pretranslate_shared_texts().
+    With jobs > 1 notebooks are handed to that many worker processes, which
+    share the RateLimiter of client and report into one progress bar.
+    Returns the per-notebook summaries.
+    """
     if not os.path.isdir(directory):
         print(f"Error: {directory} is not a valid directory")
         return
 
-    count = 0
-    walker = os.walk(directory) if recursive else [(directory, [], os.listdir(directory))]
-    for root, _, files in walker:
-        for fn in files:
-            if fn.endswith('.ipynb'):
-                path = os.path.join(root, fn)
-                print(f"Translating {path}...")
-                jupyter_translate(path, src_language, dest_language,
-                                  delay,
-                                  rename_source_file,
-                                  print_translation)
-                count += 1
+    paths = find_notebooks(directory, dest_language, recursive)
+    if pair_with:
+        groups = pair_notebooks(paths, find_notebooks(pair_with, dest_language, recursive))
+        paths = [path for group in groups for path in group]
+    else:
+        groups = [(path,) for path in paths]
+    client = client or get_default_client()
+    options = dict(rename_source_file=rename_source_file,
+                   print_translation=print_translation,
+                   workers=workers,
+                   pack_tokens=pack_tokens,
+                   incremental=incremental,
+                   max_fix_requests=max_fix_requests,
+                   resume=resume,
+                   chunk_tokens=chunk_tokens,
+                   model=model)
+    languages = [dest_language] if isinstance(dest_language, str) else list(dest_language)
+    if len(languages) > 1:
+        options["batch_languages"] = batch_languages
+    # The shared strings only belong to this run.
+    saved_phrasebook, client.phrasebook = client.phrasebook, dict(client.phrasebook)
+    try:
+        if dedupe and len(paths) > 1:
+            for language in languages:
+                pretranslate_shared_texts(paths, language, delay, client, workers=workers,
+                                          pack_tokens=pack_tokens, incremental=incremental,
+                                          chunk_tokens=chunk_tokens, model=model)
+        if jobs > 1 and len(groups) > 1:
+            summaries = _translate_with_processes(groups, src_language, dest_language, delay,
+                                                  jobs, client, options)
+        else:
+            summaries = []
+            for group in groups:
+                summaries.extend(_translate_group(group, src_language, dest_language, delay,
+                                                  client, options))
+    finally:
+        client.phrasebook = saved_phrasebook
+
+    count = len(summaries)
     print(f"Translated {count} notebook{'s' if count != 1 else ''}.")
+    print_run_summary(summaries)
+    return summaries
+
+
+TOKENIZERS = ("estimate", "tiktoken")
+
+
+def make_tokenizer(name="estimate", model=DEFAULT_MODEL):
+    """
+    Build a token counting function (text -> int) by name.
+
+    "estimate" is the character heuristic estimate_tokens(); "tiktoken"
+    counts exactly with the encoding of model and needs `pip install tiktoken`.
+    """
+    if name == "estimate":
+        return estimate_tokens
+    if name == "tiktoken":
+        try:
+            import tiktoken
+        except ImportError as e:
+            raise RuntimeError("The tiktoken tokenizer needs the tiktoken package") from e
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("o200k_base")
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    raise ValueError(f"Unknown tokenizer {name!r}; choose from {', '.join(TOKENIZERS)}")
+
+
+def _planned_markdown_requests(texts, known, chunk_tokens=0):
+    """
+    The (prompt names, content) requests translate_markdown_batch() sends for texts.
+    """
+    texts = [t for t in texts if ("markdown", normalize_text(t)) not in known]
+    if len(texts) == 1:
+        requests = []
+        chunks = split_markdown(texts[0], chunk_tokens)
+        for chunk in chunks if len(chunks) == 1 else [c.strip() for c in chunks]:
+            if not _markdown_needs_translation(chunk):
+                continue
+            masked, spans = mask_markdown(chunk)
+            if not _has_translatable_text(masked):
+                continue
+            names = ("translation_system_prompt_lines",)
+            requests.append((names + ("placeholder_instruction_lines",) if spans else names,
+                             masked))
+        return requests
+    if not texts:
+        return []
+    masked = [mask_markdown(t) for t in texts]
+    names = ("translation_system_prompt_lines", "packed_cells_instruction_lines")
+    if any(spans for _, spans in masked):
+        names += ("placeholder_instruction_lines",)
+    return [(names, "\n\n".join(f"{PACK_DELIMITER.format(n)}\n{m}"
+                                  for n, (m, _) in enumerate(masked, 1)))]
+
+
+def _planned_code_requests(texts, known):
+    """
+    The (prompt names, content) requests translate_code_texts() sends for texts.
+    """
+    unique = [t for t in dict.fromkeys(texts) if ("code", normalize_text(t)) not in known]
+    if len(unique) <= 1:
+        return [(("code_translation_system_prompt_lines",), t) for t in unique]
+    names = ("code_translation_system_prompt_lines", "batch_translation_instruction_lines")
+    return [(names, json.dumps(unique[start:start + CODE_BATCH_SIZE], ensure_ascii=False))
+            for start in range(0, len(unique), CODE_BATCH_SIZE)]
+
+
+def _makespan(durations, slots):
+    """
+    Seconds until durations, started in order on the first free of slots, are done.
+    """
+    free = [0.0] * max(slots, 1)
+    for duration in durations:
+        heapq.heapreplace(free, free[0] + duration)
+    return max(free)
+
+
+def estimate_translation(paths, dest_language, pack_tokens=0, workers=1, jobs=1,
+                         incremental=True, dedupe=True, pair_paths=None, rpm=0, tpm=0,
+                         model=DEFAULT_MODEL, tokenizer=None, output_ratio=1.0,
+                         latency=1.0, per_token_latency=0.015, chunk_tokens=0,
+                         backend_tag=""):
+    """
+    Predict the API requests, tokens, cost and wall time of translating paths.
+
+    Nothing is sent: the notebooks are planned exactly as jupyter_translate()
+    and translate_directory() would (incremental reuse, paired notebooks,
+    the shared-string pass, packing, chunking, masking and code fragment
+    batching, skipping cells already in dest_language) and
+    every request is measured with tokenizer (default estimate_tokens(); see
+    make_tokenizer()).  Answers are assumed to be output_ratio times as long
+    as the text sent, and to take latency + per_token_latency seconds per
+    answer token.  Requests are spread over workers threads and jobs
+    processes and slowed down to the rpm / tpm limits.  Only outputs
+    written with model and the backend of cache_tag backend_tag count as
+    reusable.  Cache and translation memory hits and re-requests of invalid
+    cells are not predicted.
+
+    Returns a report with per-notebook summaries (see summarize_calls()),
+    totals, the cost under every model in MODEL_PRICES and the projected
+    wall time.
+    """
+    count = tokenizer or estimate_tokens
+    prompts = {name: "\n".join(lines) for name, lines in get_prompts().items()}
+    if pair_paths:
+        groups = pair_notebooks(paths, pair_paths)
+    else:
+        groups = [(path,) for path in paths]
+    paths = [path for group in groups for path in group]
+
+    def _record(notebook, cells, names, content):
+        system_msg = "\n\n".join(prompts[name] for name in names)
+        prompt_tokens = (count(system_msg)
+                         + count(f"Translate into {dest_language}:\n\n{content}"))
+        completion_tokens = int(count(content) * output_ratio)
+        return CallRecord(notebook, tuple(cells), "+".join(names), model, "off", 0.0,
+                          latency + per_token_latency * completion_tokens, 0,
+                          prompt_tokens, completion_tokens)
+
+    known = set()
+    shared_records = []
+    shared_seconds = 0.0
+    if dedupe and len(paths) > 1:
+        counts = _collect_shared_texts(paths, dest_language, incremental, backend_tag, model)
+        shared = {key: text for key, (n, text) in counts.items() if n > 1}
+        markdown = [text for (kind, _), text in shared.items() if kind == "markdown"]
+        code = [text for (kind, _), text in shared.items() if kind == "code"]
+        cells = [{"cell_type": "markdown", "source": [t]} for t in markdown]
+        chunks = [[_record(None, (), *request) for request in
+                   _planned_markdown_requests([markdown[i] for i in job], known, chunk_tokens)]
+                  for job in _plan_jobs(cells, pack_tokens)]
+        code_records = [_record(None, (), *request)
+                        for request in _planned_code_requests(code, known)]
+        shared_records = [r for chunk in chunks for r in chunk] + code_records
+        # The code batches run on the calling thread next to the markdown pool.
+        shared_seconds = max(_makespan([_makespan([r.latency for r in chunk], workers)
+                                        for chunk in chunks], workers),
+                             sum(r.latency for r in code_records))
+        known = set(shared)
+
+    all_records = list(shared_records)
+    notebooks = []
+    group_seconds = []
+    for group in groups:
+        seconds = 0.0
+        first_hashes = set()
+        for n, path in enumerate(group):
+            base, ext = os.path.splitext(path)
+            with NotebookSource(path) as nb:
+                cells = nb.cells
+                hashes = [cell_hash(c) for c in cells]
+                reused = set()
+                if incremental:
+                    reused.update(_load_reusable_translations(
+                        f"{base}_{dest_language}.manifest.json",
+                        f"{base}_{dest_language}{ext}", hashes, dest_language, backend_tag,
+                        model))
+                if n:
+                    reused.update(i for i, h in enumerate(hashes) if h in first_hashes)
+                else:
+                    first_hashes = set(hashes)
+                skipped = {i for i, cell in enumerate(cells)
+                           if i not in reused and _skip_reason(cell, dest_language)}
+                skip = reused | skipped
+                records, durations = [], []
+                for job in _plan_jobs(cells, pack_tokens, skip=skip):
+                    texts = [''.join(cells[i]['source']) for i in job]
+                    # Chunks of one markdown cell run up to workers at a time,
+                    # code batches in turn.
+                    concurrent = cells[job[0]]['cell_type'] == 'markdown'
+                    if concurrent:
+                        requests = _planned_markdown_requests(texts, known, chunk_tokens)
+                    elif cells[job[0]]['cell_type'] == 'code' and texts[0].strip():
+                        requests = _planned_code_requests(
+                            [f.text for f in _extract_code_fragments(texts[0])], known)
+                    else:
+                        requests = []
+                    job_records = [_record(path, job, *request) for request in requests]
+                    records.extend(job_records)
+                    all_records.extend(job_records)
+                    latencies = [r.latency for r in job_records]
+                    durations.append(_makespan(latencies, workers) if concurrent
+                                     else sum(latencies))
+            notebook_seconds = _makespan(durations, workers)
+            seconds += notebook_seconds
+            summary = summarize_calls(records, notebook_seconds)
+            summary.update(file=path, cells=len(cells), reused=len(reused),
+                           skipped=len(skipped),
+                           seconds=round(notebook_seconds, 1))
+            notebooks.append(summary)
+        group_seconds.append(seconds)
+
+    seconds = shared_seconds + _makespan(group_seconds, jobs if len(groups) > 1 else 1)
+    total = summarize_calls(all_records, seconds)
+    total["tokens"] = total["prompt_tokens"] + total["completion_tokens"]
+    if rpm:
+        seconds = max(seconds, total["requests"] * 60.0 / rpm)
+    if tpm:
+        seconds = max(seconds, total["tokens"] * 60.0 / tpm)
+    total["seconds"] = round(seconds, 1)
+    total["cost_usd"] = {name: round((total["prompt_tokens"] * price[0]
+                                      + total["completion_tokens"] * price[1]) / 1e6, 4)
+                         for name, price in MODEL_PRICES.items()}
+    return {"model": model, "notebooks": notebooks,
+            "shared": dict(summarize_calls(shared_records, shared_seconds),
+                           strings=len(known), seconds=round(shared_seconds, 1)),
+            "total": total}
+
+
+def print_estimate(report):
+    """
+    Print the per-notebook table and totals of an estimate_translation() report.
+    """
+    total = report["total"]
+    notebooks = report["notebooks"]
+    width = max([len(item["file"]) for item in notebooks] + [len("Shared strings")])
+    print(f"{'Notebook':<{width}}  {'Cells':>6}  {'Reused':>6}  {'Skipped':>7}  {'Requests':>8}  "
+          f"{'In tokens':>9}  {'Out tokens':>10}  {'Time':>8}")
+    rows = notebooks
+    if report["shared"]["requests"]:
+        rows = [dict(report["shared"], file="Shared strings", cells=report["shared"]["strings"],
+                     reused=0, skipped=0)] + notebooks
+    for item in rows:
+        print(f"{item['file']:<{width}}  {item['cells']:>6}  {item['reused']:>6}  "
+              f"{item['skipped']:>7}  "
+              f"{item['requests']:>8}  {item['prompt_tokens']:>9}  "
+              f"{item['completion_tokens']:>10}  {item['seconds']:>7.1f}s")
+    print(f"Expected: {total['requests']} requests, {total['prompt_tokens']} input + "
+          f"{total['completion_tokens']} output tokens, about {total['seconds']:.0f}s wall time")
+    price = total["cost_usd"].get(report["model"])
+    if price is not None:
+        print(f"Cost with {report['model']}: ${price:.2f}")
+    others = ", ".join(f"{name} ${cost:.2f}" for name, cost in total["cost_usd"].items()
+                       if name != report["model"])
+    if others:
+        print(f"Other models: {others}")
 
 
 def main():
@@ -302,28 +3489,212 @@ def main():
     )
     parser.add_argument('fname', help="Notebook file or directory")
     parser.add_argument('--source', default='auto', help="Source language code")
-    parser.add_argument('--target', required=True, help="Destination language code")
-    parser.add_argument('--delay', type=int, default=10, help="API retry delay (s)")
+    parser.add_argument('--target', required=True,
+                        help="Destination language code, or several separated by commas "
+                             "(e.g. ja,ko,zh,es) to translate into all of them in one pass")
+    parser.add_argument('--delay', type=int, default=10,
+                        help="Pause after a rate limit error without a Retry-After hint (s)")
     parser.add_argument('--print', dest='print_translation',
                         action='store_true', help="Print translations")
     parser.add_argument('--directory', action='store_true',
                         help="Process all .ipynb in directory")
     parser.add_argument('--no-recursive', dest='recursive',
                         action='store_false', help="Disable subdirs")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of cells translated concurrently")
+    parser.add_argument('--cache', default=DEFAULT_CACHE_PATH,
+                        help="Translation cache file (SQLite)")
+    parser.add_argument('--cache-size', type=int, default=256,
+                        help="Maximum cache size in MB before LRU eviction")
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+                        help="Always call the API, ignoring the cache")
+    parser.add_argument('--memory', default=DEFAULT_MEMORY_PATH,
+                        help="Translation memory of earlier Markdown cells (SQLite file)")
+    parser.add_argument('--no-memory', dest='use_memory', action='store_false',
+                        help="Do not look up or store similar cells")
+    parser.add_argument('--memory-reuse', type=float, default=None,
+                        help="Similarity from which a remembered translation is reused as is "
+                             "(default: only for the same text)")
+    parser.add_argument('--memory-reference', type=float, default=0.6,
+                        help="Similarity from which a remembered translation is sent "
+                             "as a reference")
+    parser.add_argument('--timeout', type=int, default=120,
+                        help="Timeout for one API request (s)")
+    parser.add_argument('--backend', choices=BACKENDS, default='openai',
+                        help="Translation service; 'stub' runs a local offline "
+                             "OpenAI-compatible server, 'fake' echoes in process")
+    parser.add_argument('--model', default=DEFAULT_MODEL,
+                        help="Chat model to translate with (OpenAI and stub backends)")
+    parser.add_argument('--api-base', default=None,
+                        help="Base URL of an OpenAI-compatible API")
+    parser.add_argument('--stub-latency', type=float, default=0.0,
+                        help="Seconds the stub/fake backend waits before answering")
+    parser.add_argument('--stub-error-rate', type=float, default=0.0,
+                        help="Share of stub/fake backend requests that fail")
+    parser.add_argument('--pack-tokens', type=int, default=1000,
+                        help="Token budget for packing short Markdown cells "
+                             "into one request (0 disables packing)")
+    parser.add_argument('--chunk-tokens', type=int, default=500,
+                        help="Split Markdown cells above this token estimate into chunks "
+                             "translated in parallel (0 disables splitting)")
+    parser.add_argument('--full', dest='incremental', action='store_false',
+                        help="Retranslate every cell, ignoring the previous output")
+    parser.add_argument('--report', default=None, metavar='FILE',
+                        help="Write per-call latency, token and cost statistics as JSON")
+    parser.add_argument('--prometheus', default=None, metavar='FILE',
+                        help="Write the same statistics in Prometheus text format")
+    parser.add_argument('--batch-languages', action='store_true',
+                        help="With several targets, translate short code comments and "
+                             "messages into all languages in shared requests")
+    parser.add_argument('--estimate', action='store_true',
+                        help="Only predict requests, tokens, cost and time; send nothing")
+    parser.add_argument('--tokenizer', choices=TOKENIZERS, default='estimate',
+                        help="Token counter for --estimate ('tiktoken' needs the "
+                             "tiktoken package)")
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue an interrupted run from its checkpoint journal")
+    parser.add_argument('--no-stream', dest='stream', action='store_false',
+                        help="Wait for whole completions instead of streaming them")
+    parser.add_argument('--max-fix-requests', type=int, default=20,
+                        help="Per notebook, how many cells that fail the structure "
+                             "check may be translated again")
+    parser.add_argument('--pair-with', default=None, metavar='DIR',
+                        help="In directory mode, translate the matching notebooks of DIR "
+                             "(e.g. answer versions) in the same pass, sending only the "
+                             "cells that differ")
+    parser.add_argument('--no-dedupe', dest='dedupe', action='store_false',
+                        help="In directory mode, do not translate repeated strings "
+                             "once up front")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="Number of notebooks translated in parallel processes")
+    parser.add_argument('--rpm', type=int, default=0,
+                        help="Maximum API requests per minute across all workers "
+                             "(0 = unlimited)")
+    parser.add_argument('--tpm', type=int, default=0,
+                        help="Maximum API tokens per minute across all workers "
+                             "(0 = unlimited)")
     parser.set_defaults(recursive=True)
 
     args = parser.parse_args()
+    configure_logging()
+    load_env()
     src = args.source.lower()
-    tgt = args.target.lower()
-    print(f"Translating from {src} to {tgt}")
+    targets = [t.strip() for t in args.target.lower().split(',') if t.strip()]
+    tgt = targets[0] if len(targets) == 1 else targets
+
+    if args.estimate:
+        if args.directory or os.path.isdir(args.fname):
+            paths = find_notebooks(args.fname, tgt, args.recursive)
+            pair_paths = (find_notebooks(args.pair_with, tgt, args.recursive)
+                          if args.pair_with else None)
+        else:
+            paths, pair_paths = [args.fname], None
+        tokenizer = make_tokenizer(args.tokenizer, args.model)
+        backend_tag = {"google": GoogleTransBackend.cache_tag, "stub": "stub",
+                       "fake": FakeBackend.cache_tag}.get(args.backend, args.api_base or "")
+        reports = {}
+        for language in targets:
+            if len(targets) > 1:
+                print(f"\nInto {language}:")
+            reports[language] = estimate_translation(
+                paths, language, pack_tokens=args.pack_tokens, workers=args.workers,
+                jobs=args.jobs, incremental=args.incremental, dedupe=args.dedupe,
+                pair_paths=pair_paths, rpm=args.rpm, tpm=args.tpm,
+                chunk_tokens=args.chunk_tokens, tokenizer=tokenizer, backend_tag=backend_tag,
+                model=args.model)
+            print_estimate(reports[language])
+        if args.report:
+            with open(args.report, 'w', encoding='utf-8') as f:
+                json.dump(reports[tgt] if len(targets) == 1 else reports, f, indent=1,
+                          ensure_ascii=False)
+        return
 
+    print(f"Translating from {src} to {', '.join(targets)}")
+
+    cache = None
+    if args.use_cache:
+        cache = TranslationCache(os.path.expanduser(args.cache),
+                                 max_bytes=args.cache_size * 1024 * 1024)
+    backend_options = {}
+    if args.backend in ("openai", "stub"):
+        backend_options = dict(timeout=args.timeout,
+                               pool_size=max(args.workers, 1) * len(targets),
+                               stream=args.stream)
+    if args.backend == "openai" and args.api_base:
+        backend_options["api_base"] = args.api_base
+    if args.backend in ("stub", "fake"):
+        backend_options.update(latency=args.stub_latency, error_rate=args.stub_error_rate)
+    memory = None
+    if args.use_memory:
+        memory = TranslationMemory(os.path.expanduser(args.memory),
+                                   reuse_threshold=args.memory_reuse,
+                                   reference_threshold=args.memory_reference)
+    client = TranslatorClient(backend=make_backend(args.backend, **backend_options),
+                              cache=cache,
+                              limiter=RateLimiter(args.rpm, args.tpm, retry_delay=args.delay),
+                              memory=memory)
+
+    run_started = time.time()
     if args.directory or os.path.isdir(args.fname):
-        translate_directory(args.fname, src, tgt, args.delay,
-                            print_translation=args.print_translation,
-                            recursive=args.recursive)
+        summaries = translate_directory(args.fname, src, tgt, args.delay,
+                                        print_translation=args.print_translation,
+                                        recursive=args.recursive,
+                                        workers=args.workers,
+                                        client=client,
+                                        pack_tokens=args.pack_tokens,
+                                        incremental=args.incremental,
+                                        jobs=args.jobs,
+                                        max_fix_requests=args.max_fix_requests,
+                                        resume=args.resume,
+                                        dedupe=args.dedupe,
+                                        pair_with=args.pair_with,
+                                        chunk_tokens=args.chunk_tokens,
+                                        batch_languages=args.batch_languages,
+                                        model=args.model)
+    elif len(targets) > 1:
+        summaries = translate_languages(args.fname, src, targets, args.delay,
+                                        print_translation=args.print_translation,
+                                        workers=args.workers,
+                                        client=client,
+                                        pack_tokens=args.pack_tokens,
+                                        incremental=args.incremental,
+                                        max_fix_requests=args.max_fix_requests,
+                                        resume=args.resume,
+                                        chunk_tokens=args.chunk_tokens,
+                                        batch_languages=args.batch_languages,
+                                        model=args.model)
     else:
-        jupyter_translate(args.fname, src, tgt, args.delay,
-                          print_translation=args.print_translation)
+        summaries = [jupyter_translate(args.fname, src, tgt, args.delay,
+                                       print_translation=args.print_translation,
+                                       workers=args.workers,
+                                       client=client,
+                                       pack_tokens=args.pack_tokens,
+                                       incremental=args.incremental,
+                                       max_fix_requests=args.max_fix_requests,
+                                       resume=args.resume,
+                                       chunk_tokens=args.chunk_tokens,
+                                       model=args.model)]
+
+    if args.report or args.prometheus:
+        # Calls outside any notebook, e.g. the shared-string pass of a directory run.
+        extra = [r for r in client.metrics.records if r.notebook is None]
+        report = build_run_report(summaries or [], extra, time.time() - run_started)
+        if args.report:
+            with open(args.report, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=1, ensure_ascii=False)
+        if args.prometheus:
+            with open(args.prometheus, 'w', encoding='utf-8') as f:
+                f.write(format_prometheus(report))
+
+    if cache is not None:
+        st = cache.stats()
+        print(f"Cache: {st['hits']} hits, {st['misses']} misses, "
+              f"{st['evictions']} evictions")
+    if memory is not None:
+        st = memory.stats()
+        print(f"Translation memory: {st['reused']} reused, {st['referenced']} referenced, "
+              f"{st['segments']} segments")
+    client.close()
 
 
 if __name__ == '__main__':
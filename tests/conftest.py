@@ -1,6 +1,8 @@
 import pytest
 import sys
 import os
+import json
+from unittest.mock import patch
 
 # Add the parent directory to the path so we can import jupyter_translate in all tests
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -13,6 +15,59 @@ def disable_network_calls(monkeypatch):
     """
     def mock_sleep(*args, **kwargs):
         pass
-    
+
     # Patch sleep function to speed up tests
-    monkeypatch.setattr('time.sleep', mock_sleep) 
\ No newline at end of file
+    monkeypatch.setattr('time.sleep', mock_sleep)
+
+
+@pytest.fixture
+def write_notebook(tmp_path):
+    """
+    Write a list of cells as a minimal nbformat 4 notebook under tmp_path.
+
+    Call it as write_notebook("name.ipynb", cells); returns the path as a string.
+    """
+    def _write(name, cells):
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        notebook = {"cells": cells, "metadata": {}, "nbformat": 4, "nbformat_minor": 4}
+        path.write_text(json.dumps(notebook), encoding='utf-8')
+        return str(path)
+    return _write
+
+
+class RecordingRequest:
+    """
+    Stand-in for jupyter_translate._request_completion that records every request.
+
+    sent holds the contents and calls the (content, system_msg, dest_language)
+    of each request.  By default a text comes back as "<text>" and a JSON list
+    of code fragments as a list of "<fragment>"; set answer to a function of
+    (content, dest_language) for other replies.
+    """
+
+    def __init__(self):
+        self.sent = []
+        self.calls = []
+        self.answer = self.wrap
+
+    @staticmethod
+    def wrap(content, dest_language):
+        if content.startswith("["):
+            return json.dumps([f"<{t}>" for t in json.loads(content)], ensure_ascii=False)
+        return f"<{content.strip()}>"
+
+    def __call__(self, content, system_msg, dest_language, model, temperature, client=None):
+        self.sent.append(content)
+        self.calls.append((content, system_msg, dest_language))
+        return self.answer(content, dest_language)
+
+
+@pytest.fixture
+def fake_request():
+    """
+    Patch jupyter_translate._request_completion with a RecordingRequest and return it.
+    """
+    recorder = RecordingRequest()
+    with patch('jupyter_translate._request_completion', side_effect=recorder):
+        yield recorder
@@ -296,4 +296,448 @@ class TestJupyterTranslateIntegration:
             # Verify translate_directory was called with recursive=False
             assert mock_translate_directory.called
             args, kwargs = mock_translate_directory.call_args
-            assert kwargs['recursive'] is False 
\ No newline at end of file
+            assert kwargs['recursive'] is False 
+
+class TestConcurrentTranslation:
+    @pytest.fixture
+    def many_cells_notebook(self, write_notebook):
+        """Notebook with enough markdown cells to exercise the worker pool"""
+        return write_notebook("many.ipynb", [
+            {"cell_type": "markdown", "metadata": {}, "source": [f"Cell {i}\n"]}
+            for i in range(20)
+        ])
+
+    def test_workers_keep_cell_order(self, many_cells_notebook):
+        """Results from the thread pool are written back in original order"""
+        import random
+        import time as _time
+
+        def fake_translate(text, *_, **kwargs):
+            _time.sleep(random.random() / 100)
+            return text.replace("Cell", "Celula")
+
+        with patch('jupyter_translate.translate_markdown', side_effect=fake_translate):
+            jupyter_translate.jupyter_translate(many_cells_notebook, 'en', 'pt', 0,
+                                                workers=8)
+
+        out_path = many_cells_notebook.replace(".ipynb", "_pt.ipynb")
+        with open(out_path, encoding='utf-8') as f:
+            nb = json.load(f)
+        assert [c['source'] for c in nb['cells']] == [[f"Celula {i}\n"] for i in range(20)]
+
+
+
+class TestWholeCodeCells:
+    def test_multiline_docstring_translated_as_one_unit(self, tmp_path, write_notebook,
+                                                        fake_request):
+        source = ['def area(r):\n', '    """\n', '    Area of a circle\n',
+                  '    with radius r.\n', '    """\n', '    return 3.14 * r * r  # approx']
+        path = write_notebook("code.ipynb", [{"cell_type": "code", "metadata": {}, "outputs": [],
+                                              "execution_count": None, "source": source}])
+        fake_request.answer = lambda content, lang: json.dumps(["円の面積\n半径 r", "近似"],
+                                                               ensure_ascii=False)
+
+        jupyter_translate.jupyter_translate(path, 'en', 'ja', 0)
+
+        assert len(fake_request.sent) == 1
+        assert json.loads(fake_request.sent[0]) == ["Area of a circle\nwith radius r.", "approx"]
+        out = json.loads((tmp_path / "code_ja.ipynb").read_text(encoding='utf-8'))
+        assert out["cells"][0]["source"] == [
+            'def area(r):\n', '    """\n', '    円の面積\n', '    半径 r\n', '    """\n',
+            '    return 3.14 * r * r  # 近似']
+
+
+class TestIncrementalRetranslation:
+    def test_only_changed_cells_are_retranslated(self, tmp_path, write_notebook):
+        cells = [{"cell_type": "markdown", "metadata": {}, "source": [f"Cell {i}\n"]}
+                 for i in range(5)]
+        path = write_notebook("chapter.ipynb", cells)
+
+        def fake_translate(text, *_, **kwargs):
+            return text.replace("Cell", "Celula")
+
+        with patch('jupyter_translate.translate_markdown', side_effect=fake_translate) as tm:
+            jupyter_translate.jupyter_translate(path, 'en', 'pt', 0)
+        assert tm.call_count == 5
+        assert (tmp_path / "chapter_pt.manifest.json").exists()
+
+        cells[2]["source"] = ["Cell two, edited\n"]
+        write_notebook("chapter.ipynb", cells)
+
+        with patch('jupyter_translate.translate_markdown', side_effect=fake_translate) as tm:
+            jupyter_translate.jupyter_translate(path, 'en', 'pt', 0)
+        assert tm.call_count == 1
+        assert tm.call_args[0][0] == "Cell two, edited\n"
+
+        out = json.loads((tmp_path / "chapter_pt.ipynb").read_text(encoding='utf-8'))
+        assert [c["source"] for c in out["cells"]] == [
+            ["Celula 0\n"], ["Celula 1\n"], ["Celula two, edited\n"], ["Celula 3\n"], ["Celula 4\n"]
+        ]
+
+    def test_output_of_another_backend_is_not_reused(self, tmp_path, write_notebook,
+                                                      fake_request):
+        path = write_notebook("chapter.ipynb", [
+            {"cell_type": "markdown", "metadata": {}, "source": [f"Cell {i}\n"]} for i in range(2)
+        ])
+        # An offline run (answers echo the English text) writes the first output.
+        fake_request.answer = lambda content, lang: content
+        offline = jupyter_translate.TranslatorClient(backend=jupyter_translate.FakeBackend())
+        jupyter_translate.jupyter_translate(path, 'en', 'ja', 0, client=offline)
+        fake_request.sent.clear()
+        fake_request.answer = fake_request.wrap
+
+        summary = jupyter_translate.jupyter_translate(path, 'en', 'ja', 0)
+
+        assert summary["reused"] == 0
+        assert sorted(fake_request.sent) == ["Cell 0\n", "Cell 1\n"]
+        out = json.loads((tmp_path / "chapter_ja.ipynb").read_text(encoding='utf-8'))
+        assert [c["source"] for c in out["cells"]] == [["<Cell 0>\n"], ["<Cell 1>\n"]]
+
+    def test_output_of_another_model_is_not_reused(self, tmp_path, write_notebook,
+                                                    fake_request):
+        path = write_notebook("chapter.ipynb", [
+            {"cell_type": "markdown", "metadata": {}, "source": [f"Cell {i}\n"]} for i in range(2)
+        ])
+        jupyter_translate.jupyter_translate(path, 'en', 'ja', 0)
+        fake_request.sent.clear()
+
+        summary = jupyter_translate.jupyter_translate(path, 'en', 'ja', 0, model="gpt-4.1")
+        rerun = jupyter_translate.jupyter_translate(path, 'en', 'ja', 0, model="gpt-4.1")
+
+        assert summary["reused"] == 0
+        assert sorted(fake_request.sent) == ["Cell 0\n", "Cell 1\n"]
+        assert rerun["reused"] == 2
+        manifest = json.loads((tmp_path / "chapter_ja.manifest.json").read_text(encoding='utf-8'))
+        assert manifest["model"] == "gpt-4.1"
+
+
+class TestParallelDirectoryTranslation:
+    def test_jobs_translate_every_notebook_with_summary(self, tmp_path, monkeypatch,
+                                                       write_notebook):
+        for i in range(3):
+            write_notebook(f"chapter_{i}.ipynb", [
+                {"cell_type": "markdown", "metadata": {}, "source": ["Hello\n"]},
+                {"cell_type": "code", "metadata": {}, "outputs": [], "source": ["# comment"]},
+            ])
+
+        monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+        response = MagicMock()
+        response.choices[0].message.content = "Hola"
+        response.usage.total_tokens = 7
+
+        with patch('jupyter_translate.openai.ChatCompletion.create', return_value=response):
+            summaries = jupyter_translate.translate_directory(
+                str(tmp_path), 'en', 'es', 0, jobs=2, dedupe=False)
+
+        assert [os.path.basename(s["file"]) for s in summaries] == [
+            f"chapter_{i}.ipynb" for i in range(3)]
+        for summary in summaries:
+            assert summary["cells"] == 2
+            assert summary["failures"] == 0
+            assert summary["requests"] == 2
+            assert summary["tokens"] == 14
+            assert os.path.exists(summary["output"])
+
+
+class TestSharedStringDedupe:
+    def test_repeated_strings_are_translated_once(self, tmp_path, write_notebook, fake_request):
+        for i in range(3):
+            write_notebook(f"ch{i}.ipynb", [
+                {"cell_type": "markdown", "metadata": {}, "source": ["Watch the video!\n"]},
+                {"cell_type": "markdown", "metadata": {}, "source": [f"Chapter {i} intro"]},
+                {"cell_type": "code", "metadata": {}, "outputs": [],
+                 "source": ["x = f(x)  # shape  check\n", f"print('step {i}')"]},
+            ])
+
+        client = jupyter_translate.TranslatorClient(
+            backend=jupyter_translate.OpenAIBackend(api_key="sk-test"))
+        try:
+            jupyter_translate.translate_directory(str(tmp_path), 'en', 'ja', 0,
+                                                  client=client, pack_tokens=0)
+        finally:
+            client.close()
+
+        sent = [t for content in fake_request.sent
+                for t in (json.loads(content) if content.startswith("[") else [content])]
+
+        assert sent.count("Watch the video!\n") + sent.count("Watch the video!") == 1
+        assert sum("shape" in t for t in sent) == 1
+        assert client.phrasebook == {}
+        for i in range(3):
+            out = json.loads((tmp_path / f"ch{i}_ja.ipynb").read_text(encoding='utf-8'))
+            assert out["cells"][0]["source"] == ["<Watch the video!>\n"]
+            assert out["cells"][2]["source"] == ["x = f(x)  # <shape  check>\n",
+                                                 f"print('<step {i}>')"]
+
+
+
+class TestPairedDirectories:
+    def test_answer_notebook_only_sends_differing_cells(self, tmp_path, write_notebook,
+                                                        fake_request):
+        def cells(solution):
+            return [
+                {"cell_type": "markdown", "metadata": {}, "source": ["Intro\n"]},
+                {"cell_type": "code", "metadata": {}, "outputs": [], "source": [solution]},
+                {"cell_type": "markdown", "metadata": {}, "source": ["Outro"]},
+            ]
+        write_notebook("todo/Chapter01_TODO.ipynb", cells("# TODO: write it"))
+        write_notebook("answer/Chapter01_answer.ipynb", cells("y = x  # the answer"))
+
+        summaries = jupyter_translate.translate_directory(
+            str(tmp_path / "todo"), 'en', 'ja', 0, pair_with=str(tmp_path / "answer"))
+
+        assert [os.path.basename(s["file"]) for s in summaries] == [
+            "Chapter01_TODO.ipynb", "Chapter01_answer.ipynb"]
+        assert summaries[1]["shared"] == 2
+        assert sorted(fake_request.sent) == sorted(["Intro\n", "write it", "Outro", "the answer"])
+        out = json.loads((tmp_path / "answer" / "Chapter01_answer_ja.ipynb").read_text(
+            encoding='utf-8'))
+        assert [c["source"] for c in out["cells"]] == [
+            ["<Intro>\n"], ["y = x  # <the answer>"], ["<Outro>"]]
+
+
+class TestLanguageSkip:
+    def test_cells_already_in_target_language_are_not_sent(self, tmp_path, write_notebook,
+                                                           fake_request):
+        english = "All:\nWe know it, and you know it too, so speak.\n"
+        path = write_notebook("mixed.ipynb", [
+            {"cell_type": "markdown", "metadata": {}, "source": ["これは日本語のセルです。\n"]},
+            {"cell_type": "markdown", "metadata": {}, "source": [english]},
+            {"cell_type": "markdown", "metadata": {"jupyter_translate": {"translate": True}},
+             "source": [english]},
+            {"cell_type": "markdown", "metadata": {"jupyter_translate": {"translate": False}},
+             "source": ["このセルはそのまま残します。"]},
+        ])
+
+        summary = jupyter_translate.jupyter_translate(path, 'ja', 'en', 0)
+
+        assert sorted(fake_request.sent) == sorted(["これは日本語のセルです。\n", english])
+        assert summary["skipped"] == 1 and summary["excluded"] == 1
+        out = json.loads((tmp_path / "mixed_en.ipynb").read_text(encoding='utf-8'))
+        assert [c["source"] for c in out["cells"]] == [
+            ["<これは日本語のセルです。>\n"], [english], ["<All:\n", "We know it, and you know it too, so speak.>\n"],
+            ["このセルはそのまま残します。"]]
+
+
+class TestMultipleTargets:
+    CELLS = [
+        {"cell_type": "markdown", "metadata": {}, "source": ["# Intro\n", "Hello there\n"]},
+        {"cell_type": "code", "metadata": {}, "outputs": [],
+         "source": ["x = 1  # set x\n", "print('done')"]},
+        {"cell_type": "markdown", "metadata": {}, "source": ["Bye"]},
+    ]
+
+    def test_every_language_is_written_with_its_own_summary(self, tmp_path, write_notebook):
+        path = write_notebook("nb.ipynb", self.CELLS)
+        client = jupyter_translate.TranslatorClient(backend=jupyter_translate.FakeBackend())
+        try:
+            summaries = jupyter_translate.translate_languages(path, 'en', ['ja', 'ko', 'es'],
+                                                             0, client=client, workers=2)
+        finally:
+            client.close()
+
+        assert [s["language"] for s in summaries] == ['ja', 'ko', 'es']
+        # Concurrent languages must not count each other's requests.
+        assert [s["requests"] for s in summaries] == [3, 3, 3]
+        assert all(len(s["calls"]) == 3 for s in summaries)
+        assert client.usage.snapshot()[0] == 9
+        for lang in ('ja', 'ko', 'es'):
+            assert (tmp_path / f"nb_{lang}.ipynb").exists()
+            assert (tmp_path / f"nb_{lang}.manifest.json").exists()
+        assert jupyter_translate.find_notebooks(str(tmp_path), ['ja', 'ko', 'es']) == [path]
+
+    def test_short_fragments_share_one_request_across_languages(self, tmp_path, write_notebook,
+                                                                fake_request):
+        path = write_notebook("nb.ipynb", self.CELLS)
+
+        def answer(content, dest_language):
+            if content.startswith("["):
+                items = json.loads(content)
+                return json.dumps({lang: [f"{lang}:{t}" for t in items]
+                                   for lang in dest_language.split(", ")})
+            return f"{dest_language}:{content.strip()}"
+
+        fake_request.answer = answer
+        jupyter_translate.translate_languages(path, 'en', ['ja', 'ko'], 0,
+                                              batch_languages=True, pack_tokens=0)
+
+        sent = [(lang, content) for content, _, lang in fake_request.calls]
+        assert ("ja, ko", json.dumps(["set x", "done"])) in sent
+        assert not [c for lang, c in sent if lang in ("ja", "ko") and c.startswith("[")]
+        for lang in ('ja', 'ko'):
+            out = json.loads((tmp_path / f"nb_{lang}.ipynb").read_text(encoding='utf-8'))
+            assert out["cells"][1]["source"] == [f"x = 1  # {lang}:set x\n",
+                                                 f"print('{lang}:done')"]
+            assert out["cells"][2]["source"] == [f"{lang}:Bye"]
+
+
+class TestStubBackend:
+    def test_notebook_round_trip_through_stub_server(self, tmp_path, write_notebook):
+        cells = [
+            {"cell_type": "markdown", "metadata": {}, "source": [f"Paragraph {i}\n"]}
+            for i in range(6)
+        ] + [
+            {"cell_type": "code", "metadata": {}, "outputs": [],
+             "source": ["# first\n", "x = 1  # second"]}
+        ]
+        path = write_notebook("offline.ipynb", cells)
+
+        backend = jupyter_translate.make_backend("stub", error_rate=0.3, seed=1)
+        client = jupyter_translate.TranslatorClient(
+            backend=backend, limiter=jupyter_translate.RateLimiter(retry_delay=0))
+        try:
+            summary = jupyter_translate.jupyter_translate(
+                path, 'en', 'ja', 0, workers=4, client=client, pack_tokens=20)
+        finally:
+            client.close()
+
+        assert summary["failures"] == 0
+        assert backend.stub_server.requests > summary["requests"]  # some were retried
+        out = json.loads((tmp_path / "offline_ja.ipynb").read_text(encoding='utf-8'))
+        assert [c["source"] for c in out["cells"]] == [c["source"] for c in cells]
+
+    def test_unknown_backend(self):
+        with pytest.raises(ValueError):
+            jupyter_translate.make_backend("carrier-pigeon")
+
+    def test_streamed_completions(self):
+        backend = jupyter_translate.make_backend("stub", stream=True)
+        client = jupyter_translate.TranslatorClient(backend=backend)
+        try:
+            text = "First line\nSecond line"
+            assert client.complete(text, "sys", "ja", "stub", 1.0) == text
+            assert client.usage.snapshot()[1] > 0
+        finally:
+            client.close()
+
+
+class TestCheckpointResume:
+    def test_interrupted_run_resumes_from_journal(self, tmp_path, write_notebook):
+        path = write_notebook("long.ipynb", [
+            {"cell_type": "markdown", "metadata": {}, "source": [f"Cell {i}"]} for i in range(5)
+        ])
+        journal = tmp_path / "long_ja.journal.jsonl"
+        calls = []
+
+        def crash_on_cell_3(text, *_, **kwargs):
+            if text == "Cell 3":
+                raise KeyboardInterrupt
+            calls.append(text)
+            return text.replace("Cell", "セル")
+
+        with patch('jupyter_translate.translate_markdown', side_effect=crash_on_cell_3):
+            with pytest.raises(KeyboardInterrupt):
+                jupyter_translate.jupyter_translate(path, 'en', 'ja', 0)
+        assert journal.exists()
+        assert not (tmp_path / "long_ja.ipynb").exists()
+
+        calls.clear()
+        with patch('jupyter_translate.translate_markdown',
+                   side_effect=lambda text, *_, **kw: calls.append(text) or text.replace("Cell", "セル")):
+            summary = jupyter_translate.jupyter_translate(path, 'en', 'ja', 0, resume=True)
+
+        assert calls == ["Cell 3", "Cell 4"]
+        assert summary["resumed"] == 3
+        assert not journal.exists()
+        out = json.loads((tmp_path / "long_ja.ipynb").read_text(encoding='utf-8'))
+        assert [c["source"] for c in out["cells"]] == [[f"セル {i}"] for i in range(5)]
+
+    def test_journal_of_another_backend_is_ignored(self, tmp_path, write_notebook,
+                                                   fake_request):
+        path = write_notebook("long.ipynb", [
+            {"cell_type": "markdown", "metadata": {}, "source": [f"Cell {i}"]} for i in range(3)
+        ])
+        def echo_until_cell_2(content, lang):
+            if content == "Cell 2":
+                raise KeyboardInterrupt
+            return content
+
+        fake_request.answer = echo_until_cell_2
+        offline = jupyter_translate.TranslatorClient(backend=jupyter_translate.FakeBackend())
+        with pytest.raises(KeyboardInterrupt):
+            jupyter_translate.jupyter_translate(path, 'en', 'ja', 0, client=offline)
+        assert (tmp_path / "long_ja.journal.jsonl").exists()
+        fake_request.sent.clear()
+        fake_request.answer = fake_request.wrap
+
+        summary = jupyter_translate.jupyter_translate(path, 'en', 'ja', 0, resume=True)
+
+        assert summary["resumed"] == 0
+        assert sorted(fake_request.sent) == ["Cell 0", "Cell 1", "Cell 2"]
+
+    def test_journal_of_another_model_is_ignored(self, tmp_path, write_notebook, fake_request):
+        path = write_notebook("long.ipynb", [
+            {"cell_type": "markdown", "metadata": {}, "source": [f"Cell {i}"]} for i in range(3)
+        ])
+        def crash_on_cell_2(content, lang):
+            if content == "Cell 2":
+                raise KeyboardInterrupt
+            return fake_request.wrap(content, lang)
+
+        fake_request.answer = crash_on_cell_2
+        with pytest.raises(KeyboardInterrupt):
+            jupyter_translate.jupyter_translate(path, 'en', 'ja', 0, model="gpt-4.1")
+        assert (tmp_path / "long_ja.journal.jsonl").exists()
+        fake_request.sent.clear()
+        fake_request.answer = fake_request.wrap
+
+        summary = jupyter_translate.jupyter_translate(path, 'en', 'ja', 0, resume=True,
+                                                      model="gpt-4o-mini")
+
+        assert summary["resumed"] == 0
+        assert sorted(fake_request.sent) == ["Cell 0", "Cell 1", "Cell 2"]
+
+
+class TestEstimate:
+    def test_estimate_matches_requests_of_a_real_run(self, tmp_path, write_notebook):
+        for i in range(3):
+            write_notebook(f"ch{i}.ipynb", [
+                {"cell_type": "markdown", "metadata": {}, "source": ["Watch the video!\n"]},
+                {"cell_type": "markdown", "metadata": {},
+                 "source": [f"Chapter {i} uses `torch` and $x^{i}$"]},
+                {"cell_type": "markdown", "metadata": {},
+                 "source": ["![img](data:image/png;base64,AAAA)"]},
+                {"cell_type": "code", "metadata": {}, "outputs": [],
+                 "source": ["x = f(x)  # shape  check\n", f"print('step {i}')\n",
+                            "y = 1  # done\n"]},
+                {"cell_type": "code", "metadata": {}, "outputs": [], "source": ["z = 2"]},
+            ])
+        paths = jupyter_translate.find_notebooks(str(tmp_path), "ja")
+
+        report = jupyter_translate.estimate_translation(paths, "ja", pack_tokens=1000, workers=2)
+        assert list(tmp_path.iterdir()) and all(p.suffix == ".ipynb" for p in tmp_path.iterdir())
+
+        client = jupyter_translate.TranslatorClient(backend=jupyter_translate.FakeBackend())
+        try:
+            summaries = jupyter_translate.translate_directory(str(tmp_path), 'en', 'ja', 0,
+                                                              client=client, pack_tokens=1000,
+                                                              workers=2)
+        finally:
+            client.close()
+        assert report["total"]["requests"] == client.usage.snapshot()[0]
+        assert [n["requests"] for n in report["notebooks"]] == [s["requests"] for s in summaries]
+        assert report["shared"]["strings"] == 3
+        assert report["total"]["completion_tokens"] == sum(
+            r.completion_tokens for r in client.metrics.records)
+        assert set(report["total"]["cost_usd"]) == set(jupyter_translate.MODEL_PRICES)
+
+        # Everything is translated now, so an incremental estimate expects nothing.
+        again = jupyter_translate.estimate_translation(paths, "ja", pack_tokens=1000,
+                                                       backend_tag="fake")
+        assert again["total"]["requests"] == 0
+        assert [n["reused"] for n in again["notebooks"]] == [5, 5, 5]
+        # ...unless it is for another backend, which would not reuse the fake output.
+        other = jupyter_translate.estimate_translation(paths, "ja", pack_tokens=1000)
+        assert other["total"]["requests"] == report["total"]["requests"]
+
+    def test_rate_limits_stretch_projected_time(self, write_notebook):
+        path = write_notebook("ten.ipynb", [
+            {"cell_type": "markdown", "metadata": {}, "source": [f"Cell {i}"]} for i in range(10)
+        ])
+        fast = jupyter_translate.estimate_translation([path], "ja", workers=10,
+                                                      per_token_latency=0)
+        limited = jupyter_translate.estimate_translation([path], "ja", workers=10,
+                                                         per_token_latency=0, rpm=60)
+        assert fast["total"]["requests"] == 10
+        assert fast["total"]["seconds"] == 1.0
+        assert limited["total"]["seconds"] == 10.0
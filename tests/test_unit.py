@@ -1,6 +1,8 @@
 import pytest
 import sys
 import os
+import json
+import threading
 from unittest.mock import patch, MagicMock
 
 # Add the parent directory to the path so we can import jupyter_translate
@@ -161,4 +163,704 @@ class TestTranslateCodeCommentsAndPrints:
             result = jupyter_translate.translate_code_comments_and_prints(code_with_print, mock_translator, delay=0)
         
         # Assert that we get the expected output
-        assert 'print("Hello, translated world!")' == result 
\ No newline at end of file
+        assert 'print("Hello, translated world!")' == result 
+
+class TestTranslationCache:
+    def test_hit_and_miss_counters(self, tmp_path):
+        cache = jupyter_translate.TranslationCache(tmp_path / "cache.sqlite")
+        key = cache.make_key("hello", "ja", "gpt-4.1-mini", "system", 1.0)
+
+        assert cache.get(key) is None
+        cache.put(key, "こんにちは")
+        assert cache.get(key) == "こんにちは"
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 1
+
+    def test_key_depends_on_prompt_and_temperature(self):
+        make_key = jupyter_translate.TranslationCache.make_key
+        base = make_key("hello", "ja", "gpt-4.1-mini", "system", 1.0)
+        assert base != make_key("hello", "ja", "gpt-4.1-mini", "other system", 1.0)
+        assert base != make_key("hello", "ja", "gpt-4.1-mini", "system", 0.7)
+        assert base != make_key("hello", "ko", "gpt-4.1-mini", "system", 1.0)
+
+    def test_lru_eviction(self, tmp_path):
+        cache = jupyter_translate.TranslationCache(tmp_path / "cache.sqlite", max_bytes=10)
+        cache.put("a", "12345")
+        cache.put("b", "12345")
+        cache.get("a")  # "b" is now the least recently used entry
+        cache.put("c", "12345")
+
+        assert cache.get("b") is None
+        assert cache.get("a") == "12345"
+        assert cache.stats()["evictions"] == 1
+
+    def test_rerun_makes_no_api_calls(self, tmp_path, monkeypatch):
+        monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+        cache = jupyter_translate.TranslationCache(tmp_path / "cache.sqlite")
+        client = jupyter_translate.TranslatorClient(cache=cache)
+        response = MagicMock()
+        response.choices[0].message.content = "翻訳"
+
+        with patch('jupyter_translate.openai.ChatCompletion.create',
+                   return_value=response) as create:
+            first = jupyter_translate.translate_markdown("Hello\n", delay=0,
+                                                         dest_language="ja", client=client)
+            second = jupyter_translate.translate_markdown("Hello\n", delay=0,
+                                                          dest_language="ja", client=client)
+
+        assert first == second == "翻訳\n"
+        assert create.call_count == 1
+
+
+
+class TestTranslationMemory:
+    TODO_CELL = ("## TODO: Implement the attention head\n"
+                 "Fill in the blanks so that the query, key and value projections "
+                 "have the right shapes.")
+
+    def test_similar_segment_found_dissimilar_ignored(self, tmp_path):
+        memory = jupyter_translate.TranslationMemory(tmp_path / "memory.sqlite")
+        memory.add("ja", self.TODO_CELL, "## TODO: アテンションヘッドを実装しよう")
+        memory.add("ja", "Something else entirely, about plotting.", "プロット")
+
+        near = memory.lookup("ja", self.TODO_CELL.replace("attention head", "attention heads"))
+        assert near.source == self.TODO_CELL
+        assert 0.6 <= near.similarity < 1.0
+        assert memory.lookup("ja", "A cell about tokenizers and vocabularies.") is None
+        assert memory.lookup("ko", self.TODO_CELL) is None
+
+    def test_near_identical_cell_reused_similar_cell_referenced(self, tmp_path, fake_request):
+        memory = jupyter_translate.TranslationMemory(tmp_path / "memory.sqlite",
+                                                     reuse_threshold=0.95,
+                                                     reference_threshold=0.5)
+        memory.add("ja", self.TODO_CELL, "## TODO: アテンションヘッドを実装しよう")
+        client = jupyter_translate.TranslatorClient(
+            backend=jupyter_translate.OpenAIBackend(api_key="sk-test"), memory=memory)
+        fake_request.answer = lambda content, lang: "## TODO: マルチヘッドを実装しよう"
+
+        try:
+            reused = jupyter_translate.translate_markdown(
+                self.TODO_CELL + " ", delay=0, dest_language="ja", client=client)
+            edited = jupyter_translate.translate_markdown(
+                self.TODO_CELL.replace("attention head", "multi-head attention block"),
+                delay=0, dest_language="ja", client=client)
+        finally:
+            client.close()
+
+        prompts = [system_msg for _, system_msg, _ in fake_request.calls]
+
+        assert reused == "## TODO: アテンションヘッドを実装しよう"
+        assert len(prompts) == 1
+        assert "アテンションヘッドを実装しよう" in prompts[0]
+        assert memory.reused == 1 and memory.referenced == 1
+
+    def test_edited_number_is_not_reused(self, tmp_path):
+        cell = ("Train the model with AdamW and a learning rate of 0.001. " * 5).strip()
+        edited = cell.replace("0.001", "0.01", 1)
+        for threshold in (None, 0.95):
+            memory = jupyter_translate.TranslationMemory(tmp_path / f"{threshold}.sqlite",
+                                                         reuse_threshold=threshold)
+            memory.add("ja", cell, "学習率 0.001 で学習する。")
+            match = memory.lookup("ja", edited)
+            assert match.similarity >= 0.95
+            assert not memory.reusable(match, edited)
+            assert memory.reusable(memory.lookup("ja", cell + "  "), cell + "  ")
+            memory.close()
+
+    def test_nested_list_does_not_reuse_flat_list(self, tmp_path):
+        flat = "Steps:\n\n- load the data\n- train the model\n- plot the loss"
+        nested = "Steps:\n\n- load the data\n    - train the model\n    - plot the loss"
+        assert jupyter_translate.normalize_text(nested) != jupyter_translate.normalize_text(flat)
+        assert (jupyter_translate.normalize_text("\n- load   the data  \n")
+                == "- load the data")
+
+        memory = jupyter_translate.TranslationMemory(tmp_path / "memory.sqlite")
+        client = jupyter_translate.TranslatorClient(backend=jupyter_translate.FakeBackend(),
+                                                    memory=memory)
+        client.remember("markdown", "ja", flat, "手順:\n\n- 読み込む\n- 学習する\n- 描く")
+        client.learn("ja", flat, "手順:\n\n- 読み込む\n- 学習する\n- 描く")
+
+        assert client.recall("markdown", "ja", flat + "\n") is not None
+        assert client.recall("markdown", "ja", nested) is None
+
+    def test_inline_image_is_stored_as_digest(self, tmp_path):
+        image = "iVBORw0KGgo" + "A" * 150_000
+        cell = f"The loss curve:\n\n![loss](data:image/png;base64,{image})"
+        memory = jupyter_translate.TranslationMemory(tmp_path / "memory.sqlite")
+        client = jupyter_translate.TranslatorClient(
+            backend=jupyter_translate.OpenAIBackend(api_key="sk-test"), memory=memory)
+        try:
+            client.learn("ja", cell, cell.replace("The loss curve", "損失曲線"))
+            (source,), = memory._conn.execute("SELECT source FROM segments").fetchall()
+            shingles, _ = memory._signature(jupyter_translate._strip_data_uris(cell))
+
+            assert image not in source and len(source) < 100
+            assert len(shingles) < 100
+            assert client.recall("markdown", "ja", cell) == cell.replace("The loss curve",
+                                                                         "損失曲線")
+            assert client.recall("markdown", "ja", cell.replace("AAAA", "BBBB", 1)) is None
+        finally:
+            client.close()
+
+    def test_answers_of_another_backend_are_not_recalled(self, tmp_path):
+        memory = jupyter_translate.TranslationMemory(tmp_path / "memory.sqlite")
+        offline = jupyter_translate.TranslatorClient(backend=jupyter_translate.FakeBackend(),
+                                                     memory=memory)
+        offline.learn("ja", self.TODO_CELL, self.TODO_CELL)  # an echoed answer
+        assert offline.recall("markdown", "ja", self.TODO_CELL) == self.TODO_CELL
+
+        client = jupyter_translate.TranslatorClient(
+            backend=jupyter_translate.OpenAIBackend(api_key="sk-test"), memory=memory)
+        try:
+            assert client.recall("markdown", "ja", self.TODO_CELL) is None
+        finally:
+            client.close()
+
+
+class TestBatchedCodeTranslation:
+    def test_cell_fragments_sent_in_one_request(self, fake_request):
+        cell_source = ["# first comment\n", "x = 1  # second comment\n", "print('done')"]
+
+        result = jupyter_translate.translate_code_sources(cell_source, dest_language="ja")
+
+        assert len(fake_request.sent) == 1
+        assert result == ["# <first comment>\n", "x = 1  # <second comment>\n", "print('<done>')"]
+
+    def test_unparseable_batch_falls_back_per_item(self, fake_request):
+        fake_request.answer = lambda content, lang: (
+            "Sorry, here you go: first, second" if content.startswith("[") else content.upper())
+
+        result = jupyter_translate.translate_code_texts(["first", "second"], dest_language="ja")
+
+        assert result == ["FIRST", "SECOND"]
+        assert len(fake_request.sent) == 3
+
+    def test_batch_response_inside_code_fence(self):
+        assert jupyter_translate._parse_batch_response('```json\n["a", "b"]\n```', 2) == ["a", "b"]
+        assert jupyter_translate._parse_batch_response('["a"]', 2) is None
+
+
+
+class TestCodeFragmentExtraction:
+    CODE = (
+        'url = "http://x.com/#top"  # link to the docs\n'
+        'def f(step, loss):\n'
+        '    """\n'
+        '    Compute the thing.\n'
+        '    """\n'
+        '    print(f"Step {step}: {loss:.3f}", sep=" ")\n'
+        '    # TODO: fill in\n'
+        '%matplotlib inline\n'
+    )
+
+    def test_only_real_comments_and_messages_are_extracted(self):
+        fragments = jupyter_translate._extract_code_fragments(self.CODE)
+        assert [f.text for f in fragments] == [
+            "link to the docs", "Compute the thing.", "Step @@P0@@: @@P1@@", "fill in"]
+
+    def test_translations_are_spliced_back(self):
+        fragments = jupyter_translate._extract_code_fragments(self.CODE)
+        translations = ["ドキュメント", "計算する。", "ステップ @@P0@@: @@P1@@", "埋める"]
+        result = jupyter_translate._join_code_fragments(self.CODE, fragments, translations)
+        assert '"http://x.com/#top"  # ドキュメント\n' in result
+        assert '    """\n    計算する。\n    """\n' in result
+        assert 'print(f"ステップ {step}: {loss:.3f}", sep=" ")' in result
+        assert '# TODO: 埋める\n%matplotlib inline\n' in result
+
+    def test_lost_format_field_keeps_original(self):
+        code = 'print(f"Step {step}")'
+        fragments = jupyter_translate._extract_code_fragments(code)
+        assert jupyter_translate._join_code_fragments(code, fragments, ["ステップ"]) == code
+
+    def test_strings_of_only_format_fields_are_skipped(self):
+        code = ('print(f"{x}")\n'
+                'print(f"{a}/{b}")\n'
+                'print(f"{name}: {value:.2f}")\n'
+                'print(f"{n} items")\n')
+        fragments = jupyter_translate._extract_code_fragments(code)
+        assert [f.text for f in fragments] == ["@@P0@@ items"]
+
+    def test_docstring_line_ending_in_question_mark_is_kept(self):
+        code = 'def f():\n    """\n    Why does this work?\n    """\n'
+        fragments = jupyter_translate._extract_code_fragments(code)
+        assert [f.text for f in fragments] == ["Why does this work?"]
+        result = jupyter_translate._join_code_fragments(code, fragments, ["なぜ？"])
+        assert result == 'def f():\n    """\n    なぜ？\n    """\n'
+
+    def test_comment_ending_in_question_mark_is_translated(self):
+        code = 'x = 1  # is this right?\n'
+        fragments = jupyter_translate._extract_code_fragments(code)
+        assert [f.text for f in fragments] == ["is this right?"]
+
+    def test_help_and_magic_lines_are_skipped_only_at_statement_start(self):
+        code = ('np.mean?\n'
+                '!echo "# not a comment"\n'
+                'text = """\n'
+                '% of total\n'
+                '"""\n'
+                'print("done")\n')
+        fragments = jupyter_translate._extract_code_fragments(code)
+        assert [f.text for f in fragments] == ["done"]
+        strings = [t.string for t in jupyter_translate._tokenize_code(code)]
+        assert '"""\n% of total\n"""' in strings
+
+    def test_quotes_inside_format_fields_are_not_escaped(self):
+        fields = ('{d["k"]}',)
+        frag = jupyter_translate.CodeFragment(0, 24, 'f"', "nested @@P0@@ value", '"',
+                                              "", fields, '"')
+        rendered = jupyter_translate._render_fragment(frag, 'NESTED "@@P0@@" VALUE')
+        assert rendered == 'f"NESTED \\"{d["k"]}\\" VALUE"'
+
+
+class TestMarkdownPacking:
+    def test_plan_packs_small_markdown_cells(self):
+        cells = [
+            {"cell_type": "markdown", "source": ["Short one\n"]},
+            {"cell_type": "code", "source": ["x = 1"]},
+            {"cell_type": "markdown", "source": ["Short two"]},
+            {"cell_type": "markdown", "source": ["word " * 400]},
+            {"cell_type": "markdown", "source": []},
+        ]
+        jobs = jupyter_translate._plan_jobs(cells, pack_tokens=50)
+        assert jobs == [[1], [3], [4], [0, 2]]
+
+    def test_packed_response_is_split_back(self, fake_request):
+        fake_request.answer = lambda content, lang: (
+            content.replace("Hello", "Hola").replace("World", "Mundo"))
+
+        result = jupyter_translate.translate_markdown_batch(
+            ["Hello\n", "World"], delay=0, dest_language="es")
+
+        assert result == ["Hola\n", "Mundo"]
+        assert len(fake_request.sent) == 1
+
+    def test_segment_count_mismatch_falls_back(self, fake_request):
+        fake_request.answer = lambda content, lang: (
+            "<<<CELL 1>>>\nHola y Mundo" if "<<<CELL" in content else content.upper())
+
+        result = jupyter_translate.translate_markdown_batch(
+            ["Hello", "World"], delay=0, dest_language="es")
+
+        assert result == ["HELLO", "WORLD"]
+        assert len(fake_request.sent) == 3
+
+
+class TestNotebookSource:
+    NOTEBOOK = (
+        '{\n "cells": [\n  {\n   "cell_type": "markdown",\n   "metadata": {},\n'
+        '   "source": [\n    "Hello\\n",\n    "World"\n   ]\n  },\n  {\n'
+        '   "cell_type": "code",\n   "outputs": [{"data": {"image/png": "iVBORw0KGgo\\"x"}}],\n'
+        '   "source": "print(\\"[hi]\\")"\n  }\n ],\n "nbformat": 4\n}\n'
+    )
+
+    def test_reads_only_cell_sources(self, tmp_path):
+        path = tmp_path / "nb.ipynb"
+        path.write_text(self.NOTEBOOK, encoding='utf-8')
+
+        with jupyter_translate.NotebookSource(str(path)) as nb:
+            assert [c['cell_type'] for c in nb.cells] == ['markdown', 'code']
+            assert nb.cells[0]['source'] == ["Hello\n", "World"]
+            assert nb.cells[1]['source'] == ['print("[hi]")']
+            assert 'outputs' not in nb.cells[1]
+
+    def test_write_splices_sources_and_keeps_outputs(self, tmp_path):
+        path = tmp_path / "nb.ipynb"
+        out = tmp_path / "nb_ja.ipynb"
+        path.write_text(self.NOTEBOOK, encoding='utf-8')
+
+        with jupyter_translate.NotebookSource(str(path)) as nb:
+            nb.write(str(out), {0: ["こんにちは\n", "世界"]})
+
+        text = out.read_text(encoding='utf-8')
+        assert '   "source": [\n    "こんにちは\\n",\n    "世界"\n   ]' in text
+        assert '"image/png": "iVBORw0KGgo\\"x"' in text
+        expected = json.loads(self.NOTEBOOK)
+        expected['cells'][0]['source'] = ["こんにちは\n", "世界"]
+        assert json.loads(text) == expected
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept += seconds
+        self.now += seconds
+
+
+class TestRateLimiter:
+    @pytest.fixture
+    def clock(self, monkeypatch):
+        clock = FakeClock()
+        monkeypatch.setattr('time.time', clock.time)
+        monkeypatch.setattr('time.sleep', clock.sleep)
+        return clock
+
+    def test_requests_per_minute_are_spread(self, clock):
+        limiter = jupyter_translate.RateLimiter(rpm=60)
+        for _ in range(5):  # burst capacity is five seconds of budget
+            limiter.acquire()
+        assert clock.slept == 0
+        limiter.acquire()
+        assert clock.slept == pytest.approx(1.0)
+
+    def test_tokens_per_minute_bucket(self, clock):
+        limiter = jupyter_translate.RateLimiter(tpm=6000)  # 100 tokens/s, 500 burst
+        limiter.acquire(500)
+        limiter.acquire(200)
+        assert clock.slept == pytest.approx(2.0)
+
+    def test_settle_returns_overestimated_tokens(self, clock):
+        limiter = jupyter_translate.RateLimiter(tpm=6000)
+        limiter.acquire(500)
+        limiter.settle(500, 100)
+        limiter.acquire(400)
+        assert clock.slept == 0
+
+    def test_pause_blocks_until_retry_after(self, clock):
+        limiter = jupyter_translate.RateLimiter(retry_delay=3)
+        limiter.pause(7.5)
+        limiter.acquire()
+        assert clock.slept == pytest.approx(7.5)
+        limiter.pause()
+        limiter.acquire()
+        assert clock.slept == pytest.approx(10.5)
+
+    def test_rate_limit_error_honours_retry_after(self, clock, monkeypatch):
+        monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+        client = jupyter_translate.TranslatorClient()
+        response = MagicMock()
+        response.choices[0].message.content = "ok"
+        error = jupyter_translate.openai.error.RateLimitError(
+            "slow down", headers={"retry-after": "4"})
+
+        with patch('jupyter_translate.openai.ChatCompletion.create',
+                   side_effect=[error, response]) as create:
+            result = jupyter_translate.translate_code_text("hi", dest_language="ja",
+                                                           client=client)
+
+        assert result == "ok"
+        assert create.call_count == 2
+        assert clock.slept == pytest.approx(4.0)
+
+
+class TestTranslatorClient:
+    def test_requests_share_session_key_and_timeout(self):
+        backend = jupyter_translate.OpenAIBackend(api_key="sk-client", timeout=5)
+        client = jupyter_translate.TranslatorClient(backend=backend)
+        response = MagicMock()
+        response.choices[0].message.content = "訳"
+
+        try:
+            assert backend._session is None  # opened by the first request
+            with patch('jupyter_translate.openai.ChatCompletion.create',
+                       return_value=response) as create:
+                jupyter_translate.translate_code_text("a", dest_language="ja", client=client)
+                jupyter_translate.translate_code_text("b", dest_language="ja", client=client)
+            assert backend._session is not None
+            assert jupyter_translate.openai.requestssession is backend._session
+        finally:
+            client.close()
+
+        assert create.call_count == 2
+        kwargs = create.call_args.kwargs
+        assert kwargs["api_key"] == "sk-client"
+        assert kwargs["request_timeout"] == 5
+        assert client.usage.snapshot()[0] == 2
+        assert jupyter_translate.openai.requestssession is None
+
+    def test_system_prompts_are_joined_once(self):
+        client = jupyter_translate.TranslatorClient(
+            backend=jupyter_translate.OpenAIBackend(api_key="sk-client"))
+        combined = client.system_prompt("code_translation_system_prompt_lines",
+                                        "batch_translation_instruction_lines")
+        assert combined is client.system_prompt("code_translation_system_prompt_lines",
+                                                "batch_translation_instruction_lines")
+        with pytest.raises(RuntimeError):
+            client.system_prompt("no_such_prompt_lines")
+        client.close()
+
+
+class TestMarkdownValidation:
+    def test_clean_translation_has_no_problems(self):
+        source = "# Title\n\n$$a = b~c$$\n\nTODO: fill in\n"
+        assert jupyter_translate.validate_markdown_translation(
+            source, "# タイトル\n\n$$a = b~c$$\n\nTODO: 埋める\n") == []
+
+    def test_structural_damage_is_reported(self):
+        source = "# Title\n\n$$a = b~c$$\n\nTODO: fill in\n"
+        problems = jupyter_translate.validate_markdown_translation(
+            source, "タイトル\n\n$$a = bc$$>\n\n埋める")
+        text = " ".join(problems)
+        assert "math block" in text
+        assert "headings" in text
+        assert "TODO:" in text
+        assert "stray" in text
+        assert "trailing newline" in text
+
+    def test_broken_cells_are_re_requested_within_budget(self):
+        cells = [{"cell_type": "markdown", "source": ["# A\n"]},
+                 {"cell_type": "markdown", "source": ["# B\n"]}]
+        translated = {0: ["A\n"], 1: ["B\n"]}
+        calls = []
+
+        def fake_translate(text, *_, problems=None, **kwargs):
+            calls.append((text, problems))
+            return "# " + text[2:]
+
+        with patch('jupyter_translate.translate_markdown', side_effect=fake_translate):
+            repaired, invalid = jupyter_translate._repair_markdown_cells(
+                cells, translated, [0, 1], "ja", 0, None, 1, max_fix_requests=1)
+
+        assert len(calls) == 1 and calls[0][1]
+        assert repaired == [0] and invalid == [1]
+        assert translated[0] == ["# A\n"]
+
+
+class TestMarkdownMasking:
+    SOURCE = ("See $x_i$, `code` and [docs](https://example.com/a) <br> for $5 or $10.\n"
+              "```python\nprint('hi')\n```\n"
+              "$$\na = b~c\n$$\n"
+              "![img](data:image/png;base64,AAAA)\n")
+
+    def test_mask_round_trip(self):
+        masked, spans = jupyter_translate.mask_markdown(self.SOURCE)
+        assert "print" not in masked and "base64" not in masked and "b~c" not in masked
+        assert "https://" not in masked and "<br>" not in masked
+        assert "$5 or $10" in masked
+        assert jupyter_translate.unmask_markdown(masked, spans) == self.SOURCE
+
+    def test_masked_spans_never_reach_the_model(self, fake_request):
+        fake_request.answer = lambda content, lang: (
+            content.replace("See", "Mira").replace("for", "por"))
+
+        result = jupyter_translate.translate_markdown(self.SOURCE, delay=0, dest_language="es")
+
+        assert not [c for c in fake_request.sent if "print('hi')" in c]
+        assert result.startswith("Mira $x_i$, `code` and [docs](https://example.com/a) <br> por")
+        assert "```python\nprint('hi')\n```\n$$\na = b~c\n$$\n" in result
+
+    def test_lost_placeholder_falls_back_to_unmasked_request(self, fake_request):
+        fake_request.answer = lambda content, lang: (
+            "lost everything\n" if "@@P" in content else content)
+
+        result = jupyter_translate.translate_markdown(self.SOURCE, delay=0, dest_language="es")
+
+        contents = fake_request.sent
+        assert len(contents) == 2 and contents[1] == self.SOURCE
+        assert result == self.SOURCE
+
+    def test_code_only_cell_needs_no_request(self):
+        with patch('jupyter_translate._request_completion') as req:
+            text = "```python\nx = 1\n```\n"
+            assert jupyter_translate.translate_markdown(text, delay=0, dest_language="es") == text
+        req.assert_not_called()
+
+
+class TestMarkdownChunking:
+    PARAGRAPH = "Attention mixes the tokens of a sequence with learned weights. " * 6
+    SOURCE = ("# Attention\n\n" + PARAGRAPH + "\n\n"
+              "```python\nx = 1\n\n# not a heading\ny = 2\n```\n\n"
+              "$$\nq = k\n\nv = w\n$$\n\n"
+              "## Softmax\n" + PARAGRAPH + "\n")
+
+    def test_split_keeps_blocks_whole(self):
+        chunks = jupyter_translate.split_markdown(self.SOURCE, 120)
+        assert len(chunks) > 1
+        assert "".join(chunks) == self.SOURCE
+        assert any("```python\nx = 1\n\n# not a heading\ny = 2\n```" in c for c in chunks)
+        assert any("$$\nq = k\n\nv = w\n$$" in c for c in chunks)
+        assert chunks[-1].startswith("## Softmax")
+
+    def test_short_cells_are_not_split(self):
+        assert jupyter_translate.split_markdown(self.SOURCE, 0) == [self.SOURCE]
+        assert jupyter_translate.split_markdown("One line.\n", 120) == ["One line.\n"]
+
+    def test_chunks_are_translated_separately_and_joined_in_order(self, fake_request):
+        fake_request.answer = lambda content, lang: content.upper()
+
+        result = jupyter_translate.translate_markdown(self.SOURCE, delay=0,
+                                                      dest_language="es", chunk_tokens=120)
+
+        assert len(fake_request.sent) == len(jupyter_translate.split_markdown(self.SOURCE, 120))
+        assert result.startswith("# ATTENTION\n\nATTENTION MIXES")
+        assert "```python\nx = 1\n\n# not a heading\ny = 2\n```\n\n" in result
+        assert "\n\n## SOFTMAX\n" in result and result.endswith("WEIGHTS. \n")
+
+    def test_chunk_threads_are_capped_at_workers(self, fake_request):
+        lock, active, peak = threading.Lock(), [0], [0]
+
+        def slow_upper(content, lang):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            threading.Event().wait(0.02)
+            with lock:
+                active[0] -= 1
+            return content.upper()
+
+        fake_request.answer = slow_upper
+        source = "\n\n".join(f"## Part {i}\n" + self.PARAGRAPH for i in range(6))
+
+        jupyter_translate.translate_markdown(source, delay=0, dest_language="es",
+                                             chunk_tokens=120, workers=2)
+
+        assert len(fake_request.sent) == 6
+        assert peak[0] <= 2
+
+
+class TestLanguageDetection:
+    def test_detects_scripts_and_latin_languages(self):
+        detect = jupyter_translate.detect_language
+        assert detect("First Citizen:\nBefore we proceed any further, hear me speak.\n\n"
+                      "All:\nSpeak, speak.") == "en"
+        assert detect("Attention の Query と Key を計算します。") == "ja"
+        assert detect("这是一个中文句子，用来测试语言识别。") == "zh"
+        assert detect("Это предложение на русском языке для проверки.") == "ru"
+        assert detect("El modelo aprende de los datos y la atención es muy importante.") == "es"
+
+    def test_undecided_text_returns_none(self):
+        detect = jupyter_translate.detect_language
+        assert detect("### **Section 1: __init__(1)**") is None
+        assert detect("Epoch 1: loss 2.31, val loss 2.40") is None
+        assert detect("```python\nprint('the answer is in the code')\n```") is None
+        assert detect("Sorted characters: [' ', '!', 'H', 'W', 'd', 'e', 'l', 'o', 'r']") is None
+
+    def test_metadata_overrides_detection(self):
+        cell = {"cell_type": "markdown", "metadata": {},
+                "source": ["This is already written in English, so there is nothing to do."]}
+        assert jupyter_translate._skip_reason(cell, "en") == "language"
+        assert jupyter_translate._skip_reason(cell, "ja") is None
+        plain_hash = jupyter_translate.cell_hash(cell)
+
+        cell["metadata"] = {"jupyter_translate": {"translate": True}}
+        assert jupyter_translate._skip_reason(cell, "en") is None
+        cell["metadata"] = {"jupyter_translate": {"translate": False}}
+        assert jupyter_translate._skip_reason(cell, "ja") == "metadata"
+        # Flipping the flag must invalidate the cell for incremental runs.
+        assert jupyter_translate.cell_hash(cell) != plain_hash
+        cell["metadata"] = {"tags": ["x"]}
+        assert jupyter_translate.cell_hash(cell) == plain_hash
+
+
+class TestFakeBackend:
+    def test_failures_are_reproducible(self):
+        def outcomes(seed):
+            backend = jupyter_translate.FakeBackend(error_rate=0.5, seed=seed)
+            result = []
+            for text in ["a", "b", "c", "d", "a", "a"]:
+                try:
+                    result.append(backend.complete("sys", text, "ja", "m", 1.0).text)
+                except jupyter_translate.RateLimitedError:
+                    result.append(None)
+            return result
+
+        assert outcomes(1) == outcomes(1)
+        assert None in outcomes(1)
+        assert set(outcomes(1)) - {None} <= {"a", "b", "c", "d"}
+
+    def test_client_retries_through_fake_rate_limits(self):
+        backend = jupyter_translate.make_backend("fake", error_rate=0.5, retry_after=0)
+        client = jupyter_translate.TranslatorClient(
+            backend=backend, limiter=jupyter_translate.RateLimiter(retry_delay=0))
+        assert [client.complete(t, "sys", "ja", "m", 1.0) for t in "abcdef"] == list("abcdef")
+        assert client.usage.snapshot()[0] == 6
+
+
+class TestCallMetrics:
+    def test_calls_are_recorded_with_cells_prompt_and_cache(self, tmp_path):
+        client = jupyter_translate.TranslatorClient(
+            backend=jupyter_translate.FakeBackend(error_rate=0.0),
+            cache=jupyter_translate.TranslationCache(tmp_path / "cache.sqlite"))
+        system_msg = client.system_prompt("code_translation_system_prompt_lines")
+        token = jupyter_translate.CallMetrics.context("nb.ipynb", [3])
+        try:
+            client.complete("hello", system_msg, "ja", "gpt-4.1-mini", 0.7)
+            client.complete("hello", system_msg + "\n- retry hint", "ja", "gpt-4.1-mini", 0.7)
+            client.complete("hello", system_msg, "ja", "gpt-4.1-mini", 0.7)
+        finally:
+            jupyter_translate.CallMetrics.reset_context(token)
+            client.close()
+
+        records = client.metrics.for_notebook("nb.ipynb")
+        assert [r.cache for r in records] == ["miss", "miss", "hit"]
+        assert {r.prompt for r in records} == {"code_translation_system_prompt_lines"}
+        assert records[0].cells == (3,) and records[0].prompt_tokens > 0
+
+    def test_summary_percentiles_and_cost(self):
+        records = [
+            jupyter_translate.CallRecord("nb", (i,), "p", "gpt-4.1-mini", "off", 0.0,
+                                         float(i), 0, 1_000_000, 0)
+            for i in range(1, 21)
+        ]
+        summary = jupyter_translate.summarize_calls(records)
+        assert summary["latency_p50"] == 10.0
+        assert summary["latency_p95"] == 19.0
+        assert summary["cost_usd"] == {"gpt-4.1-mini": pytest.approx(8.0)}
+
+        report = jupyter_translate.build_run_report(
+            [{"file": "nb", "seconds": 1.0, "calls": [r._asdict() for r in records]}])
+        text = jupyter_translate.format_prometheus(report)
+        assert 'jupyter_translate_requests_total{notebook="nb"} 20' in text
+        assert 'jupyter_translate_cost_usd{model="gpt-4.1-mini"} 8.0' in text
+
+
+class TestStartupCost:
+    HEAVY = ["openai", "backoff", "tqdm", "requests", "dotenv", "http.server",
+             "concurrent.futures.process"]
+
+    def _run(self, code):
+        import subprocess
+        root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+        proc = subprocess.run([sys.executable, "-c", code], cwd=root, check=True,
+                              stdout=subprocess.PIPE, universal_newlines=True)
+        return json.loads(proc.stdout.strip().splitlines()[-1])
+
+    def test_import_loads_no_backend_libraries(self):
+        loaded = self._run(
+            "import json, sys, time\n"
+            "started = time.perf_counter()\n"
+            "import jupyter_translate\n"
+            "print(json.dumps([time.perf_counter() - started, sorted(sys.modules)]))")
+        seconds, modules = loaded
+        assert not set(self.HEAVY) & set(modules)
+        # Generous budget: importing should not pay for any client library.
+        assert seconds < 1.0
+
+    def test_help_loads_no_backend_libraries(self):
+        modules = self._run(
+            "import contextlib, io, json, sys\n"
+            "import jupyter_translate\n"
+            "sys.argv = ['jupyter_translate', '--help']\n"
+            "with contextlib.redirect_stdout(io.StringIO()):\n"
+            "    try:\n"
+            "        jupyter_translate.main()\n"
+            "    except SystemExit:\n"
+            "        pass\n"
+            "print(json.dumps(sorted(sys.modules)))")
+        assert not set(self.HEAVY) & set(modules)
+
+    def test_rerun_with_every_cell_reused_loads_no_client(self, write_notebook, fake_request):
+        path = write_notebook("nb.ipynb", [
+            {"cell_type": "markdown", "metadata": {}, "source": ["Hello there\n"]},
+            {"cell_type": "code", "metadata": {}, "outputs": [], "source": ["x = 1  # set x"]},
+        ])
+        jupyter_translate.jupyter_translate(path, 'en', 'ja', 0)
+
+        modules = self._run(
+            "import contextlib, io, json, sys\n"
+            "import jupyter_translate\n"
+            f"sys.argv = ['jupyter_translate', {path!r}, '--target', 'ja',\n"
+            "            '--no-cache', '--no-memory']\n"
+            "with contextlib.redirect_stdout(io.StringIO()):\n"
+            "    jupyter_translate.main()\n"
+            "print(json.dumps(sorted(sys.modules)))")
+        assert not {"openai", "requests", "backoff"} & set(modules)
+
+    def test_lazy_module_attributes(self):
+        assert "tutorial" in json.dumps(jupyter_translate.PROMPTS)
+        assert jupyter_translate.PROMPTS is jupyter_translate.get_prompts()